@@ -1,8 +1,9 @@
 import os
 import json
+import argparse
 from pathlib import Path
 from collections import defaultdict, Counter
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 PROMPT = """Task: Frozen Lake Shortest Path Planning
 
@@ -17,8 +18,6 @@ Your task is to analyze the image and generate the shortest valid sequence of ac
 Provide your final answer enclosed between <ANSWER> and </ANSWER>, for example: <ANSWER>right up up</ANSWER>. \n<image>"""
 
 
-is_test = False
-
 action_map = {
     0: "left",
     1: "down",
@@ -26,105 +25,195 @@ action_map = {
     3: "up"
 }
 
-# Define the root directory where the images and JSON files are stored
-root_dir = Path("frozenlake/optimal_with_distance")  # Relative path without leading slash
-# Alternatively, use an absolute path that exists on your system
-# root_dir = Path("C:/Users/Yi/Documents/GitHub/Qwen2.5/frozenlake/optimal_with_distance")
-output_data = []
-
-length_distributions = defaultdict(list)
-
+# first 1000 maps of every level are for training, the rest for testing
+NUM_TRAIN = 1000
 
-# Loop through level directories (e.g., level0, level1, level2, level3)
-for level_name in os.listdir(root_dir):
-    level_path = root_dir / level_name
-    
-    assert level_path.is_dir()
 
-    # Load the data.json file inside the level directory
-    data_json_path = level_path / "data.json"
+def stat_signature(path: Path):
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
 
-    assert data_json_path.exists()
 
-
-    with open(data_json_path, 'r') as f:
-        data = json.load(f)
+def split_subfolders(level_path: Path, split: str):
+    subfolders = sorted(
+        [p for p in level_path.iterdir() if p.is_dir() and p.name.isdigit()],
+        key=lambda x: int(x.name)
+    )
+    return subfolders[NUM_TRAIN:] if split == "test" else subfolders[:NUM_TRAIN]
 
 
-    if is_test:
-        subfolders = sorted(
-            [p for p in level_path.iterdir() if p.is_dir() and p.name.isdigit()],
-            key=lambda x: int(x.name)
-        )[1000:]
-    else:
-        subfolders = sorted(
-            [p for p in level_path.iterdir() if p.is_dir() and p.name.isdigit()],
-            key=lambda x: int(x.name)
-        )[:1000]
-
-    # Loop through subdirectories (e.g., 0, 1, 2, ..., 1249)
-    for subfolder in subfolders:
-        # print(subfolder)
-
-        assert subfolder.is_dir()
-
-        folder_name = subfolder.name
-        
-        image_path = subfolder / "0.jpg"
-
-        assert image_path.exists()
-
-        for file in subfolder.iterdir():
-            if file.is_file() and file.name != "0.jpg":
-                file.unlink()
-
-        # image_relative_path = f"{level_name}/{folder_name}/0.jpg"
-        actions = [action_map[a] for a in data[folder_name]["actions"]]
-        length_distributions[level_name].append(len(actions))
-
-        output = "<ANSWER>" + " ".join(actions) + "</ANSWER>"
-
-        conversation_data = {
-            "image": str(image_path).replace("\\", "/"),
-            "conversations": [
-                {
-                    "from": "human",
-                    "value": PROMPT
-                },
-                {
-                    "from": "gpt",
-                    "value": output
-                }
-            ]
-        }
-        output_data.append(conversation_data)
+def level_signature(level_path: Path, subfolders):
+    """mtime and size of `data.json` and of every subfolder (mtime) and its image (size)."""
+    return {
+        "data_json": stat_signature(level_path / "data.json"),
+        "folders": {
+            subfolder.name: [subfolder.stat().st_mtime_ns, (subfolder / "0.jpg").stat().st_size]
+            for subfolder in subfolders
+        },
+    }
 
 
-plt.figure(figsize=(12, 6))
-width = 0.2
-all_lengths = sorted(set(length for lengths in length_distributions.values() for length in lengths))
-x_indices = list(range(len(all_lengths)))
+def cleanup_subfolder(subfolder: Path):
+    """Delete everything but `0.jpg` from a map folder."""
+    for file in subfolder.iterdir():
+        if file.is_file() and file.name != "0.jpg":
+            file.unlink()
 
-for i, (level_name, lengths) in enumerate(sorted(length_distributions.items())):
-    counter = Counter(lengths)
-    freqs = [counter.get(length, 0) for length in all_lengths]
-    plt.bar([x + i * width for x in x_indices], freqs, width=width, label=level_name)
 
-plt.xticks([x + width * (len(length_distributions) - 1) / 2 for x in x_indices], all_lengths)
-plt.xlabel("Path Length")
-plt.ylabel("Frequency")
-plt.title("Optimal Path Length Distribution by Level (Bar Chart)")
-plt.legend(title="Level")
-plt.grid(True, axis='y', linestyle='--', alpha=0.7)
-plt.tight_layout()
-plt.show()
+def build_level(level_path: Path, split: str, shard_path: Path, previous=None, cleanup=False):
+    """Write the examples of one level to `shard_path`, unless nothing changed since `previous`.
 
-# if is_test:
-#     output_path = root_dir.parent / "test.json"
-# else:
-#     output_path = root_dir.parent / "train.json"
-# with open(output_path, "w", encoding="utf-8") as f:
-#     json.dump(output_data, f, indent=2, ensure_ascii=False)
+    Returns the new manifest entry of the level and whether the shard was rewritten.
+    """
+    subfolders = split_subfolders(level_path, split)
+    if cleanup:
+        for subfolder in subfolders:
+            cleanup_subfolder(subfolder)
+    signature = level_signature(level_path, subfolders)
+    if previous is not None and shard_path.exists():
+        if {k: previous[k] for k in signature} == signature:
+            return previous, False
 
-# print(f"Saved {len(output_data)} examples to {output_path}")
+    with open(level_path / "data.json", "r") as f:
+        data = json.load(f)
 
+    tmp_path = shard_path.with_name(f"{shard_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for subfolder in subfolders:
+            image_path = subfolder / "0.jpg"
+            assert image_path.exists()
+            actions = [action_map[a] for a in data[subfolder.name]["actions"]]
+            output = "<ANSWER>" + " ".join(actions) + "</ANSWER>"
+            conversation_data = {
+                "image": str(image_path).replace("\\", "/"),
+                "conversations": [
+                    {
+                        "from": "human",
+                        "value": PROMPT
+                    },
+                    {
+                        "from": "gpt",
+                        "value": output
+                    }
+                ]
+            }
+            f.write(json.dumps(conversation_data, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, shard_path)
+    signature["num_examples"] = len(subfolders)
+    return signature, True
+
+
+def build(args):
+    root_dir = Path(args.root_dir)
+    shard_dir = Path(args.shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = shard_dir / f"manifest-{args.split}.json"
+    manifest = {}
+    if manifest_path.exists():
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    level_names = sorted(name for name in os.listdir(root_dir) if (root_dir / name).is_dir())
+    shard_paths = {name: shard_dir / f"{args.split}-{name}.jsonl" for name in level_names}
+    with ProcessPoolExecutor(args.num_workers) as pool:
+        futures = {
+            name: pool.submit(
+                build_level,
+                root_dir / name,
+                args.split,
+                shard_paths[name],
+                manifest.get(name),
+                args.cleanup,
+            )
+            for name in level_names
+        }
+        manifest = {}
+        for name, future in futures.items():
+            manifest[name], changed = future.result()
+            print(f"{name}: {manifest[name]['num_examples']} examples" + ("" if changed else " (unchanged)"))
+
+    tmp_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    # the annotation file is the concatenation of the shards, in level order
+    output_path = Path(args.output or root_dir.parent / f"{args.split}.jsonl")
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    with open(tmp_path, "wb") as out:
+        for name in level_names:
+            with open(shard_paths[name], "rb") as f:
+                while chunk := f.read(1 << 20):
+                    out.write(chunk)
+    os.replace(tmp_path, output_path)
+    print(f"Saved {sum(entry['num_examples'] for entry in manifest.values())} examples to {output_path}")
+
+
+def plot(args):
+    import matplotlib
+
+    if args.output:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    length_distributions = defaultdict(list)
+    for shard_path in sorted(Path(args.shard_dir).glob(f"{args.split}-*.jsonl")):
+        level_name = shard_path.stem[len(args.split) + 1 :]
+        with open(shard_path, "r", encoding="utf-8") as f:
+            for line in f:
+                answer = json.loads(line)["conversations"][1]["value"]
+                actions = answer[len("<ANSWER>") : -len("</ANSWER>")].split()
+                length_distributions[level_name].append(len(actions))
+
+    plt.figure(figsize=(12, 6))
+    width = 0.2
+    all_lengths = sorted(set(length for lengths in length_distributions.values() for length in lengths))
+    x_indices = list(range(len(all_lengths)))
+
+    for i, (level_name, lengths) in enumerate(sorted(length_distributions.items())):
+        counter = Counter(lengths)
+        freqs = [counter.get(length, 0) for length in all_lengths]
+        plt.bar([x + i * width for x in x_indices], freqs, width=width, label=level_name)
+
+    plt.xticks([x + width * (len(length_distributions) - 1) / 2 for x in x_indices], all_lengths)
+    plt.xlabel("Path Length")
+    plt.ylabel("Frequency")
+    plt.title("Optimal Path Length Distribution by Level (Bar Chart)")
+    plt.legend(title="Level")
+    plt.grid(True, axis='y', linestyle='--', alpha=0.7)
+    plt.tight_layout()
+    if args.output:
+        plt.savefig(args.output)
+    else:
+        plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the FrozenLake SFT annotations from the rendered maps.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Write one JSONL shard per level and concatenate them")
+    build_parser.add_argument("--root_dir", type=str, default="frozenlake/optimal_with_distance")
+    build_parser.add_argument("--split", type=str, default="train", choices=["train", "test"])
+    build_parser.add_argument("--shard_dir", type=str, default="frozenlake/shards")
+    build_parser.add_argument("--output", type=str, default=None, help="Defaults to <root_dir>/../<split>.jsonl")
+    build_parser.add_argument("--num_workers", type=int, default=None)
+    build_parser.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="Delete every file except 0.jpg from the map folders of the split (irreversible)",
+    )
+    build_parser.set_defaults(func=build)
+
+    plot_parser = subparsers.add_parser("plot", help="Plot the optimal path length distribution of built shards")
+    plot_parser.add_argument("--split", type=str, default="train", choices=["train", "test"])
+    plot_parser.add_argument("--shard_dir", type=str, default="frozenlake/shards")
+    plot_parser.add_argument("--output", type=str, default=None, help="Save the figure instead of showing it")
+    plot_parser.set_defaults(func=plot)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,109 +1,161 @@
 import json
-from tqdm import tqdm
+import argparse
 from pathlib import Path
+
 import torch
+from tqdm import tqdm
+from torch.utils.data import DataLoader
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
 
-# default: Load the model on the available device(s)
-# model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-#     "Qwen/Qwen2.5-VL-3B-Instruct", torch_dtype="auto", device_map="auto"
-# )
-
-model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-    "output", torch_dtype="auto", device_map="auto"
-)
-
-# We recommend enabling flash_attention_2 for better acceleration and memory saving, especially in multi-image and video scenarios.
-# model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-#     "Qwen/Qwen2.5-VL-7B-Instruct",
-#     torch_dtype=torch.bfloat16,
-#     attn_implementation="flash_attention_2",
-#     device_map="auto",
-# )
-
-# default processor
-processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-3B-Instruct")
-
-with open("frozenlake/test.json", "r") as f:
-    data = json.load(f)
-
-results_path = Path("frozenlake/eval_results_low.json")
-
-if results_path.exists():
-    with open(results_path, "r") as f:
-        results = json.load(f)
-else:
-    results = []
-
-evaluated_images = set(r["image"] for r in results)
+from eval_api import read_examples, read_results
 
 
-idx = 1
-for example in tqdm(data):
-    image_path = example["image"]
-    if image_path in evaluated_images:
-        print(f"Skipping already evaluated image: {image_path}")
-        continue
-
-    print(f"Evaluating data {idx}.")
-    prompt_text = example["conversations"][0]["value"]
-
-    # 构造 messages
-    messages = [
+def build_messages(example):
+    return [
         {
             "role": "user",
             "content": [
-                {"type": "image", "image": image_path},
-                {"type": "text", "text": prompt_text},
+                {"type": "image", "image": example["image"]},
+                {"type": "text", "text": example["conversations"][0]["value"]},
             ],
         }
     ]
 
-    # 文本模板处理
-    text = processor.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
-    )
 
-    # 图像处理（你需要实现或替换 process_vision_info）
-    image_inputs, video_inputs = process_vision_info(messages)
-
-    inputs = processor(
-        text=[text],
-        images=image_inputs,
-        videos=video_inputs,
-        padding=True,
-        return_tensors="pt",
-    ).to(model.device)
-
-    # 模型生成
-    with torch.no_grad():
-        generated_ids = model.generate(
-            **inputs,
-            max_new_tokens=128,
-            do_sample=False  # 可根据需要改为 True
+class EvalCollator(object):
+    """Template, load and preprocess a batch of examples; runs in the DataLoader workers."""
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def __call__(self, examples):
+        messages = [build_messages(example) for example in examples]
+        texts = [
+            self.processor.apply_chat_template(
+                message, tokenize=False, add_generation_prompt=True
+            )
+            for message in messages
+        ]
+        image_inputs, video_inputs = process_vision_info(messages)
+        inputs = self.processor(
+            text=texts,
+            images=image_inputs,
+            videos=video_inputs,
+            padding=True,
+            return_tensors="pt",
         )
+        return examples, dict(inputs)
+
+
+def build_tiny_model(processor):
+    """Randomly initialized two-layer Qwen2.5-VL to exercise the pipeline on CPU."""
+    from transformers import Qwen2_5_VLConfig
+
+    image_processor = processor.image_processor
+    token_id = processor.tokenizer.convert_tokens_to_ids
+    config = Qwen2_5_VLConfig(
+        vision_config=dict(
+            depth=2,
+            hidden_size=32,
+            intermediate_size=64,
+            num_heads=2,
+            out_hidden_size=64,
+            patch_size=image_processor.patch_size,
+            spatial_merge_size=image_processor.merge_size,
+            temporal_patch_size=image_processor.temporal_patch_size,
+            fullatt_block_indexes=[1],
+        ),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        rope_scaling={"type": "mrope", "mrope_section": [4, 6, 6]},
+        image_token_id=token_id("<|image_pad|>"),
+        video_token_id=token_id("<|video_pad|>"),
+        vision_start_token_id=token_id("<|vision_start|>"),
+        vision_end_token_id=token_id("<|vision_end|>"),
+        torch_dtype="float32",
+    )
+    torch.manual_seed(0)
+    return Qwen2_5_VLForConditionalGeneration(config).eval()
 
-    # 解码模型输出
-    generated_ids_trimmed = [
-        out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = processor.batch_decode(
-        generated_ids_trimmed,
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=False,
-    )[0]
-
-    results.append({
-        "image": image_path,
-        "prompt": prompt_text,
-        "model_output": output_text
-    })
-    
-    with open(results_path, "w") as f:
-        json.dump(results, f, indent=2)
-
-    print(image_path)
-    print(output_text)
-    print(example["conversations"][1]["value"])
-    idx += 1
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched FrozenLake evaluation of a Qwen2.5-VL checkpoint.")
+    parser.add_argument("--checkpoint", type=str, default="output", help="Model checkpoint to evaluate")
+    parser.add_argument("--processor", type=str, default="Qwen/Qwen2.5-VL-3B-Instruct", help="Processor to use")
+    parser.add_argument("--test_file", type=str, default="frozenlake/test.json")
+    parser.add_argument(
+        "--output", type=str, default="frozenlake/eval_results_low.jsonl", help="Append-only JSONL results file"
+    )
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=4, help="Processes loading and preprocessing images")
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--limit", type=int, default=None, help="Only evaluate the first N test examples")
+    parser.add_argument(
+        "--tiny", action="store_true", help="Use a random tiny model on CPU instead of --checkpoint (pipeline test)"
+    )
+    args = parser.parse_args()
+
+    processor = AutoProcessor.from_pretrained(args.processor)
+    # decoder-only generation needs the prompts aligned on the right
+    processor.tokenizer.padding_side = "left"
+
+    if args.tiny:
+        model = build_tiny_model(processor)
+    else:
+        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+            args.checkpoint, torch_dtype="auto", device_map="auto"
+        ).eval()
+
+    data = read_examples(args.test_file)
+    if args.limit is not None:
+        data = data[: args.limit]
+
+    results_path = Path(args.output)
+    results = read_results(results_path)
+    evaluated_images = set(r["image"] for r in results)
+    pending = [example for example in data if example["image"] not in evaluated_images]
+    print(f"{len(evaluated_images)} examples already evaluated, {len(pending)} to go.")
+
+    loader = DataLoader(
+        pending,
+        batch_size=args.batch_size,
+        collate_fn=EvalCollator(processor),
+        num_workers=args.num_workers,
+        prefetch_factor=4 if args.num_workers > 0 else None,
+        pin_memory=torch.cuda.is_available(),
+    )
+
+    with open(results_path, "a") as f, tqdm(total=len(pending)) as progress:
+        for examples, inputs in loader:
+            inputs = {k: v.to(model.device, non_blocking=True) for k, v in inputs.items()}
+            with torch.no_grad():
+                generated_ids = model.generate(
+                    **inputs, max_new_tokens=args.max_new_tokens, do_sample=False
+                )
+            # left padding: every prompt ends at the same column
+            output_texts = processor.batch_decode(
+                generated_ids[:, inputs["input_ids"].shape[1] :],
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=False,
+            )
+            for example, output_text in zip(examples, output_texts):
+                f.write(
+                    json.dumps(
+                        {
+                            "image": example["image"],
+                            "prompt": example["conversations"][0]["value"],
+                            "model_output": output_text,
+                        }
+                    )
+                    + "\n"
+                )
+            f.flush()
+            progress.update(len(examples))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+PROMPT = """Task: Frozen Lake Shortest Path Planning
+
+You are given an image of a grid-based environment. In this environment:
+- An elf marks the starting position.
+- A gift represents the goal.
+- Some cells contain ice holes that are impassable for the elf.
+- The elf can move in one of four directions only: "up", "down", "left", or "right". Each move transitions the elf by one cell in the corresponding absolute direction. Diagonal movement is not permitted.
+
+Your task is to analyze the image and generate the shortest valid sequence of actions that moves the elf from the starting position to the goal without stepping into any ice holes.
+
+Do not include any explanation. Only provide your final answer enclosed between <ANSWER> and </ANSWER>, for example: <ANSWER>right up up</ANSWER>."""
+
+
+PROMPT_COT = """Task: Frozen Lake Shortest Path Planning
+
+You are given an image of a grid-based environment. In this environment:
+- An elf marks the starting position.
+- A gift represents the goal.
+- Some cells contain ice holes that are impassable for the elf.
+- The elf can move in one of four directions only: "up", "down", "left", or "right". Each move transitions the elf by one cell in the corresponding absolute direction. Diagonal movement is not permitted.
+
+Your task is to analyze the image and generate the shortest valid sequence of actions that moves the elf from the starting position to the goal without stepping into any ice holes.
+
+Let's think step by step. Provide your final answer enclosed between <ANSWER> and </ANSWER>, for example: <ANSWER>right up up</ANSWER>."""
+
+PROMPTS = {"direct": PROMPT, "cot": PROMPT_COT}
+
+
+def read_results(results_path: Path):
+    """Records already written to an append-only JSONL results file.
+
+    A last line without a newline, left by an interrupted run, is cut off the
+    file, so that sample is evaluated again. Other lines that do not decode
+    are reported and skipped. If the file does not exist yet, the records of
+    a `.json` array of the same name, as earlier versions wrote them, are
+    copied into it first.
+    """
+    results = []
+    legacy_path = results_path.with_suffix(".json")
+    if not results_path.exists() and results_path.suffix == ".jsonl" and legacy_path.exists():
+        with open(legacy_path, "r") as f:
+            legacy = json.load(f)
+        with open(results_path, "w") as f:
+            for record in legacy:
+                f.write(json.dumps(record) + "\n")
+        print(f"Imported {len(legacy)} results from {legacy_path}")
+    if not results_path.exists():
+        return results
+    end = 0
+    with open(results_path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                if line.strip():
+                    print(f"Skipping line {number} of {results_path}: {e}")
+    if end < results_path.stat().st_size:
+        os.truncate(results_path, end)
+    return results
+
+
+def read_examples(test_path):
+    """Test examples of a `.jsonl` file, as `dataset_frozenlake.py build` writes them, or a `.json` array."""
+    with open(test_path, "r") as f:
+        if str(test_path).endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+class Backend(object):
+    """One multimodal chat API. Subclasses implement `generate` and `is_retryable`."""
+
+    default_model = None
+
+    def __init__(self, model=None):
+        self.model = model or self.default_model
+
+    async def generate(self, prompt: str, image_path: str) -> str:
+        raise NotImplementedError
+
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, asyncio.TimeoutError)
+
+
+class OpenAIBackend(Backend):
+    default_model = "gpt-4o"
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        import openai
+
+        self.openai = openai
+        # retries are done by the driver, with the shared rate limit
+        self.client = openai.AsyncOpenAI(max_retries=0)
+
+    async def generate(self, prompt, image_path):
+        base64_image = await asyncio.to_thread(encode_image, image_path)
+        completion = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                        },
+                    ],
+                }
+            ],
+        )
+        return completion.choices[0].message.content
+
+    def is_retryable(self, error):
+        return super().is_retryable(error) or isinstance(
+            error,
+            (
+                self.openai.RateLimitError,
+                self.openai.APITimeoutError,
+                self.openai.APIConnectionError,
+                self.openai.InternalServerError,
+            ),
+        )
+
+
+class GeminiBackend(Backend):
+    default_model = "gemini-2.0-flash"
+
+    def __init__(self, model=None):
+        super().__init__(model)
+        from google import genai
+
+        self.errors = genai.errors
+        self.client = genai.Client()
+
+    async def generate(self, prompt, image_path):
+        image = await asyncio.to_thread(load_image, image_path)
+        response = await self.client.aio.models.generate_content(
+            model=self.model, contents=[prompt, image]
+        )
+        return response.text
+
+    def is_retryable(self, error):
+        return (
+            super().is_retryable(error)
+            or isinstance(error, self.errors.ServerError)
+            or (isinstance(error, self.errors.APIError) and error.code == 429)
+        )
+
+
+class MockError(Exception):
+    pass
+
+
+class MockBackend(Backend):
+    """Local stand-in for an API: random latency and transient failures, no network."""
+
+    default_model = "mock"
+
+    def __init__(self, model=None, latency=0.05, failure_rate=0.1, seed=0):
+        super().__init__(model)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+
+    async def generate(self, prompt, image_path):
+        await asyncio.to_thread(os.stat, image_path)
+        await asyncio.sleep(self.rng.expovariate(1 / self.latency))
+        if self.rng.random() < self.failure_rate:
+            raise MockError("503 service unavailable")
+        actions = self.rng.choices(["up", "down", "left", "right"], k=self.rng.randint(1, 6))
+        return f"<ANSWER>{' '.join(actions)}</ANSWER>"
+
+    def is_retryable(self, error):
+        return super().is_retryable(error) or isinstance(error, MockError)
+
+
+BACKENDS = {"openai": OpenAIBackend, "gemini": GeminiBackend, "mock": MockBackend}
+
+
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+def load_image(image_path):
+    from PIL import Image
+
+    image = Image.open(image_path)
+    image.load()
+    return image
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second on average and bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def evaluate(
+    backend: Backend,
+    examples,
+    prompt: str,
+    results_path: Path,
+    concurrency=8,
+    rate=5.0,
+    burst=None,
+    max_retries=6,
+    timeout=120.0,
+    backoff=1.0,
+):
+    """Query `backend` for every example not yet in `results_path`, appending each record as it completes.
+
+    Returns a dict of throughput and latency statistics.
+    """
+    evaluated_images = set(r["image"] for r in read_results(results_path))
+    pending = [example for example in examples if example["image"] not in evaluated_images]
+    print(f"{len(evaluated_images)} examples already evaluated, {len(pending)} to go.")
+
+    bucket = TokenBucket(rate, burst or max(1.0, rate))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    stats = dict(retries=0, failed=0)
+    progress = tqdm(total=len(pending))
+
+    async def query(example):
+        for attempt in range(max_retries + 1):
+            await bucket.acquire()
+            start = time.perf_counter()
+            try:
+                output_text = await asyncio.wait_for(
+                    backend.generate(prompt, example["image"]), timeout
+                )
+            except Exception as e:
+                if attempt == max_retries or not backend.is_retryable(e):
+                    print(f"Failed to evaluate {example['image']}: {e!r}")
+                    stats["failed"] += 1
+                    return None
+                stats["retries"] += 1
+                # exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, backoff * 2**attempt))
+                continue
+            latencies.append(time.perf_counter() - start)
+            return {
+                "image": example["image"],
+                "prompt": example["conversations"][0]["value"],
+                "model_output": output_text,
+            }
+
+    async def worker(example, f):
+        async with semaphore:
+            record = await query(example)
+        progress.update(1)
+        # only the event loop thread writes, so appending needs no lock
+        if record is not None:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+
+    start = time.perf_counter()
+    with open(results_path, "a") as f:
+        await asyncio.gather(*(worker(example, f) for example in pending))
+    elapsed = time.perf_counter() - start
+    progress.close()
+
+    stats.update(
+        completed=len(latencies),
+        elapsed=elapsed,
+        throughput=len(latencies) / elapsed if elapsed > 0 else 0.0,
+    )
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        stats.update(latency_p50=p50, latency_p90=p90, latency_p99=p99)
+    return stats
+
+
+def main(backend="openai", output=None, prompt="direct", limit=None):
+    parser = argparse.ArgumentParser(description="Concurrent FrozenLake evaluation of a hosted multimodal model.")
+    parser.add_argument("--backend", type=str, default=backend, choices=sorted(BACKENDS))
+    parser.add_argument("--model", type=str, default=None, help="Model name, defaults to the backend's")
+    parser.add_argument("--test_file", type=str, default="frozenlake/test.json")
+    parser.add_argument("--output", type=str, default=output, help="Append-only JSONL results file")
+    parser.add_argument("--prompt", type=str, default=prompt, choices=sorted(PROMPTS))
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    parser.add_argument("--rate", type=float, default=5.0, help="Requests per second")
+    parser.add_argument("--burst", type=float, default=None, help="Token bucket size, defaults to --rate")
+    parser.add_argument("--max_retries", type=int, default=6)
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds per request")
+    parser.add_argument(
+        "--limit", type=int, default=limit, help="Only evaluate the first N test examples, 0 for all of them"
+    )
+    args = parser.parse_args()
+
+    data = read_examples(args.test_file)
+    if args.limit:
+        data = data[: args.limit]
+    output = args.output or f"frozenlake/eval_results_{args.backend}_{args.prompt}.jsonl"
+
+    stats = asyncio.run(
+        evaluate(
+            BACKENDS[args.backend](args.model),
+            data,
+            PROMPTS[args.prompt],
+            Path(output),
+            concurrency=args.concurrency,
+            rate=args.rate,
+            burst=args.burst,
+            max_retries=args.max_retries,
+            timeout=args.timeout,
+        )
+    )
+    print(
+        f"{stats['completed']} completed, {stats['failed']} failed, {stats['retries']} retries "
+        f"in {stats['elapsed']:.1f}s ({stats['throughput']:.2f} requests/sec)"
+    )
+    if stats["completed"]:
+        print(
+            f"latency p50 {stats['latency_p50']:.2f}s, p90 {stats['latency_p90']:.2f}s, "
+            f"p99 {stats['latency_p99']:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
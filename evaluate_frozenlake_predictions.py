@@ -1,145 +1,173 @@
 import os
+import re
 import json
 import argparse
 from pathlib import Path
 
-def get_coordinate_from_state(state, level):
-    assert state < level*level, "state must be less than level*level"
-    row = state // level
-    col = state % level
-    return (row, col)
-
-def get_state_from_coordinate(coordinate, level):
-    return coordinate[0] * level + coordinate[1]
-
-def apply_action_sequence(start_coord, actions, level, target_pos, distance_dict):
-    """Apply action sequence and return path with validity of each move."""
-
-    move_delta = {
-        "up": (-1, 0),
-        "down": (1, 0),
-        "left": (0, -1),
-        "right": (0, 1),
-    }
-
-    actions = [a.strip().lower() for a in actions]
-
-    path = []
-    current_coord = start_coord
-    for action in actions:
-        if action not in move_delta:
-            path.append({"coord": current_coord, "valid": False})
+import numpy as np
+
+# first <ANSWER> up to the next </ANSWER>, or to the end of the text
+ANSWER_PATTERN = re.compile(r"<ANSWER>(.*?)(?:</ANSWER>|\Z)", re.S)
+
+MOVES = {"up": 0, "down": 1, "left": 2, "right": 3}
+INVALID_MOVE = len(MOVES)
+MOVE_DELTA = np.array([(-1, 0), (1, 0), (0, -1), (0, 1)], dtype=np.int64)
+
+TEST_IDS = range(1000, 1250)
+
+
+def image_key(image_path):
+    """`levelN/<id>` of an image path, so predictions match whatever root they were made under."""
+    parts = str(image_path).replace("\\", "/").rsplit("/", 3)
+    return f"{parts[-3]}/{parts[-2]}"
+
+
+class FrozenLakeMaps(object):
+    """All test maps of all levels as flat numpy arrays, one row per map.
+
+    `passable[row, state]` is True for cells the elf may enter, i.e. cells of
+    the distance map and the target; `distance` is the optimal path length.
+    """
+
+    def __init__(self, root_dir, ids=TEST_IDS):
+        level_names = sorted(
+            name for name in os.listdir(root_dir) if (Path(root_dir) / name).is_dir()
+        )
+        max_cells = max(int(name[len("level") :]) for name in level_names) ** 2
+        self.level_names = level_names
+        self.index = {}
+        level_ids, sizes, starts, targets, distances, passable = [], [], [], [], [], []
+        for level_id, level_name in enumerate(level_names):
+            size = int(level_name[len("level") :])
+            with open(Path(root_dir) / level_name / "data_distance_map.json", "r") as f:
+                data_map = json.load(f)
+            for i in ids:
+                entry = data_map[str(i)]
+                distance_map = entry["distance_map"]
+                start, target = int(entry["start_pos"]), int(entry["target_pos"])
+                assert str(start) in distance_map
+                cells = np.zeros(max_cells, dtype=bool)
+                cells[[int(state) for state in distance_map]] = True
+                cells[target] = True
+                self.index[f"{level_name}/{i}"] = len(sizes)
+                level_ids.append(level_id)
+                sizes.append(size)
+                starts.append(start)
+                targets.append(target)
+                distances.append(distance_map[str(start)])
+                passable.append(cells)
+        self.level_id = np.array(level_ids, dtype=np.int64)
+        self.size = np.array(sizes, dtype=np.int64)
+        self.start = np.array(starts, dtype=np.int64)
+        self.target = np.array(targets, dtype=np.int64)
+        self.distance = np.array(distances, dtype=np.int64)
+        self.passable = np.stack(passable)
+
+    def __len__(self):
+        return len(self.size)
+
+
+def parse_actions(texts, max_length):
+    """Encode the `<ANSWER>` action list of every text as move codes.
+
+    Returns `(codes, lengths)`; `codes` is `(len(texts), max_length)` and only
+    holds answers of at most `max_length` actions, since longer ones cannot be
+    optimal. Texts without both tags get length 0.
+    """
+    codes = np.full((len(texts), max_length), INVALID_MOVE, dtype=np.int8)
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for n, text in enumerate(texts):
+        if "</ANSWER>" not in text:
             continue
+        match = ANSWER_PATTERN.search(text)
+        if match is None:
+            continue
+        actions = match.group(1).split()
+        lengths[n] = len(actions)
+        if len(actions) <= max_length:
+            codes[n, : len(actions)] = [
+                MOVES.get(a.strip().lower(), INVALID_MOVE) for a in actions
+            ]
+    return codes, lengths
+
+
+def score(maps, rows, codes, lengths):
+    """Whether each predicted action list is a valid shortest path, simulated for all at once."""
+    size = maps.size[rows]
+    row, col = np.divmod(maps.start[rows], size)
+    valid = (lengths == maps.distance[rows]) & (lengths > 0)
+    for t in range(codes.shape[1]):
+        move = codes[:, t].astype(np.int64)
+        active = valid & (t < lengths)
+        legal = move < INVALID_MOVE
+        delta = MOVE_DELTA[np.minimum(move, INVALID_MOVE - 1)]
+        next_row, next_col = row + delta[:, 0], col + delta[:, 1]
+        in_bounds = (next_row >= 0) & (next_row < size) & (next_col >= 0) & (next_col < size)
+        state = np.where(in_bounds, next_row * size + next_col, 0)
+        ok = legal & in_bounds & maps.passable[rows, state]
+        valid &= ~active | ok
+        row = np.where(active, next_row, row)
+        col = np.where(active, next_col, col)
+    return valid & (row * size + col == maps.target[rows])
+
+
+def read_predictions(eval_file):
+    with open(eval_file, "r") as f:
+        if str(eval_file).endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def evaluate(maps, eval_results):
+    """Per level `(accuracy, correct, total, missing)` over all test maps."""
+    # a later record for the same image (e.g. a rerun) wins
+    predictions = {}
+    for entry in eval_results:
+        row = maps.index.get(image_key(entry["image"]))
+        if row is not None:
+            predictions[row] = entry["model_output"] or ""
+    rows = np.fromiter(predictions.keys(), dtype=np.int64, count=len(predictions))
+    codes, lengths = parse_actions(list(predictions.values()), int(maps.distance.max()))
+    correct = np.zeros(len(maps), dtype=bool)
+    correct[rows] = score(maps, rows, codes, lengths)
+    answered = np.zeros(len(maps), dtype=bool)
+    answered[rows] = True
 
-        dr, dc = move_delta[action]
-        next_coord = (current_coord[0] + dr, current_coord[1] + dc)
-
-        # Check if the move is within bounds
-        if 0 <= next_coord[0] < level and 0 <= next_coord[1] < level:
-            next_state = str(get_state_from_coordinate(next_coord, level))
-
-            if next_state in distance_dict or next_state == target_pos:
-                valid = True
-                current_coord = next_coord
-            else:
-                valid = False
-        else:
-            valid = False
-
-        path.append({"coord": next_coord, "valid": valid})
+    level_accuracy = {}
+    for level_id, level_name in enumerate(maps.level_names):
+        in_level = maps.level_id == level_id
+        level_correct = int(correct[in_level].sum())
+        level_total = int(in_level.sum())
+        level_accuracy[level_name] = (
+            level_correct / level_total if level_total > 0 else 0,
+            level_correct,
+            level_total,
+            int((in_level & ~answered).sum()),
+        )
+    return level_accuracy
 
-    return path
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate GPT model output on FrozenLake task.")
     parser.add_argument("--prefix", type=str, default="frozenlake", help="Directory prefix where the eval file is stored (default: frozenlake)")
-    parser.add_argument("--name", type=str, required=True, help="Filename of the evaluation result (with or without .json)")
+    parser.add_argument("--name", type=str, nargs="+", required=True, help="Filename(s) of the evaluation result (.json, .jsonl, or without extension for .json)")
     args = parser.parse_args()
 
-    # Ensure .json extension is added if not present
-    eval_filename = args.name if args.name.endswith(".json") else args.name + ".json"
-    eval_file = Path(args.prefix) / eval_filename
-
     root_dir = Path("frozenlake/optimal_with_distance")
+    maps = FrozenLakeMaps(root_dir)
 
-    # Load model predictions
-    with open(eval_file, "r") as f:
-        eval_results = json.load(f)
-
-    correct = 0
-    total = 0
-    level_accuracy = {}
-
-    level_to_offset = {
-        "level3": 0,
-        "level4": 250,
-        "level5": 500,
-        "level6": 750,
-    }
-
-    for level_name in sorted(os.listdir(root_dir)):
-        level = int(level_name[-1])  # level3 -> 3, etc.
-        level_path = root_dir / level_name
-        if not level_path.is_dir():
-            continue
-
-        print(f"Evaluating {level_name}...")
-
-        data_path = level_path / "data_distance_map.json"
-        with open(data_path, "r") as f:
-            data_map = json.load(f)
-
-        offset = level_to_offset[level_name]
-        level_correct = 0
-        level_total = 0
-
-        for i in range(1000, 1250):
-            subfolder = str(i)
-            assert subfolder in data_map
-
-            distance_dict = data_map[subfolder]["distance_map"]
-            start_pos = str(data_map[subfolder]["start_pos"])
-            target_pos = str(data_map[subfolder]["target_pos"])
-
-            start_coordinate = get_coordinate_from_state(int(start_pos), level)
-            assert start_pos in distance_dict
-            true_distance = distance_dict[start_pos]
-
-            prediction_entry = eval_results[offset + (i - 1000)]
-            pred_text = prediction_entry["model_output"]
-
-            if "<ANSWER>" in pred_text and "</ANSWER>" in pred_text:
-                answer = pred_text.split("<ANSWER>")[1].split("</ANSWER>")[0].strip()
-                pred_actions = answer.split()
-            else:
-                pred_actions = []
-
-            path = apply_action_sequence(start_coordinate, pred_actions, level, target_pos, distance_dict)
-            all_valid = all(step["valid"] for step in path)
-
-            if all_valid:
-                path_length_matches = len(path) == true_distance
-                final_coord = path[-1]["coord"]
-                final_state = get_state_from_coordinate(final_coord, level)
-                target_state = int(data_map[subfolder]["target_pos"])
-                ends_correctly = final_state == target_state
-
-                if path_length_matches and ends_correctly:
-                    print(f"Correct: {level_name} {subfolder} -> {pred_actions} (length: {len(path)}, true_distance: {true_distance}), correct {level_correct+1}")
-                    correct += 1
-                    level_correct += 1
-            total += 1
-            level_total += 1
+    for name in args.name:
+        # Ensure .json extension is added if not present
+        eval_filename = name if name.endswith((".json", ".jsonl")) else name + ".json"
+        eval_file = Path(args.prefix) / eval_filename
+        level_accuracy = evaluate(maps, read_predictions(eval_file))
 
-        level_acc = level_correct / level_total if level_total > 0 else 0
-        level_accuracy[level_name] = (level_acc, level_correct, level_total)
-        print(f"{level_name} Accuracy: {level_acc:.4f} ({level_correct}/{level_total})")
+        print(f"\n==== {eval_file} ====")
+        for level_name, (acc, corr, tot, missing) in level_accuracy.items():
+            print(f"{level_name:<7}: {acc*100:.4f} ({corr}/{tot})" + (f", {missing} missing" if missing else ""))
+        avg_acc = sum(acc for acc, _, _, _ in level_accuracy.values()) / len(level_accuracy)
+        print(f"{'Average':<7}: {avg_acc*100:.4f}")
 
-    avg_acc = sum(acc for acc, _, _ in level_accuracy.values()) / len(level_accuracy)
-    print("\n==== Final Summary ====")
-    for level_name, (acc, corr, tot) in level_accuracy.items():
-        print(f"{level_name:<7}: {acc*100:.4f} ({corr}/{tot})")
-    print(f"{'Average':<7}: {avg_acc*100:.4f}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
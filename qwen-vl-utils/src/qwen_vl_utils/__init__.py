@@ -1,7 +1,10 @@
+from .media_cache import MediaCache, get_media_cache, media_cache_stats
 from .vision_process import (
     extract_vision_info,
     fetch_image,
     fetch_video,
     process_vision_info,
+    process_vision_info_async,
+    process_vision_info_batch,
     smart_resize,
 )
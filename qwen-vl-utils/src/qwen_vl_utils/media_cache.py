@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from typing import Optional
+
+import numpy as np
+import requests
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+# In-memory tier per process, in MB, disabled unless a size is given.
+MEDIA_CACHE_MEMORY_MB = float(os.environ.get("QWENVL_MEDIA_CACHE_MB", 0))
+# On-disk tier, disabled unless a directory is given.
+MEDIA_CACHE_DIR = os.environ.get("QWENVL_MEDIA_CACHE_DIR", None)
+MEDIA_CACHE_DISK_GB = float(os.environ.get("QWENVL_MEDIA_CACHE_DISK_GB", 16))
+
+
+def sha256_hex(data: str | bytes) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def source_key(image: str) -> Optional[str]:
+    """Key of the content behind an image string: the URL, the payload hash, or the file version."""
+    if image.startswith("http://") or image.startswith("https://"):
+        return f"url:{image}"
+    if image.startswith("data:image"):
+        if "base64," not in image:
+            return None
+        return f"data:{sha256_hex(image.split('base64,', 1)[1])}"
+    path = image[7:] if image.startswith("file://") else image
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"file:{os.path.abspath(path)}:{stat.st_size}-{stat.st_mtime_ns}"
+
+
+class _MemoryTier(object):
+    """LRU of bytes and images, evicting the least recently used entries past `max_bytes`."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._entries.popitem(last=False)
+                self.nbytes -= size
+
+
+class MediaCache(object):
+    """Two-tier cache of downloaded media bytes and decoded, resized images.
+
+    The memory tier is an LRU bounded by `memory_bytes`. The disk tier under
+    `cache_dir` keeps downloads keyed by URL together with their ETag, and
+    decoded images keyed by the hash of their source (URL, base64 payload or
+    local file version) plus the resize settings. A disk hit for a URL that
+    had an ETag is revalidated with a conditional request; without an ETag
+    the cached download is trusted. Files are published with an atomic
+    rename, so processes can share `cache_dir`, and the least recently used
+    files are deleted once it exceeds `disk_bytes`.
+    """
+
+    def __init__(self, memory_bytes: int, cache_dir: Optional[str] = None, disk_bytes: int = 0):
+        self.memory = _MemoryTier(memory_bytes) if memory_bytes > 0 else None
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._written = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _count(self, kind: str, name: str):
+        """Count a lookup of downloaded `"bytes"` or resized `"images"`, so each gets its own hit rate."""
+        with self._counts_lock:
+            self.counts[kind, name] += 1
+
+    def _disk_path(self, kind: str, key: str, suffix: str = "") -> str:
+        digest = sha256_hex(key)
+        return os.path.join(self.cache_dir, kind, digest[:2], f"{digest}{suffix}")
+
+    def _publish(self, path: str, data: bytes) -> bool:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # full disk or read-only cache: fetching goes on uncached
+            logger.warning(f"media cache: could not write {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self._written += len(data)
+        if self._written > self.disk_bytes // 16:
+            self._written = 0
+            self.evict()
+        return True
+
+    def _download(self, url: str, session: requests.Session, timeout: float) -> tuple[Optional[str], Optional[bytes]]:
+        """`(path, content)` of `url`, revalidating or refreshing its disk copy.
+
+        `content` is set when the body was downloaded, `path` is None when it could not be stored.
+        """
+        path = self._disk_path("bytes", f"url:{url}")
+        meta_path = f"{path}.json"
+        headers = {}
+        try:
+            with open(meta_path, "r") as f:
+                etag = json.load(f).get("etag")
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            if etag is None:
+                self._count("bytes", "disk_hits")
+                os.utime(path)
+                return path, None
+            headers["If-None-Match"] = etag
+        except (OSError, ValueError):
+            pass
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            self._count("bytes", "disk_hits")
+            self._count("bytes", "disk_revalidated")
+            os.utime(path)
+            return path, None
+        response.raise_for_status()
+        self._count("bytes", "disk_misses")
+        meta = json.dumps({"url": url, "etag": response.headers.get("ETag")}).encode()
+        if not (self._publish(path, response.content) and self._publish(meta_path, meta)):
+            return None, response.content
+        return path, response.content
+
+    def fetch_url(self, url: str, session: requests.Session, timeout: float) -> bytes:
+        """Bytes of `url`, from memory, then disk, then the network."""
+        key = f"url:{url}"
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                self._count("bytes", "memory_hits")
+                return data
+            self._count("bytes", "memory_misses")
+        data = None
+        if self.cache_dir is not None:
+            path, data = self._download(url, session, timeout)
+            if data is None:
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except OSError:
+                    # evicted by another process sharing cache_dir since the hit
+                    pass
+        if data is None:
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+            data = response.content
+        if self.memory is not None:
+            self.memory.put(key, data, len(data))
+        return data
+
+    def video_path(self, url: str, session: requests.Session, timeout: float) -> str:
+        """Local copy of a video URL for the video readers, or the URL itself without a disk tier."""
+        if self.cache_dir is None:
+            return url
+        path, _ = self._download(url, session, timeout)
+        return path or url
+
+    def get_image(self, key: str) -> Optional[Image.Image]:
+        """A copy of the cached image, so callers may modify it."""
+        if self.memory is not None:
+            image = self.memory.get(key)
+            if image is not None:
+                self._count("images", "memory_hits")
+                return image.copy()
+            self._count("images", "memory_misses")
+        if self.cache_dir is not None:
+            path = self._disk_path("images", key, ".npy")
+            try:
+                image = Image.fromarray(np.load(path))
+                os.utime(path)
+            except (OSError, ValueError):
+                self._count("images", "disk_misses")
+                return None
+            self._count("images", "disk_hits")
+            if self.memory is not None:
+                self.memory.put(key, image, _image_nbytes(image))
+            return image.copy()
+        return None
+
+    def put_image(self, key: str, image: Image.Image):
+        if self.memory is not None:
+            self.memory.put(key, image.copy(), _image_nbytes(image))
+        if self.cache_dir is not None:
+            buffer = BytesIO()
+            np.save(buffer, np.asarray(image))
+            self._publish(self._disk_path("images", key, ".npy"), buffer.getvalue())
+
+    def evict(self):
+        """Delete least recently used files until the disk tier is under 90% of `disk_bytes`."""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith((".tmp", ".json")):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in files)
+        if total <= self.disk_bytes:
+            return
+        for _, size, path in sorted(files):
+            for stale in (path, f"{path}.json"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            if total <= self.disk_bytes * 0.9:
+                break
+
+    def stats(self) -> dict:
+        """Hits, misses and hit rate of each tier since the process started.
+
+        Lookups of downloaded bytes and of resized images are counted apart,
+        since an image miss goes on to look up the bytes of its URL.
+        """
+        stats = {}
+        for kind in ("bytes", "images"):
+            stats[kind] = {}
+            for tier in ("memory", "disk"):
+                hits, misses = self.counts[kind, f"{tier}_hits"], self.counts[kind, f"{tier}_misses"]
+                stats[kind][tier] = dict(
+                    hits=hits,
+                    misses=misses,
+                    hit_rate=hits / (hits + misses) if hits + misses else 0.0,
+                )
+        stats["bytes"]["disk"]["revalidated"] = self.counts["bytes", "disk_revalidated"]
+        if self.memory is not None:
+            stats["memory"] = dict(nbytes=self.memory.nbytes, max_bytes=self.memory.max_bytes)
+        return stats
+
+
+def _image_nbytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+@lru_cache(maxsize=1)
+def get_media_cache() -> MediaCache:
+    return MediaCache(
+        int(MEDIA_CACHE_MEMORY_MB * 1024**2),
+        MEDIA_CACHE_DIR,
+        int(MEDIA_CACHE_DISK_GB * 1024**3),
+    )
+
+
+def media_cache_stats() -> dict:
+    return get_media_cache().stats()
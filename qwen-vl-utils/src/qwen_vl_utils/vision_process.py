@@ -1,23 +1,28 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import logging
 import math
 import os
 import sys
+import threading
 import time
-import warnings
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
 from functools import lru_cache
 from io import BytesIO
+from typing import Optional
 
+import numpy as np
+import PIL
 import requests
 import torch
-import torchvision
-from packaging import version
 from PIL import Image
-from torchvision import io, transforms
+from requests.adapters import HTTPAdapter
+from torchvision import transforms
 from torchvision.transforms import InterpolationMode
-from typing import Optional
+
+from .media_cache import get_media_cache, source_key
 
 
 logger = logging.getLogger(__name__)
@@ -40,6 +45,51 @@ FPS_MAX_FRAMES = 768
 VIDEO_TOTAL_PIXELS = int(float(os.environ.get('VIDEO_MAX_PIXELS', 128000 * 28 * 28 * 0.9)))
 logger.info(f"set VIDEO_TOTAL_PIXELS: {VIDEO_TOTAL_PIXELS}")
 
+# Timeout in seconds of each HTTP request for media, and threads fetching media concurrently.
+HTTP_TIMEOUT = float(os.environ.get("QWENVL_HTTP_TIMEOUT", 30))
+FETCH_WORKERS = int(os.environ.get("QWENVL_FETCH_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+
+# Decode JPEGs at a reduced DCT scale when they are downsized by 2x or more; set to 0 for full decoding.
+IMAGE_DRAFT_DECODE = os.environ.get("QWENVL_IMAGE_DRAFT_DECODE", "1") != "0"
+
+_http_session = None
+_fetch_executor = None
+_pool_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Session shared by all media downloads, keeping up to FETCH_WORKERS connections per host alive."""
+    global _http_session
+    with _pool_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS, max_retries=3)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def get_fetch_executor() -> ThreadPoolExecutor:
+    global _fetch_executor
+    with _pool_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix="qwen-vl-fetch")
+        return _fetch_executor
+
+
+def _reset_pools_after_fork():
+    # a forked child (e.g. a dataloader worker) has none of the parent's pool threads
+    # and must not share its sockets, so it creates its own pools on first use
+    global _http_session, _fetch_executor, _pool_lock
+    _http_session = None
+    _fetch_executor = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
 
 def round_by_factor(number: int, factor: int) -> int:
     """Returns the closest integer to 'number' that is divisible by 'factor'."""
@@ -85,8 +135,18 @@ def smart_resize(
     return h_bar, w_bar
 
 
+@lru_cache(maxsize=1)
+def get_image_decode_backend() -> str:
+    """`pillow-simd` when that drop-in build of Pillow is installed, which speeds up `resize`, else `pillow`."""
+    image_decode_backend = "pillow-simd" if ".post" in PIL.__version__ else "pillow"
+    logger.info(f"qwen-vl-utils using {image_decode_backend} {PIL.__version__} to decode images.")
+    return image_decode_backend
+
+
 def to_rgb(pil_image: Image.Image) -> Image.Image:
-      if pil_image.mode == 'RGBA':
+      if pil_image.mode == 'RGB':
+          return pil_image
+      elif pil_image.mode == 'RGBA':
           white_background = Image.new("RGB", pil_image.size, (255, 255, 255))
           white_background.paste(pil_image, mask=pil_image.split()[3])  # Use alpha channel as mask
           return white_background
@@ -94,17 +154,49 @@ def to_rgb(pil_image: Image.Image) -> Image.Image:
           return pil_image.convert("RGB")
 
 
+def image_cache_key(image: str, ele: dict, size_factor: int) -> Optional[str]:
+    """Media cache key of the resized image `fetch_image` returns, or None if the source has no stable key."""
+    key = source_key(image)
+    if key is None:
+        return None
+    if "resized_height" in ele and "resized_width" in ele:
+        size = f"resized={ele['resized_height']}x{ele['resized_width']}"
+    else:
+        size = f"pixels={ele.get('min_pixels', MIN_PIXELS)}-{ele.get('max_pixels', MAX_PIXELS)}"
+    decode = "draft" if IMAGE_DRAFT_DECODE else "full"
+    return f"{key}|factor={size_factor}|{size}|decode={decode}"
+
+
 def fetch_image(ele: dict[str, str | Image.Image], size_factor: int = IMAGE_FACTOR) -> Image.Image:
+    """Load an image and resize it to its `smart_resize` size.
+
+    The target size is computed from the header before any pixel is decoded.
+    With IMAGE_DRAFT_DECODE, a JPEG at least twice the target size in both
+    dimensions is decoded at the largest 1/2, 1/4 or 1/8 DCT scale that stays
+    above the target (PIL draft mode), converting to RGB in the decoder, and
+    then resized once. On natural photos the result differs from full
+    decoding by about one uint8 level on average (see README); other
+    formats, smaller downsizing and PIL.Image inputs are decoded as before.
+    """
+    get_image_decode_backend()
     if "image" in ele:
         image = ele["image"]
     else:
         image = ele["image_url"]
+    media_cache = get_media_cache()
+    cache_key = None
+    if not isinstance(image, Image.Image):
+        cache_key = image_cache_key(image, ele, size_factor)
+        if cache_key is not None:
+            cached = media_cache.get_image(cache_key)
+            if cached is not None:
+                return cached
     image_obj = None
     if isinstance(image, Image.Image):
         image_obj = image
     elif image.startswith("http://") or image.startswith("https://"):
-        response = requests.get(image, stream=True)
-        image_obj = Image.open(BytesIO(response.content))
+        data = media_cache.fetch_url(image, get_http_session(), HTTP_TIMEOUT)
+        image_obj = Image.open(BytesIO(data))
     elif image.startswith("file://"):
         image_obj = Image.open(image[7:])
     elif image.startswith("data:image"):
@@ -116,8 +208,7 @@ def fetch_image(ele: dict[str, str | Image.Image], size_factor: int = IMAGE_FACT
         image_obj = Image.open(image)
     if image_obj is None:
         raise ValueError(f"Unrecognized image input, support local path, http url, base64 and PIL.Image, got {image}")
-    image = to_rgb(image_obj)
-    ## resize
+    ## resize, sized from the header
     if "resized_height" in ele and "resized_width" in ele:
         resized_height, resized_width = smart_resize(
             ele["resized_height"],
@@ -125,7 +216,7 @@ def fetch_image(ele: dict[str, str | Image.Image], size_factor: int = IMAGE_FACT
             factor=size_factor,
         )
     else:
-        width, height = image.size
+        width, height = image_obj.size
         min_pixels = ele.get("min_pixels", MIN_PIXELS)
         max_pixels = ele.get("max_pixels", MAX_PIXELS)
         resized_height, resized_width = smart_resize(
@@ -135,8 +226,12 @@ def fetch_image(ele: dict[str, str | Image.Image], size_factor: int = IMAGE_FACT
             min_pixels=min_pixels,
             max_pixels=max_pixels,
         )
+    if IMAGE_DRAFT_DECODE and not isinstance(image, Image.Image) and image_obj.format == "JPEG":
+        image_obj.draft("RGB", (resized_width, resized_height))
+    image = to_rgb(image_obj)
     image = image.resize((resized_width, resized_height))
-
+    if cache_key is not None:
+        media_cache.put_image(cache_key, image)
     return image
 
 
@@ -180,10 +275,96 @@ def smart_nframes(
     return nframes
 
 
+def segment_frame_range(timestamps: np.ndarray, ele: dict) -> tuple[int, int]:
+    """First and last index of the frames whose timestamps (seconds, sorted) lie in [video_start, video_end]."""
+    start, end = 0, len(timestamps) - 1
+    if ele.get("video_start") is not None:
+        start = int(np.searchsorted(timestamps, ele["video_start"] - 1e-6, side="left"))
+    if ele.get("video_end") is not None:
+        end = int(np.searchsorted(timestamps, ele["video_end"] + 1e-6, side="right")) - 1
+    if end < start:
+        raise ValueError(
+            f"no frame between video_start {ele.get('video_start')} and video_end {ele.get('video_end')}, "
+            f"the video spans [{timestamps[0]:.3f}, {timestamps[-1]:.3f}] seconds"
+        )
+    return start, end
+
+
+def sample_frame_indices(ele: dict, timestamps: np.ndarray, video_fps: float) -> tuple[np.ndarray, float]:
+    """Indices of the `smart_nframes` frames sampled evenly from the segment, and the sampled fps."""
+    start, end = segment_frame_range(timestamps, ele)
+    total_frames = end - start + 1
+    nframes = smart_nframes(ele, total_frames=total_frames, video_fps=video_fps)
+    idx = start + torch.linspace(0, total_frames - 1, nframes).round().long().numpy()
+    sample_fps = nframes / max(total_frames, 1e-6) * video_fps
+    return idx, sample_fps
+
+
+def _iter_frames_pyav(container, stream, targets: np.ndarray, keyframes: np.ndarray):
+    """Yield the `(H, W, 3)` frames with presentation timestamps `targets` (sorted), in order.
+
+    Decoding starts from the last keyframe before each target and moves on by
+    seeking whenever the next target lies past a later keyframe, so only the
+    GOPs holding sampled frames are decoded and only sampled frames are kept.
+    """
+    i = 0
+    while i < len(targets):
+        seek_to = keyframes[max(np.searchsorted(keyframes, targets[i], side="right") - 1, 0)]
+        container.seek(int(seek_to), stream=stream, backward=True, any_frame=False)
+        progress = i
+        for frame in container.decode(stream):
+            if frame.pts is None or frame.pts < targets[i]:
+                continue
+            array = frame.to_ndarray(format="rgb24")
+            # a target missing from the stream takes the next decoded frame
+            while i < len(targets) and targets[i] <= frame.pts:
+                yield array
+                i += 1
+            if i == len(targets):
+                break
+            next_keyframe = keyframes[np.searchsorted(keyframes, targets[i], side="right") - 1]
+            if next_keyframe > frame.pts:
+                break
+        if i == progress:
+            raise ValueError(f"could not decode the frame at pts {targets[i]}")
+
+
+def _decode_frames_pyav(container, stream, targets: np.ndarray, keyframes: np.ndarray) -> np.ndarray:
+    """All frames of `_iter_frames_pyav` in one preallocated `(T, H, W, 3)` array."""
+    frames = None
+    for i, array in enumerate(_iter_frames_pyav(container, stream, targets, keyframes)):
+        if frames is None:
+            frames = np.empty((len(targets), *array.shape), dtype=np.uint8)
+        frames[i] = array
+    return frames
+
+
+def _index_video_pyav(container, ele: dict):
+    """`(stream, pts, keyframes, total_frames, video_fps, idx, sample_fps)`, reading packet headers only."""
+    stream = container.streams.video[0]
+    stream.thread_type = "AUTO"
+    packets = sorted((packet.pts, packet.is_keyframe) for packet in container.demux(stream) if packet.pts is not None)
+    pts = np.array([packet[0] for packet in packets], dtype=np.int64)
+    keyframes = pts[np.array([packet[1] for packet in packets], dtype=bool)]
+    if len(keyframes) == 0 or keyframes[0] > pts[0]:
+        keyframes = np.concatenate(([pts[0]], keyframes))
+    timestamps = (pts - (stream.start_time or 0)) * float(stream.time_base)
+    if stream.average_rate:
+        video_fps = float(stream.average_rate)
+    else:
+        video_fps = len(pts) / max(timestamps[-1] - timestamps[0], 1e-6)
+    idx, sample_fps = sample_frame_indices(ele, timestamps, video_fps)
+    return stream, pts, keyframes, len(pts), video_fps, idx, sample_fps
+
+
 def _read_video_torchvision(
     ele: dict,
 ) -> (torch.Tensor, float):
-    """read video using torchvision.io.read_video
+    """read video with PyAV, the decoder behind torchvision.io.read_video
+
+    Only the packet headers are read to index the frames; then just the
+    sampled frames are decoded, seeking from keyframe to keyframe, so memory
+    grows with the number of sampled frames rather than the video length.
 
     Args:
         ele (dict): a dict contains the configuration of video.
@@ -194,26 +375,17 @@ def _read_video_torchvision(
     Returns:
         torch.Tensor: the video tensor with shape (T, C, H, W).
     """
+    import av
+
     video_path = ele["video"]
-    if version.parse(torchvision.__version__) < version.parse("0.19.0"):
-        if "http://" in video_path or "https://" in video_path:
-            warnings.warn("torchvision < 0.19.0 does not support http/https video path, please upgrade to 0.19.0.")
-        if "file://" in video_path:
-            video_path = video_path[7:]
+    if video_path.startswith("file://"):
+        video_path = video_path[7:]
     st = time.time()
-    video, audio, info = io.read_video(
-        video_path,
-        start_pts=ele.get("video_start", 0.0),
-        end_pts=ele.get("video_end", None),
-        pts_unit="sec",
-        output_format="TCHW",
-    )
-    total_frames, video_fps = video.size(0), info["video_fps"]
-    logger.info(f"torchvision:  {video_path=}, {total_frames=}, {video_fps=}, time={time.time() - st:.3f}s")
-    nframes = smart_nframes(ele, total_frames=total_frames, video_fps=video_fps)
-    idx = torch.linspace(0, total_frames - 1, nframes).round().long()
-    sample_fps = nframes / max(total_frames, 1e-6) * video_fps
-    video = video[idx]
+    with av.open(video_path) as container:
+        stream, pts, keyframes, total_frames, video_fps, idx, sample_fps = _index_video_pyav(container, ele)
+        video = _decode_frames_pyav(container, stream, pts[idx], keyframes)
+    logger.info(f"pyav:  {video_path=}, {total_frames=}, {video_fps=}, time={time.time() - st:.3f}s")
+    video = torch.from_numpy(video).permute(0, 3, 1, 2)  # Convert to TCHW format
     return video, sample_fps
 
 
@@ -228,6 +400,9 @@ def _read_video_decord(
 ) -> (torch.Tensor, float):
     """read video using decord.VideoReader
 
+    `get_batch` seeks to the keyframe before each sampled frame and decodes
+    only what it needs; segments are cut on the frame timestamps.
+
     Args:
         ele (dict): a dict contains the configuration of video.
         support keys:
@@ -241,25 +416,74 @@ def _read_video_decord(
     video_path = ele["video"]
     st = time.time()
     vr = decord.VideoReader(video_path)
-    # TODO: support start_pts and end_pts
-    if 'video_start' in ele or 'video_end' in ele:
-        raise NotImplementedError("not support start_pts and end_pts in decord for now.")
     total_frames, video_fps = len(vr), vr.get_avg_fps()
     logger.info(f"decord:  {video_path=}, {total_frames=}, {video_fps=}, time={time.time() - st:.3f}s")
-    nframes = smart_nframes(ele, total_frames=total_frames, video_fps=video_fps)
-    idx = torch.linspace(0, total_frames - 1, nframes).round().long().tolist()
-    video = vr.get_batch(idx).asnumpy()
+    timestamps = vr.get_frame_timestamp(np.arange(total_frames))[:, 0]
+    idx, sample_fps = sample_frame_indices(ele, timestamps, video_fps)
+    video = vr.get_batch(idx.tolist()).asnumpy()
     video = torch.tensor(video).permute(0, 3, 1, 2)  # Convert to TCHW format
-    sample_fps = nframes / max(total_frames, 1e-6) * video_fps
     return video, sample_fps
 
 
+def _stream_video_torchvision(ele: dict, chunk_size: int):
+    """`(chunks, nframes, sample_fps)` of `_read_video_torchvision`, the frames coming as `(<=chunk_size, C, H, W)` uint8 tensors."""
+    import av
+
+    video_path = ele["video"]
+    if video_path.startswith("file://"):
+        video_path = video_path[7:]
+    container = av.open(video_path)
+    try:
+        stream, pts, keyframes, _, _, idx, sample_fps = _index_video_pyav(container, ele)
+    except Exception:
+        container.close()
+        raise
+
+    def chunks():
+        try:
+            buffer = []
+            for array in _iter_frames_pyav(container, stream, pts[idx], keyframes):
+                buffer.append(array)
+                if len(buffer) == chunk_size:
+                    yield torch.from_numpy(np.stack(buffer)).permute(0, 3, 1, 2)
+                    buffer = []
+            if buffer:
+                yield torch.from_numpy(np.stack(buffer)).permute(0, 3, 1, 2)
+        finally:
+            container.close()
+
+    return chunks(), len(idx), sample_fps
+
+
+def _stream_video_decord(ele: dict, chunk_size: int):
+    """`(chunks, nframes, sample_fps)` of `_read_video_decord`, the frames coming as `(<=chunk_size, C, H, W)` uint8 tensors."""
+    import decord
+
+    vr = decord.VideoReader(ele["video"])
+    timestamps = vr.get_frame_timestamp(np.arange(len(vr)))[:, 0]
+    idx, sample_fps = sample_frame_indices(ele, timestamps, vr.get_avg_fps())
+
+    def chunks():
+        for start in range(0, len(idx), chunk_size):
+            video = vr.get_batch(idx[start : start + chunk_size].tolist()).asnumpy()
+            yield torch.from_numpy(video).permute(0, 3, 1, 2)
+
+    return chunks(), len(idx), sample_fps
+
+
 VIDEO_READER_BACKENDS = {
     "decord": _read_video_decord,
     "torchvision": _read_video_torchvision,
 }
 
+VIDEO_STREAM_BACKENDS = {
+    "decord": _stream_video_decord,
+    "torchvision": _stream_video_torchvision,
+}
+
 FORCE_QWENVL_VIDEO_READER = os.getenv("FORCE_QWENVL_VIDEO_READER", None)
+# Frames per chunk of the streaming video path of fetch_video; 0 reads all sampled frames at once.
+VIDEO_STREAM_CHUNK_SIZE = int(os.environ.get("QWENVL_VIDEO_STREAM_CHUNK", 0))
 
 
 @lru_cache(maxsize=1)
@@ -274,8 +498,93 @@ def get_video_reader_backend() -> str:
     return video_reader_backend
 
 
-def fetch_video(ele: dict, image_factor: int = IMAGE_FACTOR, return_video_sample_fps: bool = False) -> torch.Tensor | list[Image.Image]:
+def video_resized_size(
+    ele: dict, nframes: int, height: int, width: int, image_factor: int = IMAGE_FACTOR
+) -> tuple[int, int]:
+    """`(resized_height, resized_width)` of the frames of a video, within the video pixel budget."""
+    min_pixels = ele.get("min_pixels", VIDEO_MIN_PIXELS)
+    total_pixels = ele.get("total_pixels", VIDEO_TOTAL_PIXELS)
+    max_pixels = max(min(VIDEO_MAX_PIXELS, total_pixels / nframes * FRAME_FACTOR), int(min_pixels * 1.05))
+    max_pixels_supposed = ele.get("max_pixels", max_pixels)
+    if max_pixels_supposed > max_pixels:
+        logger.warning(f"The given max_pixels[{max_pixels_supposed}] exceeds limit[{max_pixels}].")
+    max_pixels = min(max_pixels_supposed, max_pixels)
+    if "resized_height" in ele and "resized_width" in ele:
+        return smart_resize(
+            ele["resized_height"],
+            ele["resized_width"],
+            factor=image_factor,
+        )
+    return smart_resize(
+        height,
+        width,
+        factor=image_factor,
+        min_pixels=min_pixels,
+        max_pixels=max_pixels,
+    )
+
+
+def _resize_frames(video: torch.Tensor, resized_height: int, resized_width: int) -> torch.Tensor:
+    return transforms.functional.resize(
+        video,
+        [resized_height, resized_width],
+        interpolation=InterpolationMode.BICUBIC,
+        antialias=True,
+    )
+
+
+def _stream_video(ele: dict, image_factor: int, chunk_size: int, dtype: torch.dtype) -> tuple[torch.Tensor, float]:
+    """Decode, resize and convert the sampled frames `chunk_size` at a time into one preallocated tensor.
+
+    Peak memory is the output plus a few copies of one chunk, instead of the
+    whole native-resolution video plus a float32 copy of it.
+    """
+    video_reader_backend = get_video_reader_backend()
+    try:
+        chunks, nframes, sample_fps = VIDEO_STREAM_BACKENDS[video_reader_backend](ele, chunk_size)
+        chunk = next(chunks)
+    except Exception as e:
+        logger.warning(f"video_reader_backend {video_reader_backend} error, use torchvision as default, msg: {e}")
+        chunks, nframes, sample_fps = VIDEO_STREAM_BACKENDS["torchvision"](ele, chunk_size)
+        chunk = next(chunks)
+    _, _, height, width = chunk.shape
+    resized_height, resized_width = video_resized_size(ele, nframes, height, width, image_factor)
+    video = torch.empty((nframes, chunk.shape[1], resized_height, resized_width), dtype=dtype)
+    start = 0
+    while chunk is not None:
+        video[start : start + len(chunk)] = _resize_frames(chunk, resized_height, resized_width)
+        start += len(chunk)
+        chunk = next(chunks, None)
+    return video, sample_fps
+
+
+def fetch_video(
+    ele: dict,
+    image_factor: int = IMAGE_FACTOR,
+    return_video_sample_fps: bool = False,
+    stream_chunk_size: Optional[int] = None,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor | list[Image.Image]:
+    """Sampled, resized frames of a video as a `(T, C, H, W)` tensor of `dtype`, or the images of a frame list.
+
+    With `stream_chunk_size` (default `QWENVL_VIDEO_STREAM_CHUNK`, 0 turns it
+    off), frames are decoded, resized and converted that many at a time into
+    one preallocated tensor. The values are the same as without streaming;
+    resized pixels are whole numbers in [0, 255], which bfloat16 and uint8
+    hold exactly.
+    """
     if isinstance(ele["video"], str):
+        if ele["video"].startswith("http://") or ele["video"].startswith("https://"):
+            # readers get a local copy from the media cache's disk tier, if there is one
+            ele = {**ele, "video": get_media_cache().video_path(ele["video"], get_http_session(), HTTP_TIMEOUT)}
+        if stream_chunk_size is None:
+            stream_chunk_size = VIDEO_STREAM_CHUNK_SIZE
+        if stream_chunk_size > 0:
+            video, sample_fps = _stream_video(ele, image_factor, stream_chunk_size, dtype)
+            if return_video_sample_fps:
+                return video, sample_fps
+            return video
+
         video_reader_backend = get_video_reader_backend()
         try:
             video, sample_fps = VIDEO_READER_BACKENDS[video_reader_backend](ele)
@@ -284,33 +593,8 @@ def fetch_video(ele: dict, image_factor: int = IMAGE_FACTOR, return_video_sample
             video, sample_fps = VIDEO_READER_BACKENDS["torchvision"](ele)
 
         nframes, _, height, width = video.shape
-        min_pixels = ele.get("min_pixels", VIDEO_MIN_PIXELS)
-        total_pixels = ele.get("total_pixels", VIDEO_TOTAL_PIXELS)
-        max_pixels = max(min(VIDEO_MAX_PIXELS, total_pixels / nframes * FRAME_FACTOR), int(min_pixels * 1.05))
-        max_pixels_supposed = ele.get("max_pixels", max_pixels)
-        if max_pixels_supposed > max_pixels:
-            logger.warning(f"The given max_pixels[{max_pixels_supposed}] exceeds limit[{max_pixels}].")
-        max_pixels = min(max_pixels_supposed, max_pixels)
-        if "resized_height" in ele and "resized_width" in ele:
-            resized_height, resized_width = smart_resize(
-                ele["resized_height"],
-                ele["resized_width"],
-                factor=image_factor,
-            )
-        else:
-            resized_height, resized_width = smart_resize(
-                height,
-                width,
-                factor=image_factor,
-                min_pixels=min_pixels,
-                max_pixels=max_pixels,
-            )
-        video = transforms.functional.resize(
-            video,
-            [resized_height, resized_width],
-            interpolation=InterpolationMode.BICUBIC,
-            antialias=True,
-        ).float()
+        resized_height, resized_width = video_resized_size(ele, nframes, height, width, image_factor)
+        video = _resize_frames(video, resized_height, resized_width).to(dtype)
         if return_video_sample_fps:
             return video, sample_fps
         return video
@@ -349,25 +633,27 @@ def extract_vision_info(conversations: list[dict] | list[list[dict]]) -> list[di
     return vision_infos
 
 
-def process_vision_info(
-    conversations: list[dict] | list[list[dict]],
-    return_video_kwargs: bool = False,
-) -> tuple[list[Image.Image] | None, list[torch.Tensor | list[Image.Image]] | None, Optional[dict]]:
+def fetch_vision_info(vision_info: dict) -> Image.Image | tuple[torch.Tensor | list[Image.Image], float]:
+    """Image of an image element, or `(video, sample_fps)` of a video element."""
+    if "image" in vision_info or "image_url" in vision_info:
+        return fetch_image(vision_info)
+    elif "video" in vision_info:
+        return fetch_video(vision_info, return_video_sample_fps=True)
+    else:
+        raise ValueError("image, image_url or video should in content.")
 
-    vision_infos = extract_vision_info(conversations)
-    ## Read images or videos
+
+def _collect_vision_inputs(vision_infos: list[dict], fetched: list, return_video_kwargs: bool):
     image_inputs = []
     video_inputs = []
     video_sample_fps_list = []
-    for vision_info in vision_infos:
+    for vision_info, result in zip(vision_infos, fetched):
         if "image" in vision_info or "image_url" in vision_info:
-            image_inputs.append(fetch_image(vision_info))
-        elif "video" in vision_info:
-            video_input, video_sample_fps = fetch_video(vision_info, return_video_sample_fps=True)
+            image_inputs.append(result)
+        else:
+            video_input, video_sample_fps = result
             video_sample_fps_list.append(video_sample_fps)
             video_inputs.append(video_input)
-        else:
-            raise ValueError("image, image_url or video should in content.")
     if len(image_inputs) == 0:
         image_inputs = None
     if len(video_inputs) == 0:
@@ -375,3 +661,54 @@ def process_vision_info(
     if return_video_kwargs:
         return image_inputs, video_inputs, {'fps': video_sample_fps_list}
     return image_inputs, video_inputs
+
+
+def process_vision_info(
+    conversations: list[dict] | list[list[dict]],
+    return_video_kwargs: bool = False,
+) -> tuple[list[Image.Image] | None, list[torch.Tensor | list[Image.Image]] | None, Optional[dict]]:
+
+    vision_infos = extract_vision_info(conversations)
+    ## Read images or videos
+    fetched = [fetch_vision_info(vision_info) for vision_info in vision_infos]
+    return _collect_vision_inputs(vision_infos, fetched, return_video_kwargs)
+
+
+async def process_vision_info_async(
+    conversations: list[dict] | list[list[dict]],
+    return_video_kwargs: bool = False,
+    executor: Optional[Executor] = None,
+) -> tuple[list[Image.Image] | None, list[torch.Tensor | list[Image.Image]] | None, Optional[dict]]:
+    """Same outputs as `process_vision_info`, with every image and video fetched and decoded concurrently.
+
+    Downloads share the pooled session of `get_http_session`; fetching and
+    decoding run on `executor`, by default a shared pool of FETCH_WORKERS
+    threads, so the event loop is never blocked.
+    """
+    vision_infos = extract_vision_info(conversations)
+    loop = asyncio.get_running_loop()
+    executor = executor or get_fetch_executor()
+    fetched = await asyncio.gather(
+        *(loop.run_in_executor(executor, fetch_vision_info, vision_info) for vision_info in vision_infos)
+    )
+    return _collect_vision_inputs(vision_infos, fetched, return_video_kwargs)
+
+
+def process_vision_info_batch(
+    batch: list[list[dict]],
+    return_video_kwargs: bool = False,
+    executor: Optional[Executor] = None,
+) -> list[tuple]:
+    """`process_vision_info` of each conversation in `batch`, with all media of the batch fetched concurrently.
+
+    Returns one `process_vision_info` output per conversation, in order. An
+    error fetching any element is raised once every fetch has finished.
+    """
+    executor = executor or get_fetch_executor()
+    vision_infos = [extract_vision_info(conversation) for conversation in batch]
+    futures = [[executor.submit(fetch_vision_info, vision_info) for vision_info in infos] for infos in vision_infos]
+    wait([future for conversation in futures for future in conversation])
+    return [
+        _collect_vision_inputs(infos, [future.result() for future in conversation], return_video_kwargs)
+        for infos, conversation in zip(vision_infos, futures)
+    ]
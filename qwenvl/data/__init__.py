@@ -26,23 +26,38 @@ MY_DATASET = {
     "data_path": "",
 }
 
+# pre-built Arrow annotation store, see qwenvl/data/arrow_store.py
+MY_DATASET_ARROW = {
+    "annotation_path": "./frozenlake/train.arrow",
+    "data_path": "",
+}
+
 data_dict = {
     "my_dataset": MY_DATASET,
+    "my_dataset_arrow": MY_DATASET_ARROW,
 }
 
 
+# `name%NN` weights a dataset by NN percent; values above 100 oversample it
+SAMPLING_RATE_PATTERN = re.compile(r"%(\d+(?:\.\d+)?)$")
+
+
 def parse_sampling_rate(dataset_name):
-    match = re.search(r"%(\d+)$", dataset_name)
+    match = SAMPLING_RATE_PATTERN.search(dataset_name)
     if match:
-        return int(match.group(1)) / 100.0
+        return float(match.group(1)) / 100.0
     return 1.0
 
 
+def strip_sampling_rate(dataset_name):
+    return SAMPLING_RATE_PATTERN.sub("", dataset_name)
+
+
 def data_list(dataset_names):
     config_list = []
     for dataset_name in dataset_names:
         sampling_rate = parse_sampling_rate(dataset_name)
-        dataset_name = re.sub(r"%(\d+)$", "", dataset_name)
+        dataset_name = strip_sampling_rate(dataset_name)
         if dataset_name in data_dict.keys():
             config = data_dict[dataset_name].copy()
             config["sampling_rate"] = sampling_rate
@@ -53,7 +68,7 @@ def data_list(dataset_names):
 
 
 if __name__ == "__main__":
-    dataset_names = ["my_dataset%100"]
+    dataset_names = ["my_dataset%100", "my_dataset_arrow%250"]
     configs = data_list(dataset_names)
     for config in configs:
         print(config)
@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import hashlib
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+INDEX_VERSION = 1
+# where derived files go when neither `cache_dir` nor the annotation's directory can be written
+FALLBACK_CACHE_DIR = os.path.join(tempfile.gettempdir(), "qwenvl-annotations")
+# earlier versions of a derived file, replaced when a new one is written
+JSONL_STALE_SUFFIX = r"\.\d+-\d+\.jsonl"
+# also matches indexes named after the conversion, as earlier versions wrote them
+INDEX_STALE_SUFFIX = r"(\.\d+-\d+\.jsonl)?\.index-v\d+-\d+-\d+\.npz"
+
+
+def file_signature(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def line_spans(path: str, chunk_size: int = 1 << 24) -> np.ndarray:
+    """`[start, end)` byte offsets of every non-empty line of `path`."""
+    newlines = []
+    offset = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            newlines.append(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10) + offset)
+            offset += len(chunk)
+    ends = np.concatenate(newlines + [np.array([offset], dtype=np.int64)])
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    spans = np.stack([starts, ends], axis=1).astype(np.int64)
+    return spans[spans[:, 1] > spans[:, 0]]
+
+
+def _publish(path: str, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def sidecar_dirs(annotation_path: str, cache_dir: Optional[str] = None) -> List[str]:
+    """Directories that may hold files derived from `annotation_path`, in order of preference.
+
+    Derived files go to `cache_dir`, by default the annotation file's own
+    directory, or to `FALLBACK_CACHE_DIR` when that cannot be written.
+    """
+    primary = cache_dir or os.path.dirname(os.path.abspath(annotation_path))
+    return [primary, FALLBACK_CACHE_DIR]
+
+
+def sidecar_path(annotation_path: str, directory: str, suffix: str) -> str:
+    """`<annotation file name><suffix>` in `directory`.
+
+    Outside the annotation file's own directory the name also carries a hash
+    of its full path, so annotation files that share a name do not collide.
+    """
+    annotation_path = os.path.abspath(annotation_path)
+    name = os.path.basename(annotation_path)
+    if os.path.abspath(directory) != os.path.dirname(annotation_path):
+        name = f"{name}-{hashlib.sha256(annotation_path.encode()).hexdigest()[:12]}"
+    return os.path.join(directory, f"{name}{suffix}")
+
+
+def find_sidecar(annotation_path: str, suffix: str, cache_dir: Optional[str] = None) -> Optional[str]:
+    for directory in sidecar_dirs(annotation_path, cache_dir):
+        path = sidecar_path(annotation_path, directory, suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def publish_sidecar(
+    annotation_path: str,
+    suffix: str,
+    write,
+    cache_dir: Optional[str] = None,
+    stale_suffix: Optional[str] = None,
+) -> str:
+    """Write a file derived from `annotation_path` to the first writable sidecar directory.
+
+    Files in that directory whose suffix matches the regex `stale_suffix`,
+    such as the versions derived from an earlier edit of the annotation
+    file, are deleted once the new file is in place.
+    """
+    from .data_qwen import rank0_print
+
+    error = None
+    for directory in sidecar_dirs(annotation_path, cache_dir):
+        path = sidecar_path(annotation_path, directory, suffix)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _publish(path, write)
+        except OSError as e:
+            rank0_print(f"Could not write {path}: {e}")
+            error = e
+            continue
+        if stale_suffix is not None:
+            remove_stale_sidecars(path, sidecar_path(annotation_path, directory, ""), stale_suffix)
+        return path
+    raise error
+
+
+def remove_stale_sidecars(path: str, prefix: str, stale_suffix: str):
+    pattern = re.compile(re.escape(os.path.basename(prefix)) + stale_suffix + "$")
+    directory = os.path.dirname(path)
+    for name in os.listdir(directory):
+        if name != os.path.basename(path) and pattern.match(name):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def build_annotation_index(jsonl_path: str) -> Dict[str, np.ndarray]:
+    spans = line_spans(jsonl_path)
+    has_media = np.zeros(len(spans), dtype=bool)
+    with open(jsonl_path, "rb") as f:
+        for row, (start, end) in enumerate(spans):
+            f.seek(start)
+            ann = json.loads(f.read(end - start))
+            has_media[row] = "image" in ann or "video" in ann
+    return dict(spans=spans, has_media=has_media)
+
+
+class JsonlAnnotations(object):
+    """Records of one JSONL annotation file, parsed on access through a byte-offset index.
+
+    Only the `(n, 2)` span array and a per-record media flag are held in
+    memory, so forked dataloader workers share them without copy-on-write
+    churn. Records are read with `os.pread`, which needs no per-worker file
+    position. Each parsed record gets the `data_path` of its dataset.
+    """
+
+    def __init__(self, path: str, spans: np.ndarray, has_media: np.ndarray, data_path=""):
+        self.path = path
+        self.spans = spans
+        self.has_media = has_media
+        self.data_path = data_path
+        self._fd = None
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __getitem__(self, row: int) -> Dict:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDONLY)
+        start, end = self.spans[row]
+        ann = json.loads(os.pread(self._fd, int(end - start), int(start)))
+        ann["data_path"] = self.data_path
+        return ann
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        return state
+
+
+def annotation_jsonl(annotation_path: str, cache_dir: Optional[str] = None) -> str:
+    """JSONL records of `annotation_path`: the file itself, or its conversion from a `.json` array.
+
+    A conversion is keyed on the version of the `.json` file and replaces
+    the conversions of earlier versions.
+    """
+    from .data_qwen import rank0_print
+
+    if annotation_path.endswith(".jsonl"):
+        return annotation_path
+    suffix = f".{file_signature(annotation_path)}.jsonl"
+    jsonl_path = find_sidecar(annotation_path, suffix, cache_dir)
+    if jsonl_path is None:
+        rank0_print(f"Converting {annotation_path} to JSONL")
+        with open(annotation_path, "r") as f:
+            annotations = json.load(f)
+
+        def write(f):
+            for ann in annotations:
+                f.write((json.dumps(ann, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        jsonl_path = publish_sidecar(
+            annotation_path, suffix, write, cache_dir, stale_suffix=JSONL_STALE_SUFFIX
+        )
+    return jsonl_path
+
+
+def index_suffix(annotation_path: str) -> str:
+    return f".index-v{INDEX_VERSION}-{file_signature(annotation_path)}.npz"
+
+
+def load_annotations(annotation_path: str, data_path: str = "", cache_dir: Optional[str] = None):
+    """Open `annotation_path` lazily, converting `.json` to JSONL and indexing it on first use.
+
+    The conversion and the index are written to `cache_dir` (see
+    `sidecar_dirs`). Pre-built Arrow stores (`.arrow`, see arrow_store.py)
+    are memory-mapped as they are.
+    """
+    from .data_qwen import rank0_print
+
+    if annotation_path.endswith(".arrow"):
+        from .arrow_store import ArrowAnnotations
+
+        return ArrowAnnotations(annotation_path, data_path)
+
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+        jsonl_path = annotation_jsonl(annotation_path, cache_dir)
+        if find_sidecar(annotation_path, index_suffix(annotation_path), cache_dir) is None:
+            rank0_print(f"Indexing annotations {jsonl_path}")
+            index = build_annotation_index(jsonl_path)
+            publish_sidecar(
+                annotation_path,
+                index_suffix(annotation_path),
+                lambda f: np.savez(f, **index),
+                cache_dir,
+                stale_suffix=INDEX_STALE_SUFFIX,
+            )
+    if distributed:
+        torch.distributed.barrier()
+    jsonl_path = annotation_jsonl(annotation_path, cache_dir)
+    with np.load(find_sidecar(annotation_path, index_suffix(annotation_path), cache_dir)) as index:
+        return JsonlAnnotations(
+            jsonl_path, index["spans"], index["has_media"], data_path=data_path
+        )
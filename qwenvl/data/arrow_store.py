@@ -0,0 +1,167 @@
+import os
+import json
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+# keys with their own column; anything else goes to `extra` as JSON
+STORE_KEYS = ("conversations", "image", "video", "data_path", "dataset")
+
+
+def store_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("dataset", pa.dictionary(pa.int32(), pa.string())),
+            ("data_path", pa.dictionary(pa.int32(), pa.string())),
+            ("image", pa.list_(pa.string())),
+            ("video", pa.list_(pa.string())),
+            # one JSON object per turn, so `from`/`value` and `role`/`content`
+            # turns and any other per-turn keys round-trip unchanged
+            ("conversations", pa.list_(pa.string())),
+            ("extra", pa.string()),
+        ]
+    )
+
+
+def _media(ann: Dict, key: str):
+    files = ann.get(key)
+    if files is None or isinstance(files, list):
+        return files
+    return [files]
+
+
+def build_arrow_store(
+    sources: Iterable[Tuple[str, Iterable[Dict], str]],
+    output_path: str,
+    batch_size: int = 8192,
+):
+    """Write `(dataset name, annotations, data_path)` sources to one Arrow IPC file.
+
+    Single media paths are stored as one-element lists, which the dataset
+    treats the same way.
+    """
+    import pyarrow as pa
+
+    schema = store_schema()
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for name, annotations, data_path in sources:
+            batch = []
+            for ann in annotations:
+                extra = {k: v for k, v in ann.items() if k not in STORE_KEYS}
+                batch.append(
+                    {
+                        "dataset": name,
+                        "data_path": ann.get("data_path", data_path),
+                        "image": _media(ann, "image"),
+                        "video": _media(ann, "video"),
+                        "conversations": [
+                            json.dumps(conv, ensure_ascii=False)
+                            for conv in ann["conversations"]
+                        ],
+                        "extra": json.dumps(extra, ensure_ascii=False) if extra else None,
+                    }
+                )
+                if len(batch) == batch_size:
+                    writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                    batch = []
+            if batch:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class ArrowAnnotations(object):
+    """Annotations in a memory-mapped Arrow IPC file, with the `JsonlAnnotations` interface.
+
+    Columns are read straight from the mapped pages, so dataloader workers
+    share one copy; put the file on `/dev/shm` to keep it in shared memory.
+    Only the record being fetched is turned into Python objects.
+    """
+
+    def __init__(self, path: str, data_path: str = ""):
+        import pyarrow.compute as pc
+
+        self.path = path
+        self.data_path = data_path
+        table = self.table
+        self.has_media = np.asarray(
+            pc.or_(pc.is_valid(table["image"]), pc.is_valid(table["video"]))
+        )
+
+    @property
+    def table(self):
+        if getattr(self, "_table", None) is None:
+            import pyarrow as pa
+
+            # the table's buffers point into the mapping, so it stays open
+            self._source = pa.memory_map(self.path, "r")
+            self._table = pa.ipc.open_file(self._source).read_all()
+        return self._table
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def _record(self, record: Dict) -> Dict:
+        ann = json.loads(record.pop("extra") or "{}")
+        for key in ("image", "video"):
+            if record[key] is not None:
+                ann[key] = record[key]
+        # stores built before turns were JSON hold `{"from", "value"}` structs
+        ann["conversations"] = [
+            json.loads(conv) if isinstance(conv, str) else conv
+            for conv in record["conversations"]
+        ]
+        ann["dataset"] = record["dataset"]
+        ann["data_path"] = (
+            record["data_path"] if record["data_path"] is not None else self.data_path
+        )
+        return ann
+
+    def __getitem__(self, row: int) -> Dict:
+        return self._record(self.table.slice(int(row), 1).to_pylist()[0])
+
+    def __iter__(self):
+        for batch in self.table.to_batches():
+            for record in batch.to_pylist():
+                yield self._record(record)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_table"] = None
+        state["_source"] = None
+        return state
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from qwenvl.data import data_list, strip_sampling_rate
+    from qwenvl.data.annotations import load_annotations
+
+    parser = argparse.ArgumentParser(
+        description="Build an Arrow annotation store from registered datasets."
+    )
+    parser.add_argument("--dataset_use", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--annotation_cache_dir", type=str, default=None)
+    args = parser.parse_args()
+
+    names = args.dataset_use.split(",")
+    configs = data_list(names)
+    build_arrow_store(
+        (
+            (
+                strip_sampling_rate(name),
+                load_annotations(
+                    config["annotation_path"], config["data_path"], args.annotation_cache_dir
+                ),
+                config["data_path"],
+            )
+            for name, config in zip(names, configs)
+        ),
+        args.output_path,
+    )
+    print(f"Saved {len(ArrowAnnotations(args.output_path))} annotations to {args.output_path}")
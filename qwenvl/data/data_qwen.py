@@ -8,6 +8,8 @@ import time
 import math
 import itertools
 import ast
+import multiprocessing.util
+from functools import lru_cache
 from dataclasses import dataclass, field
 from typing import Dict, Optional, Sequence, List, Tuple
 from io import BytesIO
@@ -22,13 +24,24 @@ from decord import VideoReader
 import transformers
 
 from . import data_list
-from .rope2d import get_rope_index_25, get_rope_index_2
+from .rope2d import get_rope_index_25, get_rope_index_2, rope_template_cache
+from .annotations import load_annotations
+from .token_cache import load_token_cache
+from .length_index import load_length_index
+from .pixel_cache import PixelCache, processor_fingerprint
+from .failure_registry import FailureRegistry
+from .vision_processing import VisionProcessor
+from .video_decoding import VideoReaderCache
+from .frame_store import FrameStore
 
 IGNORE_INDEX = -100
 IMAGE_TOKEN_INDEX = 151655
 VIDEO_TOKEN_INDEX = 151656
 DEFAULT_IMAGE_TOKEN = "<image>"
 DEFAULT_VIDEO_TOKEN = "<video>"
+# replacements tried for a bad sample before giving up
+MAX_SAMPLE_REPLACEMENTS = 32
+CHAT_TEMPLATE = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
 
 local_rank = None
 
@@ -43,88 +56,171 @@ def read_jsonl(path):
         return [json.loads(line) for line in f]
 
 
-def preprocess_qwen_2_visual(
-    sources,
-    tokenizer: transformers.PreTrainedTokenizer,
-    grid_thw: List = [],
-    visual_type: str = "image",
-) -> Dict:
-    roles = {"human": "user", "gpt": "assistant"}
-    system_message = "You are a helpful assistant."
-    if visual_type not in ["image", "video"]:
-        raise ValueError("visual_type must be either 'image' or 'video'")
+def video_frame_indices(total_frames: int, avg_fps: float, data_args) -> np.ndarray:
+    """Indices of the frames sampled from a video, one every `base_interval` seconds."""
+    video_length = total_frames / avg_fps
+    interval = getattr(data_args, "base_interval", 4)
 
-    tokenizer = copy.deepcopy(tokenizer)
-    chat_template = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
-    tokenizer.chat_template = chat_template
+    num_frames_to_sample = round(video_length / interval)
+    video_min_frames = getattr(data_args, "video_min_frames", 4)
+    video_max_frames = getattr(data_args, "video_max_frames", 8)
 
-    visual_replicate_index = 0
-    input_ids, targets = [], []
+    target_frames = min(max(num_frames_to_sample, video_min_frames), video_max_frames)
+    frame_idx = np.linspace(0, total_frames - 1, target_frames, dtype=int)
+    return np.unique(frame_idx)
 
-    for i, source in enumerate(sources):
-        try:
-            if roles[source[0]["from"]] != roles["human"]:
-                source = source[1:]
-        except:
-            print(sources)
 
-        input_id, target = [], []
+class ConversationEncoder(object):
+    """Tokenize conversations with CHAT_TEMPLATE without rendering it per turn.
 
-        input_id += tokenizer.apply_chat_template(
-            [{"role": "system", "content": system_message}]
-        )
-        target += [IGNORE_INDEX] * len(input_id)
+    The role headers, the system turn and the turn terminator are tokenized
+    once; per sample only the message text is tokenized and the cached pieces
+    and vision spans are spliced around it. Special tokens always split the
+    tokenizer input, so this is identical to `apply_chat_template` except when
+    a message starts with whitespace, which may merge with the header newline;
+    those turns are encoded together with their header.
+    """
+
+    roles = {"human": "user", "gpt": "assistant"}
 
-        for conv in source:
+    def __init__(
+        self,
+        tokenizer: transformers.PreTrainedTokenizer,
+        system_message: str = "You are a helpful assistant.",
+        chat_template: str = CHAT_TEMPLATE,
+    ):
+        self.tokenizer = tokenizer
+        self.chat_template = chat_template
+        self._encode_text = lru_cache(maxsize=4096)(self._encode)
+        self.system_ids = tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_message}],
+            chat_template=chat_template,
+        )
+        self.im_start_id = tokenizer.convert_tokens_to_ids("<|im_start|>")
+        self.turn_end_ids = tokenizer.convert_tokens_to_ids(["<|im_end|>"]) + self.encode(
+            "\n"
+        )
+        self.vision_start_id = tokenizer.convert_tokens_to_ids("<|vision_start|>")
+        self.vision_end_id = tokenizer.convert_tokens_to_ids("<|vision_end|>")
+        self.pad_ids = {
+            "image": tokenizer.convert_tokens_to_ids("<|image_pad|>"),
+            "video": tokenizer.convert_tokens_to_ids("<|video_pad|>"),
+        }
+        self.header_ids = {}
+
+    def _encode(self, text: str) -> Tuple[int]:
+        return tuple(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def encode(self, text: str) -> List[int]:
+        return list(self._encode_text(text)) if text else []
+
+    def encode_header(self, role: str, text: str) -> List[int]:
+        """Tokenize `<|im_start|>{role}\\n{text}`."""
+        if text[:1].isspace():
+            return [self.im_start_id] + self.encode(role + "\n" + text)
+        if role not in self.header_ids:
+            self.header_ids[role] = [self.im_start_id] + self.encode(role + "\n")
+        return self.header_ids[role] + self.encode(text)
+
+    def __call__(
+        self, sources, grid_thw: List = [], visual_type: str = "image"
+    ) -> Dict:
+        if visual_type not in ["image", "video"]:
+            raise ValueError("visual_type must be either 'image' or 'video'")
+        visual_tag = f"<{visual_type}>"
+        pad_id = self.pad_ids[visual_type]
+
+        visual_replicate_index = 0
+        input_ids, targets = [], []
+
+        for source in sources:
             try:
-                role = conv["role"]
-                content = conv["content"]
+                if self.roles[source[0]["from"]] != self.roles["human"]:
+                    source = source[1:]
             except:
-                role = conv["from"]
-                content = conv["value"]
-
-            role = roles.get(role, role)
-            if role == "user":
-                visual_tag = f"<{visual_type}>"
-                if visual_tag in content:
-                    parts = content.split(visual_tag)
-                    new_parts = []
-                    for i in range(len(parts) - 1):
-                        new_parts.append(parts[i])
-                        replacement = (
-                            "<|vision_start|>"
-                            + f"<|{visual_type}_pad|>"
-                            * grid_thw[visual_replicate_index]
-                            + "<|vision_end|>"
-                        )
-                        new_parts.append(replacement)
-                        visual_replicate_index += 1
-                    new_parts.append(parts[-1])
-                    content = "".join(new_parts)
-
-            conv = [{"role": role, "content": content}]
-            encode_id = tokenizer.apply_chat_template(conv)
-            input_id += encode_id
-            if role in ["user", "system"]:
-                target += [IGNORE_INDEX] * len(encode_id)
-            else:
-                target_mask = encode_id.copy()
-                target_mask[:3] = [IGNORE_INDEX] * 3
-                target += target_mask
+                print(sources)
+
+            input_id = list(self.system_ids)
+            target = [IGNORE_INDEX] * len(input_id)
+
+            for conv in source:
+                try:
+                    role = conv["role"]
+                    content = conv["content"]
+                except:
+                    role = conv["from"]
+                    content = conv["value"]
+
+                role = self.roles.get(role, role)
+                parts = content.split(visual_tag) if role == "user" else [content]
+                encode_id = self.encode_header(role, parts[0])
+                for part in parts[1:]:
+                    encode_id.append(self.vision_start_id)
+                    encode_id += [pad_id] * int(grid_thw[visual_replicate_index])
+                    encode_id.append(self.vision_end_id)
+                    encode_id += self.encode(part)
+                    visual_replicate_index += 1
+                encode_id += self.turn_end_ids
+
+                input_id += encode_id
+                if role in ["user", "system"]:
+                    target += [IGNORE_INDEX] * len(encode_id)
+                else:
+                    target += [IGNORE_INDEX] * 3 + encode_id[3:]
 
-        assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
-        input_ids.append(input_id)
-        targets.append(target)
+            assert len(input_id) == len(target), f"{len(input_id)} != {len(target)}"
+            input_ids.append(input_id)
+            targets.append(target)
 
-    input_ids = torch.tensor(input_ids, dtype=torch.long)
-    targets = torch.tensor(targets, dtype=torch.long)
+        input_ids = torch.tensor(input_ids, dtype=torch.long)
+        targets = torch.tensor(targets, dtype=torch.long)
 
-    return dict(
-        input_ids=input_ids,
-        labels=targets,
+        return dict(
+            input_ids=input_ids,
+            labels=targets,
+        )
+
+
+_conversation_encoders = {}
+
+
+def get_conversation_encoder(
+    tokenizer: transformers.PreTrainedTokenizer,
+) -> ConversationEncoder:
+    """Return the encoder of `tokenizer`, built once per (worker) process."""
+    encoder = _conversation_encoders.get(id(tokenizer))
+    if encoder is None or encoder.tokenizer is not tokenizer:
+        encoder = ConversationEncoder(tokenizer)
+        _conversation_encoders[id(tokenizer)] = encoder
+    return encoder
+
+
+def preprocess_qwen_2_visual(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    grid_thw: List = [],
+    visual_type: str = "image",
+) -> Dict:
+    return get_conversation_encoder(tokenizer)(
+        sources, grid_thw=grid_thw, visual_type=visual_type
     )
 
 
+class LazyAnnotationList(object):
+    """Read-only list view of the shuffled samples, parsing each record on access."""
+
+    def __init__(self, annotations, sample_source, sample_row):
+        self.annotations = annotations
+        self.sample_source = sample_source
+        self.sample_row = sample_row
+
+    def __len__(self):
+        return len(self.sample_source)
+
+    def __getitem__(self, i) -> Dict:
+        return self.annotations[self.sample_source[i]][self.sample_row[i]]
+
+
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -146,165 +242,248 @@ class LazySupervisedDataset(Dataset):
         else:
             self.get_rope_index = get_rope_index_2
 
-        list_data_dict = []
-
-        for data in dataset_list:
-            file_format = data["annotation_path"].split(".")[-1]
-            if file_format == "jsonl":
-                annotations = read_jsonl(data["annotation_path"])
-            else:
-                annotations = json.load(open(data["annotation_path"], "r"))
-            sampling_rate = data.get("sampling_rate", 1.0)
-            if sampling_rate < 1.0:
-                annotations = random.sample(
-                    annotations, int(len(annotations) * sampling_rate)
+        # annotations stay on disk; a sample is the (source, row) pair of its record
+        self.annotations = []
+        self.token_caches = []
+        self.source_weights = []
+        self.annotation_paths = []
+        sample_source, sample_row, sample_num_tokens = [], [], []
+
+        for source_id, data in enumerate(dataset_list):
+            annotations = load_annotations(
+                data["annotation_path"],
+                data["data_path"],
+                getattr(data_args, "annotation_cache_dir", None),
+            )
+            self.annotations.append(annotations)
+            cache = None
+            if getattr(data_args, "token_cache_dir", None):
+                cache = load_token_cache(
+                    data["annotation_path"],
+                    annotations,
+                    data["data_path"],
+                    tokenizer,
+                    data_args,
                 )
-                print(f"sampling {len(annotations)} examples from dataset {data}")
-            else:
-                rank0_print(f"dataset name: {data}")
-            for ann in annotations:
-                ann["data_path"] = data["data_path"]
-            list_data_dict += annotations
+            self.token_caches.append(cache)
+            num_tokens = load_length_index(
+                data["annotation_path"],
+                annotations,
+                tokenizer,
+                data_args,
+                cache,
+                build=getattr(data_args, "build_length_index", False),
+            )
+            # the `%NN` weight is applied by the mixture sampler, every record stays indexable
+            rows = np.arange(len(annotations))
+            self.source_weights.append(data.get("sampling_rate", 1.0))
+            self.annotation_paths.append(data["annotation_path"])
+            rank0_print(f"dataset name: {data}")
+            sample_source.append(np.full(len(rows), source_id, dtype=np.int32))
+            sample_row.append(rows)
+            sample_num_tokens.append(num_tokens[rows])
 
-        rank0_print(f"Total training samples: {len(list_data_dict)}")
+        order = list(range(sum(len(rows) for rows in sample_row)))
+        rank0_print(f"Total training samples: {len(order)}")
 
-        random.shuffle(list_data_dict)  # Randomly shuffle the data for training
+        random.shuffle(order)  # Randomly shuffle the data for training
+        order = np.array(order, dtype=np.int64)
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
-        self.list_data_dict = list_data_dict
+        self.sample_source = np.concatenate(sample_source)[order]
+        self.sample_row = np.concatenate(sample_row)[order]
+        self.list_data_dict = LazyAnnotationList(
+            self.annotations, self.sample_source, self.sample_row
+        )
         self.data_args = data_args
         self.data_args.image_processor.max_pixels = data_args.max_pixels
         self.data_args.image_processor.min_pixels = data_args.min_pixels
         self.data_args.image_processor.size["longest_edge"] = data_args.max_pixels
         self.data_args.image_processor.size["shortest_edge"] = data_args.min_pixels
+        fast = getattr(data_args, "fast_vision_processor", False)
+        self.image_processor = VisionProcessor(
+            data_args.image_processor,
+            data_args.min_pixels,
+            data_args.max_pixels,
+            fast=fast,
+        )
+        self.video_processor = VisionProcessor(
+            data_args.image_processor,
+            data_args.video_min_frame_pixels,
+            data_args.video_max_frame_pixels,
+            fast=fast,
+        )
+        self.video_readers = VideoReaderCache(
+            data_args.video_min_frame_pixels,
+            data_args.video_max_frame_pixels,
+            factor=data_args.image_processor.patch_size
+            * data_args.image_processor.merge_size,
+            reduced=getattr(data_args, "video_reduced_decode", False),
+        )
+        self.frame_store = None
+        if getattr(data_args, "video_frame_store_dir", None):
+            self.frame_store = FrameStore(data_args.video_frame_store_dir, data_args)
+        self.pixel_cache = None
+        if getattr(data_args, "pixel_cache_dir", None):
+            self.pixel_cache = PixelCache(
+                data_args.pixel_cache_dir,
+                self.image_processor.processor,
+                max_bytes=int(data_args.pixel_cache_max_gb * 1024**3),
+            )
+        self._num_tokens = np.concatenate(sample_num_tokens)[order]
+        has_media = np.concatenate(
+            [
+                self.annotations[source_id].has_media[rows]
+                for source_id, rows in enumerate(sample_row)
+            ]
+        )[order]
+        self._lengths = self._num_tokens.tolist()
+        self._modality_lengths = np.where(
+            has_media, self._num_tokens, -self._num_tokens
+        ).tolist()
+        self.failure_registry = FailureRegistry(
+            self.annotation_paths,
+            [len(annotations) for annotations in self.annotations],
+            self.sample_source,
+            self.sample_row,
+            self._num_tokens,
+            has_media,
+            registry_dir=getattr(data_args, "sample_failure_dir", None),
+            fingerprint=processor_fingerprint(data_args.image_processor),
+            log_dir=getattr(data_args, "sample_failure_log_dir", None),
+        )
+        self._stats_pid = None
 
     def __len__(self):
         return len(self.list_data_dict)
 
     @property
     def lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            img_tokens = 128 if "image" in sample else 0
-            length_list.append(
-                sum(len(conv["value"].split()) for conv in sample["conversations"])
-                + img_tokens
-            )
-        return length_list
+        return self._lengths
 
     @property
     def modality_lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(
-                len(conv["value"].split()) for conv in sample["conversations"]
-            )
-            cur_len = (
-                cur_len if ("image" in sample) or ("video" in sample) else -cur_len
-            )
-            length_list.append(cur_len)
-        return length_list
+        return self._modality_lengths
+
+    @property
+    def num_tokens(self) -> np.ndarray:
+        """Exact token count (text plus vision) of every sample, from the length index."""
+        return self._num_tokens
 
     @property
     def pre_calculated_length(self):
-        if "num_tokens" in self.list_data_dict[0]:
-            length_list = [sample["num_tokens"] for sample in self.list_data_dict]
-            return np.array(length_list)
-        else:
-            print("No pre-calculated length available.")
-            return np.array([1] * len(self.list_data_dict))
+        return self._num_tokens
+
+    def source_indices(self) -> List[np.ndarray]:
+        """Dataset indices of each source, in annotation order (independent of the shuffle)."""
+        indices = []
+        for source_id in range(len(self.annotations)):
+            index = np.flatnonzero(self.sample_source == source_id)
+            indices.append(index[np.argsort(self.sample_row[index], kind="stable")])
+        return indices
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit and miss counts of the caches of the current process (dataloader worker)."""
+        stats = dict(rope_templates=rope_template_cache.info())
+        for name, cache in (
+            ("pixel_cache", self.pixel_cache),
+            ("frame_store", self.frame_store),
+        ):
+            if cache is not None:
+                stats[name] = dict(hits=cache.hits, misses=cache.misses)
+        return stats
+
+    def _print_cache_stats_at_exit(self):
+        # dataloader workers exit at the end of every epoch unless they are persistent
+        worker = torch.utils.data.get_worker_info()
+        if worker is None or self._stats_pid == os.getpid():
+            return
+        self._stats_pid = os.getpid()
+        multiprocessing.util.Finalize(
+            None,
+            lambda: rank0_print(f"Worker {worker.id} cache stats: {self.cache_stats()}"),
+            exitpriority=0,
+        )
 
     def process_image_unified(self, image_file):
-        processor = copy.deepcopy(self.data_args.image_processor)
+        if self.pixel_cache is not None:
+            cached = self.pixel_cache.get(image_file)
+            if cached is not None:
+                return cached
         image = Image.open(image_file).convert("RGB")
-
-        visual_processed = processor.preprocess(image, return_tensors="pt")
-        image_tensor = visual_processed["pixel_values"]
-        if isinstance(image_tensor, List):
-            image_tensor = image_tensor[0]
-        grid_thw = visual_processed["image_grid_thw"][0]
+        image_tensor, grid_thw = self.image_processor(image)
+        if self.pixel_cache is not None:
+            self.pixel_cache.put(image_file, image_tensor, grid_thw)
         return image_tensor, grid_thw
 
     def process_video(self, video_file):
         if not os.path.exists(video_file):
-            print(f"File not exist: {video_file}")
-        vr = VideoReader(video_file, num_threads=4)
+            raise FileNotFoundError(f"File not exist: {video_file}")
+        if self.frame_store is not None:
+            stored = self.frame_store.get(video_file)
+            if stored is not None:
+                video, entry = stored
+                video_tensor, grid_thw = self.video_processor(video, video=True)
+                second_per_grid_ts = [entry["second_per_grid_ts"]] * len(grid_thw)
+                return video_tensor, grid_thw, second_per_grid_ts
+        vr = self.video_readers.get(video_file)
         total_frames = len(vr)
         avg_fps = vr.get_avg_fps()
         video_length = total_frames / avg_fps
-        interval = getattr(self.data_args, "base_interval", 4)
-
-        num_frames_to_sample = round(video_length / interval)
-        video_min_frames = getattr(self.data_args, "video_min_frames", 4)
-        video_max_frames = getattr(self.data_args, "video_max_frames", 8)
-
-        target_frames = min(
-            max(num_frames_to_sample, video_min_frames), video_max_frames
-        )
-        frame_idx = np.linspace(0, total_frames - 1, target_frames, dtype=int)
-        frame_idx = np.unique(frame_idx)
+        frame_idx = video_frame_indices(total_frames, avg_fps, self.data_args)
         video = vr.get_batch(frame_idx).asnumpy()
         fps = len(frame_idx) / video_length
-        processor = copy.deepcopy(self.data_args.image_processor)
-        processor.max_pixels = self.data_args.video_max_frame_pixels
-        processor.min_pixels = self.data_args.video_min_frame_pixels
-        processor.size["longest_edge"] = processor.max_pixels
-        processor.size["shortest_edge"] = processor.min_pixels
-        video_processed = processor.preprocess(
-            images=None, videos=video, return_tensors="pt"
-        )
-        video_tensor = video_processed["pixel_values_videos"]
-        grid_thw = video_processed["video_grid_thw"][0]
+        video_tensor, grid_thw = self.video_processor(video, video=True)
         second_per_grid_ts = [
             self.data_args.image_processor.temporal_patch_size / fps
         ] * len(grid_thw)
         return video_tensor, grid_thw, second_per_grid_ts
 
-    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        num_base_retries = 3
-        num_final_retries = 30
-
-        # try the current sample first
-        for attempt_idx in range(num_base_retries):
-            try:
-                sample = self._get_item(i)
-                return sample
-            except Exception as e:
-                # sleep 1s in case it is a cloud disk issue
-                print(f"[Try #{attempt_idx}] Failed to fetch sample {i}. Exception:", e)
-                time.sleep(1)
-
-        # try other samples, in case it is file corruption issue
-        for attempt_idx in range(num_base_retries):
-            try:
-                next_index = min(i + 1, len(self.list_data_dict) - 1)
-                # sample_idx = random.choice(range(len(self)))
-                sample = self._get_item(next_index)
-                return sample
-            except Exception as e:
-                # no need to sleep
-                print(
-                    f"[Try other #{attempt_idx}] Failed to fetch sample {next_index}. Exception:",
-                    e,
-                )
-                pass
+    def preprocess(
+        self, i, sources, grid_thw=None, grid_thw_merged=None, visual_type="image"
+    ) -> Dict:
+        """Read pre-tokenized ids of sample `i`, tokenizing on the fly on a cache miss."""
+        source_id, row = self.sample_source[i], self.sample_row[i]
+        if self.token_caches[source_id] is not None:
+            cached = self.token_caches[source_id].get(row)
+            expected_grid_thw = torch.stack(grid_thw).tolist() if grid_thw else []
+            if cached is not None and cached["grid_thw"].tolist() == expected_grid_thw:
+                return dict(input_ids=cached["input_ids"], labels=cached["labels"])
+        sources = copy.deepcopy([e["conversations"] for e in sources])
+        return preprocess_qwen_2_visual(
+            sources, self.tokenizer, grid_thw=grid_thw_merged, visual_type=visual_type
+        )
 
-        try:
-            sample = self._get_item(i)
-            return sample
-        except Exception as e:
-            raise e
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        # known-bad samples are skipped without touching their files; a sample whose
+        # media fails is counted for every worker and replaced by a similar one,
+        # any other error is raised
+        self._print_cache_stats_at_exit()
+        error = None
+        for attempt in range(MAX_SAMPLE_REPLACEMENTS):
+            if not self.failure_registry.is_bad(i):
+                try:
+                    return self._get_item(i)
+                except Exception as e:
+                    if not self.failure_registry.record(i, e):
+                        raise
+                    error = e
+            i = self.failure_registry.replacement(i, attempt)
+        raise RuntimeError(
+            f"no loadable sample found after {MAX_SAMPLE_REPLACEMENTS} replacements"
+        ) from error
 
     def _get_item(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        sample = self.list_data_dict[i]
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
         video = None
         if "image" in sources[0]:
-            image_folder = self.list_data_dict[i]["data_path"]
-            image_file = self.list_data_dict[i]["image"]
+            image_folder = sample["data_path"]
+            image_file = sample["image"]
             if isinstance(image_file, List):
                 if len(image_file) > 1:
                     image_file = [
@@ -329,9 +508,8 @@ class LazySupervisedDataset(Dataset):
                 merged_thw.prod() // self.data_args.image_processor.merge_size**2
                 for merged_thw in grid_thw_merged
             ]
-            sources = copy.deepcopy([e["conversations"] for e in sources])
-            data_dict = preprocess_qwen_2_visual(
-                sources, self.tokenizer, grid_thw=grid_thw_merged, visual_type="image"
+            data_dict = self.preprocess(
+                i, sources, grid_thw, grid_thw_merged, visual_type="image"
             )
             position_ids, _ = self.get_rope_index(
                 self.data_args.image_processor.merge_size,
@@ -339,8 +517,8 @@ class LazySupervisedDataset(Dataset):
                 torch.stack(grid_thw, dim=0),
             )
         elif "video" in sources[0]:
-            video_file = self.list_data_dict[i]["video"]
-            video_folder = self.list_data_dict[i]["data_path"]
+            video_file = sample["video"]
+            video_folder = sample["data_path"]
             if isinstance(video_file, List):
                 if len(video_file) > 1:
                     video_file = [
@@ -365,9 +543,8 @@ class LazySupervisedDataset(Dataset):
                 merged_thw.prod() // self.data_args.image_processor.merge_size**2
                 for merged_thw in grid_thw_merged
             ]
-            sources = copy.deepcopy([e["conversations"] for e in sources])
-            data_dict = preprocess_qwen_2_visual(
-                sources, self.tokenizer, grid_thw=grid_thw_merged, visual_type="video"
+            data_dict = self.preprocess(
+                i, sources, grid_thw, grid_thw_merged, visual_type="video"
             )
             position_ids, _ = self.get_rope_index(
                 self.data_args.image_processor.merge_size,
@@ -377,10 +554,7 @@ class LazySupervisedDataset(Dataset):
             )
         else:
             grid_thw_merged = None
-            sources = copy.deepcopy([e["conversations"] for e in sources])
-            data_dict = preprocess_qwen_2_visual(
-                sources, self.tokenizer, grid_thw=grid_thw_merged
-            )
+            data_dict = self.preprocess(i, sources, None, grid_thw_merged)
             position_ids = (
                 torch.arange(0, data_dict["input_ids"].size(1))
                 .view(1, -1)
@@ -395,11 +569,11 @@ class LazySupervisedDataset(Dataset):
                 position_ids=position_ids,
             )
 
-        if "image" in self.list_data_dict[i]:
+        if "image" in sample:
             data_dict["pixel_values"] = image
             data_dict["image_grid_thw"] = grid_thw
         # video exist in the data
-        elif "video" in self.list_data_dict[i]:
+        elif "video" in sample:
             data_dict["pixel_values_videos"] = video
             data_dict["video_grid_thw"] = grid_thw
 
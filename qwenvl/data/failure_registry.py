@@ -0,0 +1,277 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+from .annotations import file_signature
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_VERSION = 2
+# length buckets per doubling of the token count
+BUCKETS_PER_OCTAVE = 4
+MAX_ERROR_LENGTH = 1000
+# failures with a possibly transient OSError before a sample is skipped
+MAX_TRANSIENT_FAILURES = 3
+
+
+def bad_media_errors() -> Tuple[type, ...]:
+    """Exceptions meaning the media of a sample is missing or cannot be decoded."""
+    errors = [FileNotFoundError, UnidentifiedImageError, Image.DecompressionBombError]
+    try:
+        from decord._ffi.base import DECORDError
+
+        errors.append(DECORDError)
+    except ImportError:
+        pass
+    try:
+        import av
+
+        errors.append(av.FFmpegError)
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+def length_buckets(num_tokens: np.ndarray) -> np.ndarray:
+    return np.floor(
+        BUCKETS_PER_OCTAVE * np.log2(np.maximum(num_tokens, 1))
+    ).astype(np.int32)
+
+
+def registry_key(
+    annotation_paths: Sequence[str], source_sizes: Sequence[int], fingerprint: str = ""
+) -> str:
+    sources = [
+        [path, file_signature(path), int(size)]
+        for path, size in zip(annotation_paths, source_sizes)
+    ]
+    key = dict(sources=sources, fingerprint=fingerprint, version=REGISTRY_VERSION)
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:16]
+
+
+class FailureRegistry(object):
+    """Samples that failed to load, shared by every dataloader worker.
+
+    Only failures that say something about the sample are recorded: missing
+    or undecodable media (`bad_media_errors`) flag it at once, and any other
+    `OSError`, which may be transient, after `MAX_TRANSIENT_FAILURES`.
+    Everything else is the caller's to raise.
+
+    One byte per annotation record counts its failures. Without `registry_dir`
+    the counts live in an anonymous shared mapping, seen by workers forked
+    after the dataset was built. With `registry_dir` they live in a
+    memory-mapped file keyed on the annotation files and `fingerprint` (the
+    processing settings), so every rank on the filesystem and every later run
+    with the same annotations and settings sees them too. Each flagged sample
+    is also appended to a JSONL log with its exception: next to the counts,
+    or without `registry_dir` to a per-rank log in `log_dir` started afresh
+    by every run.
+
+    Records are flagged by `(source, row)`, not by dataset index, which
+    changes with the shuffle. A bad sample is replaced by a pick seeded by
+    its index from the samples of the same modality (with or without media)
+    and length bucket, then from the same modality, then from all samples.
+    """
+
+    def __init__(
+        self,
+        annotation_paths: Sequence[str],
+        source_sizes: Sequence[int],
+        sample_source: np.ndarray,
+        sample_row: np.ndarray,
+        num_tokens: np.ndarray,
+        has_media: np.ndarray,
+        registry_dir: Optional[str] = None,
+        fingerprint: str = "",
+        log_dir: Optional[str] = None,
+    ):
+        self.annotation_paths = list(annotation_paths)
+        self.source_offsets = np.concatenate(([0], np.cumsum(source_sizes))).astype(np.int64)
+        self.sample_source = sample_source
+        self.sample_row = sample_row
+        self.started = time.time()
+
+        # samples sorted by (modality, length bucket), so both are contiguous ranges
+        modality = has_media.astype(np.int32)
+        group = (modality << 16) | length_buckets(num_tokens)
+        self.order = np.argsort(group, kind="stable")
+        self.sorted_group = group[self.order]
+        self.group = group
+
+        num_records = max(int(self.source_offsets[-1]), 1)
+        self.flags_path = self.log_path = None
+        if registry_dir:
+            os.makedirs(registry_dir, exist_ok=True)
+            key = registry_key(self.annotation_paths, source_sizes, fingerprint)
+            prefix = os.path.join(registry_dir, f"sample_failures-{key}")
+            self.flags_path = f"{prefix}.flags"
+            self.log_path = f"{prefix}.jsonl"
+            fd = os.open(self.flags_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # idempotent, so ranks may race on it
+                if os.fstat(fd).st_size < num_records:
+                    os.ftruncate(fd, num_records)
+            finally:
+                os.close(fd)
+            self._flags = None
+        else:
+            self._flags = np.frombuffer(mmap.mmap(-1, num_records), dtype=np.uint8)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+                rank = int(os.environ.get("RANK", 0))
+                self.log_path = os.path.join(log_dir, f"sample_failures-rank{rank}.jsonl")
+                open(self.log_path, "w").close()
+        self.num_records = num_records
+
+    @property
+    def flags(self) -> np.ndarray:
+        if self._flags is None:
+            with open(self.flags_path, "r+b") as f:
+                self._flags = np.frombuffer(
+                    mmap.mmap(f.fileno(), self.num_records), dtype=np.uint8
+                )
+        return self._flags
+
+    def record_key(self, i: int) -> int:
+        return int(self.source_offsets[self.sample_source[i]] + self.sample_row[i])
+
+    def is_bad(self, i: int) -> bool:
+        return bool(self.flags[self.record_key(i)] >= MAX_TRANSIENT_FAILURES)
+
+    def record(self, i: int, error: Exception) -> bool:
+        """Count a failure of sample `i`; False if `error` is not one the registry handles."""
+        key = self.record_key(i)
+        if isinstance(error, bad_media_errors()):
+            failures = MAX_TRANSIENT_FAILURES
+        elif isinstance(error, OSError):
+            # racing workers may lose an increment, which only delays the flag
+            failures = min(int(self.flags[key]) + 1, MAX_TRANSIENT_FAILURES)
+        else:
+            return False
+        if self.flags[key] >= MAX_TRANSIENT_FAILURES:
+            return True
+        self.flags[key] = failures
+        source, row = int(self.sample_source[i]), int(self.sample_row[i])
+        message = f"{type(error).__name__}: {error}"[:MAX_ERROR_LENGTH]
+        if failures < MAX_TRANSIENT_FAILURES:
+            logger.warning(
+                f"Sample {row} of {self.annotation_paths[source]} failed "
+                f"({failures}/{MAX_TRANSIENT_FAILURES}): {message}"
+            )
+            return True
+        logger.warning(
+            f"Skipping sample {row} of {self.annotation_paths[source]} from now on: {message}"
+        )
+        if self.log_path is not None:
+            entry = dict(
+                source=source,
+                row=row,
+                annotation_path=self.annotation_paths[source],
+                error=message,
+                time=time.time(),
+                pid=os.getpid(),
+            )
+            # a single O_APPEND write, so lines from concurrent workers do not interleave
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+        return True
+
+    def replacement(self, i: int, attempt: int) -> int:
+        """Index to load instead of the bad sample `i` on the `attempt`-th try."""
+        rng = np.random.default_rng([i, attempt])
+        group = self.group[i]
+        if attempt < 8:
+            lo, hi = np.searchsorted(self.sorted_group, [group, group + 1])
+        elif attempt < 16:
+            modality = group >> 16
+            lo, hi = np.searchsorted(
+                self.sorted_group, [modality << 16, (modality + 1) << 16]
+            )
+        else:
+            lo, hi = 0, len(self.order)
+        return int(self.order[lo + rng.integers(hi - lo)])
+
+    def flagged(self) -> List[Dict]:
+        """Every sample flagged bad, with the first logged exception if there is a log."""
+        entries = {}
+        if self.log_path is not None and os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    entries.setdefault((entry["source"], entry["row"]), entry)
+        samples = []
+        for key in np.flatnonzero(self.flags >= MAX_TRANSIENT_FAILURES).tolist():
+            source = int(np.searchsorted(self.source_offsets, key, side="right") - 1)
+            row = key - int(self.source_offsets[source])
+            entry = entries.get((source, row), {})
+            samples.append(
+                dict(
+                    source=source,
+                    row=row,
+                    error=entry.get("error"),
+                    first_seen=entry.get("time"),
+                )
+            )
+        return samples
+
+    def report(self, flagged: Optional[List[Dict]] = None) -> Dict:
+        """Summary of the `flagged()` samples, or of `flagged` gathered from several ranks.
+
+        A sample flagged more than once keeps its earliest logged exception.
+        """
+        by_record = {}
+        for sample in self.flagged() if flagged is None else flagged:
+            record = (sample["source"], sample["row"])
+            seen = by_record.get(record)
+            if seen is None or (
+                sample["first_seen"] is not None
+                and (seen["first_seen"] is None or sample["first_seen"] < seen["first_seen"])
+            ):
+                by_record[record] = sample
+        samples = [
+            dict(
+                annotation_path=self.annotation_paths[source],
+                row=row,
+                error=sample["error"],
+                first_seen=sample["first_seen"],
+            )
+            for (source, row), sample in sorted(by_record.items())
+        ]
+        per_source = {path: 0 for path in self.annotation_paths}
+        for sample in samples:
+            per_source[sample["annotation_path"]] += 1
+        return dict(
+            num_skipped=len(samples),
+            num_new=sum(
+                1
+                for sample in samples
+                if sample["first_seen"] is not None and sample["first_seen"] >= self.started
+            ),
+            per_source=per_source,
+            samples=samples,
+        )
+
+    def write_report(self, path: str, flagged: Optional[List[Dict]] = None) -> Dict:
+        report = self.report(flagged)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.flags_path is not None:
+            state["_flags"] = None
+        return state
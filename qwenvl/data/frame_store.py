@@ -0,0 +1,306 @@
+import os
+import json
+import fcntl
+import hashlib
+import multiprocessing
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+from .annotations import file_signature
+
+STORE_VERSION = 1
+CHUNK_BYTES = 1 << 30
+INDEX_NAME = "index.jsonl"
+
+
+def store_settings(data_args) -> Dict:
+    """Every setting that changes the frames `process_video` samples and resizes."""
+    image_processor = data_args.image_processor
+    return dict(
+        base_interval=getattr(data_args, "base_interval", 4),
+        video_min_frames=getattr(data_args, "video_min_frames", 4),
+        video_max_frames=getattr(data_args, "video_max_frames", 8),
+        video_min_frame_pixels=data_args.video_min_frame_pixels,
+        video_max_frame_pixels=data_args.video_max_frame_pixels,
+        patch_size=image_processor.patch_size,
+        merge_size=image_processor.merge_size,
+        temporal_patch_size=image_processor.temporal_patch_size,
+        resample=int(image_processor.resample),
+        version=STORE_VERSION,
+    )
+
+
+def store_path(store_dir: str, data_args) -> str:
+    key = hashlib.sha256(
+        json.dumps(store_settings(data_args), sort_keys=True).encode()
+    ).hexdigest()[:16]
+    return os.path.join(store_dir, key)
+
+
+def video_key(video_file: str) -> str:
+    """Entries are looked up by path and file version, so a replaced video is extracted again."""
+    return f"{os.path.abspath(video_file)}:{file_signature(video_file)}"
+
+
+def extract_frames(video_file: str, data_args) -> Tuple[np.ndarray, np.ndarray, float]:
+    """`(frame_idx, frames, fps)` of a video as `process_video` samples them.
+
+    Frames are resized with PIL to their `smart_resize` size the way the
+    image processor does, so its own resize of a stored frame is a copy.
+    """
+    from decord import VideoReader
+
+    from .data_qwen import video_frame_indices
+
+    image_processor = data_args.image_processor
+    vr = VideoReader(video_file, num_threads=1)
+    total_frames = len(vr)
+    avg_fps = vr.get_avg_fps()
+    frame_idx = video_frame_indices(total_frames, avg_fps, data_args)
+    video = vr.get_batch(frame_idx).asnumpy()
+    height, width = smart_resize(
+        video.shape[1],
+        video.shape[2],
+        factor=image_processor.patch_size * image_processor.merge_size,
+        min_pixels=data_args.video_min_frame_pixels,
+        max_pixels=data_args.video_max_frame_pixels,
+    )
+    frames = np.empty((len(video), height, width, 3), dtype=np.uint8)
+    for t, frame in enumerate(video):
+        frames[t] = np.asarray(
+            Image.fromarray(frame).resize(
+                (width, height), resample=image_processor.resample
+            )
+        )
+    fps = len(frame_idx) / (total_frames / avg_fps)
+    return frame_idx, frames, fps
+
+
+class FrameStore(object):
+    """Sampled, resized video frames extracted offline, read by memory-mapping.
+
+    The store directory is keyed on `store_settings`. Frames of all videos
+    are appended as raw uint8 to chunk files of about `CHUNK_BYTES`; an
+    append-only `index.jsonl` gives the chunk, byte offset, shape, sampled
+    fps and `second_per_grid_ts` of each video. A video's frames are written
+    and flushed before its index line, so readers never see a partial entry,
+    and `add` only extracts videos missing from the index. The index is read
+    once per process; videos extracted after that are decoded as usual.
+    """
+
+    def __init__(self, store_dir: str, data_args):
+        self.data_args = data_args
+        self.path = store_path(store_dir, data_args)
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._chunks = {}
+
+    @property
+    def entries(self) -> Dict[str, Dict]:
+        if self._entries is None:
+            self._entries = self._read_index()
+        return self._entries
+
+    def _read_index(self) -> Dict[str, Dict]:
+        entries = {}
+        try:
+            with open(os.path.join(self.path, INDEX_NAME), "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by a killed writer
+                    entries[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.path, f"chunk-{chunk:05d}.u8")
+
+    def _chunk(self, chunk: int) -> np.ndarray:
+        data = self._chunks.get(chunk)
+        if data is None:
+            data = self._chunks[chunk] = np.memmap(
+                self._chunk_path(chunk), dtype=np.uint8, mode="r"
+            )
+        return data
+
+    def get(self, video_file: str) -> Optional[Tuple[np.ndarray, Dict]]:
+        """`(frames, entry)` of a stored video, frames as a read-only `(T, H, W, 3)` view."""
+        try:
+            entry = self.entries.get(video_key(video_file))
+        except OSError:
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        shape = entry["shape"]
+        offset = entry["offset"]
+        frames = self._chunk(entry["chunk"])[offset : offset + int(np.prod(shape))]
+        self.hits += 1
+        return frames.reshape(shape), entry
+
+    def add(self, video_files: Iterable[str], num_workers: Optional[int] = None) -> Dict:
+        """Extract the videos not in the store yet on a pool of processes.
+
+        One writer at a time holds a lock on the store; the decoding is
+        parallel, the appends are not.
+        """
+        from .data_qwen import rank0_print
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "settings.json"), "w") as f:
+            json.dump(store_settings(self.data_args), f, indent=2)
+        stats = dict(stored=0, added=0, failed=[])
+        with open(os.path.join(self.path, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._entries = self._read_index()
+            todo, seen = [], set()
+            for video_file in video_files:
+                try:
+                    key = video_key(video_file)
+                except OSError as e:
+                    stats["failed"].append(dict(file=video_file, error=f"{type(e).__name__}: {e}"))
+                    continue
+                if key in seen:
+                    continue
+                seen.add(key)
+                if key in self._entries:
+                    stats["stored"] += 1
+                else:
+                    todo.append(video_file)
+            rank0_print(f"Extracting frames of {len(todo)} videos into {self.path}")
+            num_workers = min(num_workers or os.cpu_count() or 1, max(len(todo), 1))
+            if num_workers <= 1:
+                _init_worker(self.data_args)
+                results = map(_extract, todo)
+                self._append(results, stats)
+            else:
+                with multiprocessing.Pool(
+                    num_workers, initializer=_init_worker, initargs=(self.data_args,)
+                ) as pool:
+                    self._append(pool.imap_unordered(_extract, todo), stats)
+        self._chunks = {}
+        return stats
+
+    def _append(self, results, stats: Dict):
+        chunks = sorted(
+            int(name[6:11]) for name in os.listdir(self.path) if name.startswith("chunk-")
+        )
+        chunk = chunks[-1] if chunks else 0
+        temporal_patch_size = self.data_args.image_processor.temporal_patch_size
+        index_fd = os.open(
+            os.path.join(self.path, INDEX_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        try:
+            for video_file, key, result in results:
+                if isinstance(result, str):
+                    stats["failed"].append(dict(file=video_file, error=result))
+                    continue
+                frame_idx, frames, fps = result
+                chunk_path = self._chunk_path(chunk)
+                if os.path.exists(chunk_path) and os.path.getsize(chunk_path) >= CHUNK_BYTES:
+                    chunk += 1
+                    chunk_path = self._chunk_path(chunk)
+                with open(chunk_path, "ab") as f:
+                    # bytes left behind by a killed writer are skipped, not reused
+                    offset = f.tell()
+                    f.write(frames.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                entry = dict(
+                    key=key,
+                    chunk=chunk,
+                    offset=offset,
+                    shape=list(frames.shape),
+                    frame_idx=frame_idx.tolist(),
+                    fps=fps,
+                    second_per_grid_ts=temporal_patch_size / fps,
+                )
+                os.write(index_fd, (json.dumps(entry) + "\n").encode("utf-8"))
+                self._entries[key] = entry
+                stats["added"] += 1
+        finally:
+            os.close(index_fd)
+
+    def __getstate__(self):
+        # memory maps are reopened by each dataloader worker
+        state = self.__dict__.copy()
+        state["_chunks"] = {}
+        return state
+
+
+_worker_state = {}
+
+
+def _init_worker(data_args):
+    _worker_state["data_args"] = data_args
+
+
+def _extract(video_file: str):
+    try:
+        key = video_key(video_file)
+        return video_file, key, extract_frames(video_file, _worker_state["data_args"])
+    except Exception as e:
+        return video_file, None, f"{type(e).__name__}: {e}"
+
+
+def annotation_videos(annotations) -> List[str]:
+    """Paths of every video referenced by an annotation file, as `_get_item` joins them."""
+    video_files = []
+    for sample in annotations:
+        files = sample.get("video")
+        if files is None:
+            continue
+        if not isinstance(files, list):
+            files = [files]
+        video_files.extend(os.path.join(sample["data_path"], file) for file in files)
+    return video_files
+
+
+if __name__ == "__main__":
+    from dataclasses import dataclass, field
+
+    from transformers import AutoProcessor, HfArgumentParser
+
+    import qwenvl.data.data_qwen as data_qwen
+    from qwenvl.data import data_list
+    from qwenvl.data.annotations import load_annotations
+    from qwenvl.train.argument import ModelArguments, DataArguments
+
+    @dataclass
+    class ExtractionArguments:
+        num_workers: Optional[int] = field(
+            default=None, metadata={"help": "Decoding processes. Defaults to all CPUs."}
+        )
+
+    parser = HfArgumentParser((ModelArguments, DataArguments, ExtractionArguments))
+    model_args, data_args, extraction_args = parser.parse_args_into_dataclasses()
+    if data_args.video_frame_store_dir is None:
+        raise ValueError("--video_frame_store_dir is required to extract frames")
+    data_qwen.local_rank = 0
+    data_args.image_processor = AutoProcessor.from_pretrained(
+        model_args.model_name_or_path
+    ).image_processor
+    video_files = []
+    for data in data_list(data_args.dataset_use.split(",")):
+        video_files.extend(
+            annotation_videos(
+                load_annotations(
+                    data["annotation_path"], data["data_path"], data_args.annotation_cache_dir
+                )
+            )
+        )
+    store = FrameStore(data_args.video_frame_store_dir, data_args)
+    stats = store.add(video_files, num_workers=extraction_args.num_workers)
+    print(
+        f"{stats['added']} videos added, {stats['stored']} already stored, "
+        f"{len(stats['failed'])} failed, at {store.path}"
+    )
+    for failure in stats["failed"][:5]:
+        print(f"  - {failure['file']}: {failure['error']}")
@@ -0,0 +1,313 @@
+import os
+import copy
+import itertools
+import multiprocessing
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import transformers
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+from .annotations import find_sidecar, publish_sidecar
+from .token_cache import image_grid_thw, token_cache_key
+
+
+def video_grid_thw(video_file: str, data_args) -> List[int]:
+    """Grid of a video as produced by `LazySupervisedDataset.process_video`.
+
+    Only the container metadata and the first frame are read.
+    """
+    from decord import VideoReader
+
+    from .data_qwen import video_frame_indices
+
+    image_processor = data_args.image_processor
+    vr = VideoReader(video_file, num_threads=1)
+    height, width = vr[0].shape[:2]
+    num_frames = len(video_frame_indices(len(vr), vr.get_avg_fps(), data_args))
+    resized_height, resized_width = smart_resize(
+        height,
+        width,
+        factor=image_processor.patch_size * image_processor.merge_size,
+        min_pixels=data_args.video_min_frame_pixels,
+        max_pixels=data_args.video_max_frame_pixels,
+    )
+    temporal_patch_size = image_processor.temporal_patch_size
+    return [
+        (num_frames + temporal_patch_size - 1) // temporal_patch_size,
+        resized_height // image_processor.patch_size,
+        resized_width // image_processor.patch_size,
+    ]
+
+
+def sample_grid_thw(sample: Dict, data_args) -> List[List[int]]:
+    """Grids of all images or videos of an annotation, without decoding pixels."""
+    image_processor = data_args.image_processor
+    if "image" in sample:
+        files = sample["image"]
+        probe = lambda file: image_grid_thw(
+            file,
+            image_processor.patch_size,
+            image_processor.merge_size,
+            data_args.min_pixels,
+            data_args.max_pixels,
+        )
+    elif "video" in sample:
+        files = sample["video"]
+        probe = lambda file: video_grid_thw(file, data_args)
+    else:
+        return []
+    if not isinstance(files, list):
+        files = [files]
+    return [probe(os.path.join(sample["data_path"], file)) for file in files]
+
+
+def sample_num_tokens(
+    sample: Dict, tokenizer: transformers.PreTrainedTokenizer, data_args
+) -> int:
+    """Exact number of tokens (text plus vision) the dataset produces for `sample`.
+
+    Media that cannot be probed count as zero vision tokens.
+    """
+    from .data_qwen import preprocess_qwen_2_visual
+
+    merge_size = data_args.image_processor.merge_size
+    visual_type = "video" if "video" in sample else "image"
+    num_media = sum(
+        conv.get("value", conv.get("content", "")).count(f"<{visual_type}>")
+        for conv in sample["conversations"]
+        if conv.get("from", conv.get("role")) in ("human", "user")
+    )
+    try:
+        grid_thw_merged = [
+            int(np.prod(thw)) // merge_size**2
+            for thw in sample_grid_thw(sample, data_args)
+        ]
+    except Exception:
+        grid_thw_merged = []
+    if len(grid_thw_merged) != num_media:
+        grid_thw_merged = [0] * num_media
+    data_dict = preprocess_qwen_2_visual(
+        copy.deepcopy([sample["conversations"]]),
+        tokenizer,
+        grid_thw=grid_thw_merged,
+        visual_type=visual_type,
+    )
+    return data_dict["input_ids"].shape[1]
+
+
+_worker_state = {}
+
+
+def _init_worker(tokenizer, data_args):
+    _worker_state["tokenizer"] = tokenizer
+    _worker_state["data_args"] = data_args
+
+
+def _count_tokens(samples: List[Dict]) -> List[int]:
+    counts = []
+    for sample in samples:
+        try:
+            count = sample_num_tokens(
+                sample, _worker_state["tokenizer"], _worker_state["data_args"]
+            )
+        except Exception:
+            # malformed record (no "conversations", unexpected types, ...);
+            # loading it fails later and is handled there
+            count = -1
+        counts.append(count)
+    return counts
+
+
+def build_length_index(
+    samples: List[Dict],
+    tokenizer: transformers.PreTrainedTokenizer,
+    data_args,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 256,
+) -> np.ndarray:
+    """Compute `sample_num_tokens` of every sample on a pool of processes.
+
+    Malformed samples count as 0 tokens.
+    """
+    from .data_qwen import rank0_print
+
+    chunks = [
+        samples[i : i + chunk_size] for i in range(0, len(samples), chunk_size)
+    ]
+    num_workers = min(num_workers or os.cpu_count() or 1, len(chunks))
+    if num_workers <= 1:
+        _init_worker(tokenizer, data_args)
+        counts = [_count_tokens(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(
+            num_workers, initializer=_init_worker, initargs=(tokenizer, data_args)
+        ) as pool:
+            counts = pool.map(_count_tokens, chunks)
+    num_tokens = np.fromiter(
+        itertools.chain.from_iterable(counts), dtype=np.int64, count=len(samples)
+    )
+    malformed = num_tokens < 0
+    if malformed.any():
+        rank0_print(f"{int(malformed.sum())} malformed samples counted as 0 tokens")
+        num_tokens[malformed] = 0
+    return num_tokens
+
+
+def estimate_num_tokens(annotations: List[Dict], token_cache=None) -> np.ndarray:
+    """Approximate token counts: the words of the conversation plus 128 per image sample.
+
+    Rows pre-tokenized in `token_cache` are exact. Malformed records count as 0 tokens.
+    """
+    num_tokens = np.zeros(len(annotations), dtype=np.int64)
+    todo = range(len(annotations))
+    if token_cache is not None:
+        num_tokens[token_cache.valid] = np.diff(token_cache.offsets)[token_cache.valid]
+        todo = np.flatnonzero(~token_cache.valid).tolist()
+    for i in todo:
+        sample = annotations[i]
+        try:
+            num_tokens[i] = sum(
+                len(conv.get("value", conv.get("content", "")).split())
+                for conv in sample["conversations"]
+            ) + (128 if "image" in sample else 0)
+        except Exception:
+            pass
+    return num_tokens
+
+
+def length_index_suffix(
+    annotation_path: str, tokenizer: transformers.PreTrainedTokenizer, data_args
+) -> str:
+    """Suffix of the length index sidecar, keyed like the token cache plus video settings."""
+    from .data_qwen import CHAT_TEMPLATE
+
+    image_processor = data_args.image_processor
+    key = token_cache_key(
+        annotation_path,
+        tokenizer,
+        CHAT_TEMPLATE,
+        min_pixels=data_args.min_pixels,
+        max_pixels=data_args.max_pixels,
+        patch_size=image_processor.patch_size,
+        merge_size=image_processor.merge_size,
+        extra=dict(
+            temporal_patch_size=image_processor.temporal_patch_size,
+            video_min_frame_pixels=data_args.video_min_frame_pixels,
+            video_max_frame_pixels=data_args.video_max_frame_pixels,
+            base_interval=getattr(data_args, "base_interval", 4),
+            video_min_frames=getattr(data_args, "video_min_frames", 4),
+            video_max_frames=getattr(data_args, "video_max_frames", 8),
+        ),
+    )
+    return f".lengths-{key[:16]}.npy"
+
+
+def load_length_index(
+    annotation_path: str,
+    annotations: List[Dict],
+    tokenizer: transformers.PreTrainedTokenizer,
+    data_args,
+    token_cache=None,
+    build: bool = False,
+) -> np.ndarray:
+    """Token count of every annotation in file order, read from (or with `build` written to) a sidecar.
+
+    The sidecar is stored like the annotation index, see `annotations.sidecar_dirs`.
+    Rows already pre-tokenized in `token_cache` are read from it. Without
+    `build`, a missing index is replaced by `estimate_num_tokens`, since
+    building it at startup can outlast the distributed timeout; build it
+    offline with `python -m qwenvl.data.length_index`.
+    """
+    from .data_qwen import rank0_print
+
+    suffix = length_index_suffix(annotation_path, tokenizer, data_args)
+    cache_dir = getattr(data_args, "annotation_cache_dir", None)
+    if not build:
+        path = find_sidecar(annotation_path, suffix, cache_dir)
+        if path is None:
+            rank0_print(
+                f"No length index for {annotation_path}, estimating sample lengths from word counts; "
+                "build it with `python -m qwenvl.data.length_index` for exact token counts"
+            )
+            return estimate_num_tokens(annotations, token_cache)
+        num_tokens = np.load(path)
+        if len(num_tokens) != len(annotations):
+            raise ValueError(
+                f"length index {path} has {len(num_tokens)} rows but {annotation_path} has {len(annotations)}"
+            )
+        return num_tokens
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+
+    def build() -> np.ndarray:
+        rank0_print(f"Building length index for {annotation_path}")
+        num_tokens = np.zeros(len(annotations), dtype=np.int64)
+        todo = np.arange(len(annotations))
+        if token_cache is not None:
+            num_tokens[token_cache.valid] = np.diff(token_cache.offsets)[
+                token_cache.valid
+            ]
+            todo = np.flatnonzero(~token_cache.valid)
+        num_tokens[todo] = build_length_index(
+            [annotations[i] for i in todo],
+            tokenizer,
+            data_args,
+            num_workers=getattr(data_args, "length_index_num_workers", None),
+        )
+        return num_tokens
+
+    num_tokens = None
+    path = find_sidecar(annotation_path, suffix, cache_dir)
+    if path is None and int(os.environ.get("LOCAL_RANK", 0)) == 0:
+        num_tokens = build()
+        try:
+            path = publish_sidecar(
+                annotation_path, suffix, lambda f: np.save(f, num_tokens), cache_dir
+            )
+        except OSError as e:
+            rank0_print(f"Could not write the length index of {annotation_path}: {e}")
+    if distributed:
+        torch.distributed.barrier()
+    if num_tokens is None:
+        path = find_sidecar(annotation_path, suffix, cache_dir)
+        # every rank builds its own when the index could not be written anywhere
+        num_tokens = np.load(path) if path is not None else build()
+    if len(num_tokens) != len(annotations):
+        raise ValueError(
+            f"length index {path} has {len(num_tokens)} rows but {annotation_path} has {len(annotations)}"
+        )
+    return num_tokens
+
+
+if __name__ == "__main__":
+    from transformers import AutoProcessor, HfArgumentParser
+
+    from qwenvl.data import data_list
+    from qwenvl.data.annotations import load_annotations
+    from qwenvl.data.token_cache import load_token_cache
+    from qwenvl.train.argument import ModelArguments, DataArguments
+
+    parser = HfArgumentParser((ModelArguments, DataArguments))
+    model_args, data_args = parser.parse_args_into_dataclasses()
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_args.model_name_or_path, use_fast=False
+    )
+    data_args.image_processor = AutoProcessor.from_pretrained(
+        model_args.model_name_or_path
+    ).image_processor
+    for data in data_list(data_args.dataset_use.split(",")):
+        annotations = load_annotations(
+            data["annotation_path"], data["data_path"], data_args.annotation_cache_dir
+        )
+        cache = None
+        if data_args.token_cache_dir is not None:
+            cache = load_token_cache(
+                data["annotation_path"], annotations, data["data_path"], tokenizer, data_args
+            )
+        num_tokens = load_length_index(
+            data["annotation_path"], annotations, tokenizer, data_args, cache, build=True
+        )
+        print(
+            f"{data['annotation_path']}: {len(num_tokens)} samples, {int(num_tokens.sum())} tokens"
+        )
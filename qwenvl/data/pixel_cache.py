@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+from .token_cache import file_sha256
+
+CACHE_VERSION = 1
+
+
+def processor_fingerprint(image_processor) -> str:
+    """Hash every setting of the image processor that changes `pixel_values`."""
+    settings = image_processor.to_dict()
+    settings["version"] = CACHE_VERSION
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+class PixelCache(object):
+    """On-disk cache of preprocessed `pixel_values` and `image_grid_thw`.
+
+    Entries are addressed by the sha256 of the image file plus the processor
+    settings and stored as one `.npy` shard each, which readers memory-map
+    instead of copying. Shards are published with an atomic rename, so any
+    number of dataloader workers can share a cache directory. Reads refresh
+    the shard mtime and, once the directory grows past `max_bytes`, the least
+    recently used shards are deleted.
+    """
+
+    def __init__(self, cache_dir: str, image_processor, max_bytes: int):
+        self.path = os.path.join(cache_dir, processor_fingerprint(image_processor))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._written = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _digest(self, image_file: str) -> str:
+        # hashed on every lookup rather than remembered per path and mtime, which miss
+        # in-place rewrites; reading the file costs little next to decoding it
+        return file_sha256(image_file)
+
+    def _shard(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], f"{digest}.npy")
+
+    def get(self, image_file: str) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        shard = self._shard(self._digest(image_file))
+        try:
+            grid_thw = np.load(f"{shard[:-4]}.thw.npy")
+            pixel_values = np.load(shard, mmap_mode="c")
+            os.utime(shard)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.from_numpy(pixel_values), torch.from_numpy(grid_thw)
+
+    def put(self, image_file: str, pixel_values: torch.Tensor, grid_thw: torch.Tensor):
+        shard = self._shard(self._digest(image_file))
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        pixel_values = pixel_values.numpy()
+        for path, array in (
+            (f"{shard[:-4]}.thw.npy", grid_thw.numpy()),
+            (shard, pixel_values),
+        ):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+            except OSError:
+                # full disk or read-only cache: training goes on uncached
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return
+        self._written += pixel_values.nbytes
+        # every process rescans after writing a slice of the budget
+        if self._written > self.max_bytes // 16:
+            self._written = 0
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used shards until the cache is under 90% of `max_bytes`."""
+        shards = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(".npy") and not name.endswith(".thw.npy"):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    shards.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        total = sum(size for _, size, _ in shards)
+        if total <= self.max_bytes:
+            return
+        for _, size, shard in sorted(shards):
+            for path in (shard, f"{shard[:-4]}.thw.npy"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            if total <= self.max_bytes * 0.9:
+                break
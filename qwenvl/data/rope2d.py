@@ -1,23 +1,249 @@
-import os
-import copy
-import json
-import random
-import logging
-import re
-import time
-import math
-import ast
-from dataclasses import dataclass, field
-from typing import Dict, Optional, Sequence, List, Tuple
-from io import BytesIO
-import base64
-
-import numpy as np
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
 import torch
-from torch.utils.data import Dataset
-from PIL import Image
-from decord import VideoReader
-import transformers
+
+
+class RopeTemplateCache(object):
+    """Bounded LRU cache of the (t, h, w) position block of a vision span.
+
+    Most samples share a handful of grid shapes, so the block is built once per
+    `(t, h, w, spatial_merge_size, second_per_grid_t)` and reused by offsetting it.
+    `hits` and `misses` count lookups in the current process (dataloader worker).
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self,
+        grid_t: int,
+        grid_h: int,
+        grid_w: int,
+        spatial_merge_size: int,
+        second_per_grid_t: Optional[float] = None,
+        time_dtype: torch.dtype = torch.float32,
+    ) -> Tuple[torch.Tensor, int]:
+        """Return the `(3, num_tokens)` position block and its extent (max position + 1).
+
+        `second_per_grid_t=None` gives Qwen2-VL temporal indices, otherwise the
+        Qwen2.5-VL ones scaled by `second_per_grid_t * 2`, computed in `time_dtype`.
+        """
+        key = (
+            grid_t,
+            grid_h,
+            grid_w,
+            spatial_merge_size,
+            second_per_grid_t,
+            None if second_per_grid_t is None else time_dtype,
+        )
+        template = self.templates.get(key)
+        if template is not None:
+            self.hits += 1
+            self.templates.move_to_end(key)
+            return template
+        self.misses += 1
+
+        llm_grid_t, llm_grid_h, llm_grid_w = (
+            grid_t,
+            grid_h // spatial_merge_size,
+            grid_w // spatial_merge_size,
+        )
+        t_index = (
+            torch.arange(llm_grid_t).view(-1, 1).expand(-1, llm_grid_h * llm_grid_w)
+        )
+        if second_per_grid_t is not None:
+            t_index = (
+                t_index * torch.tensor(second_per_grid_t, dtype=time_dtype) * 2
+            ).long()
+        h_index = (
+            torch.arange(llm_grid_h).view(1, -1, 1).expand(llm_grid_t, -1, llm_grid_w)
+        )
+        w_index = (
+            torch.arange(llm_grid_w).view(1, 1, -1).expand(llm_grid_t, llm_grid_h, -1)
+        )
+        positions = torch.stack(
+            [t_index.flatten(), h_index.flatten(), w_index.flatten()]
+        )
+        template = (positions, int(positions.max()) + 1 if positions.numel() else 0)
+
+        self.templates[key] = template
+        if len(self.templates) > self.maxsize:
+            self.templates.popitem(last=False)
+        return template
+
+    def info(self) -> Dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self.templates),
+            maxsize=self.maxsize,
+        )
+
+    def clear(self):
+        self.templates.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+rope_template_cache = RopeTemplateCache()
+
+
+def _get_rope_index(
+    spatial_merge_size: int,
+    input_ids: Optional[torch.LongTensor],
+    image_grid_thw: Optional[torch.LongTensor],
+    video_grid_thw: Optional[torch.LongTensor],
+    second_per_grid_ts: Optional[torch.Tensor],
+    attention_mask: Optional[torch.Tensor],
+    cu_seqlens: Optional[torch.Tensor],
+    scale_time: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Shared implementation of `get_rope_index_25` (`scale_time=True`) and `get_rope_index_2`."""
+    image_token_id = 151655
+    video_token_id = 151656
+    vision_start_token_id = 151652
+    if input_ids is not None and (
+        image_grid_thw is not None
+        or video_grid_thw is not None
+        or cu_seqlens is not None
+    ):
+        device = input_ids.device
+        batch_size, seq_length = input_ids.shape
+        if cu_seqlens is not None:
+            # packed input: one row holding several sequences back to back
+            assert batch_size == 1, "packed inputs must be a single row"
+            cu_seqlens = cu_seqlens.to(device=device, dtype=torch.long)
+            valid_index = torch.arange(seq_length, device=device)
+            segment_ids = torch.searchsorted(cu_seqlens[1:], valid_index, right=True)
+            segment_lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+        else:
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            attention_mask = attention_mask.to(device)
+            valid_index = torch.nonzero(attention_mask.reshape(-1) == 1).squeeze(1)
+            segment_ids = valid_index // seq_length
+            segment_lengths = torch.full(
+                (batch_size,), seq_length, dtype=torch.long, device=device
+            )
+        num_segments = segment_lengths.numel()
+        tokens = input_ids.reshape(-1)[valid_index]
+
+        # Every token advances the position of the next one: text tokens by 1,
+        # a vision span by the extent of its (t, h, w) block, all of it on the
+        # last token of the span. Positions are the exclusive cumsum of that.
+        increments = torch.ones_like(tokens, dtype=torch.long)
+
+        # a vision span starts at the pad token that follows <|vision_start|>
+        span_start_mask = torch.zeros_like(tokens, dtype=torch.bool)
+        span_start_mask[1:] = (
+            (tokens[:-1] == vision_start_token_id)
+            & (segment_ids[:-1] == segment_ids[1:])
+            & ((tokens[1:] == image_token_id) | (tokens[1:] == video_token_id))
+        )
+        span_starts = torch.nonzero(span_start_mask).squeeze(1)
+        num_spans = span_starts.numel()
+        if num_spans > 0:
+            span_is_image = (tokens[span_starts] == image_token_id).tolist()
+            image_grids = iter(
+                image_grid_thw.tolist() if image_grid_thw is not None else []
+            )
+            video_grids = iter(
+                video_grid_thw.tolist() if video_grid_thw is not None else []
+            )
+            time_dtype = torch.get_default_dtype()
+            if isinstance(second_per_grid_ts, torch.Tensor):
+                if second_per_grid_ts.is_floating_point():
+                    time_dtype = second_per_grid_ts.dtype
+                second_per_grid_ts = second_per_grid_ts.tolist()
+
+            templates, span_lengths, span_extents = [], [], []
+            video_index = 0
+            for is_image in span_is_image:
+                if is_image:
+                    t, h, w = next(image_grids)
+                    second_per_grid_t = 0.0
+                else:
+                    t, h, w = next(video_grids)
+                    if second_per_grid_ts is not None:
+                        second_per_grid_t = float(second_per_grid_ts[video_index])
+                    else:
+                        second_per_grid_t = 1.0
+                    video_index += 1
+                template, extent = rope_template_cache.get(
+                    t,
+                    h,
+                    w,
+                    spatial_merge_size,
+                    second_per_grid_t if scale_time else None,
+                    time_dtype,
+                )
+                templates.append(template)
+                span_lengths.append(template.shape[1])
+                span_extents.append(extent)
+            vision_positions = torch.cat(templates, dim=1).to(device)
+            span_lengths = torch.tensor(span_lengths, device=device)
+            span_extents = torch.tensor(span_extents, device=device)
+
+            # flat index of every vision token
+            vision_index = span_starts.repeat_interleave(span_lengths) + (
+                torch.arange(vision_positions.shape[1], device=device)
+                - (torch.cumsum(span_lengths, 0) - span_lengths).repeat_interleave(
+                    span_lengths
+                )
+            )
+            increments[vision_index] = 0
+            increments[span_starts + span_lengths - 1] = span_extents
+
+        segment_totals = torch.zeros(
+            num_segments, dtype=torch.long, device=device
+        ).index_add_(0, segment_ids, increments)
+        segment_bases = torch.cumsum(segment_totals, 0) - segment_totals
+        positions = (
+            torch.cumsum(increments, 0) - increments - segment_bases[segment_ids]
+        )
+
+        llm_positions = positions.unsqueeze(0).repeat(3, 1)
+        if num_spans > 0:
+            llm_positions[:, vision_index] += vision_positions
+
+        position_ids = torch.ones(
+            3,
+            batch_size * seq_length,
+            dtype=input_ids.dtype,
+            device=device,
+        )
+        position_ids[:, valid_index] = llm_positions.to(position_ids.dtype)
+        position_ids = position_ids.view(3, batch_size, seq_length)
+        mrope_position_deltas = (segment_totals - segment_lengths).unsqueeze(1)
+        return position_ids, mrope_position_deltas
+    else:
+        if attention_mask is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = (
+                position_ids.unsqueeze(0).expand(3, -1, -1).to(attention_mask.device)
+            )
+            max_position_ids = position_ids.max(0, keepdim=False)[0].max(
+                -1, keepdim=True
+            )[0]
+            mrope_position_deltas = max_position_ids + 1 - attention_mask.shape[-1]
+        else:
+            position_ids = (
+                torch.arange(input_ids.shape[1], device=input_ids.device)
+                .view(1, 1, -1)
+                .expand(3, input_ids.shape[0], -1)
+            )
+            mrope_position_deltas = torch.zeros(
+                [input_ids.shape[0], 1],
+                device=input_ids.device,
+                dtype=input_ids.dtype,
+            )
+
+        return position_ids, mrope_position_deltas
 
 
 def get_rope_index_25(
@@ -27,6 +253,7 @@ def get_rope_index_25(
     video_grid_thw: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
     attention_mask: Optional[torch.Tensor] = None,
+    cu_seqlens: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Calculate the 3D rope index based on image and video's temporal, height and width in LLM.
@@ -76,159 +303,27 @@ def get_rope_index_25(
 
             - 1 for tokens that are **not masked**,
             - 0 for tokens that are **masked**.
+        cu_seqlens (`torch.Tensor` of shape `(num_sequences + 1)`, *optional*):
+            Cumulative sequence lengths of a packed `input_ids` of shape `(1, total_length)`. Positions restart at
+            0 for every sequence and `attention_mask` is ignored.
+
+    All vision spans of the batch are located with tensor ops, without a per-sequence loop, and their positions
+    are offset copies of the templates in `rope_template_cache`.
 
     Returns:
         position_ids (`torch.LongTensor` of shape `(3, batch_size, sequence_length)`)
-        mrope_position_deltas (`torch.Tensor` of shape `(batch_size)`)
+        mrope_position_deltas (`torch.Tensor` of shape `(batch_size)`, or `(num_sequences)` for packed inputs)
     """
-    image_token_id = 151655
-    video_token_id = 151656
-    vision_start_token_id = 151652
-    mrope_position_deltas = []
-    if input_ids is not None and (
-        image_grid_thw is not None or video_grid_thw is not None
-    ):
-        total_input_ids = input_ids
-        if attention_mask is None:
-            attention_mask = torch.ones_like(total_input_ids)
-        position_ids = torch.ones(
-            3,
-            input_ids.shape[0],
-            input_ids.shape[1],
-            dtype=input_ids.dtype,
-            device=input_ids.device,
-        )
-        image_index, video_index = 0, 0
-        attention_mask = attention_mask.to(total_input_ids.device)
-        for i, input_ids in enumerate(total_input_ids):
-            input_ids = input_ids[attention_mask[i] == 1]
-            image_nums, video_nums = 0, 0
-            vision_start_indices = torch.argwhere(
-                input_ids == vision_start_token_id
-            ).squeeze(1)
-            vision_tokens = input_ids[vision_start_indices + 1]
-            image_nums = (vision_tokens == image_token_id).sum()
-            video_nums = (vision_tokens == video_token_id).sum()
-            input_tokens = input_ids.tolist()
-            llm_pos_ids_list: list = []
-            st = 0
-            remain_images, remain_videos = image_nums, video_nums
-            for _ in range(image_nums + video_nums):
-                if image_token_id in input_tokens and remain_images > 0:
-                    ed_image = input_tokens.index(image_token_id, st)
-                else:
-                    ed_image = len(input_tokens) + 1
-                if video_token_id in input_tokens and remain_videos > 0:
-                    ed_video = input_tokens.index(video_token_id, st)
-                else:
-                    ed_video = len(input_tokens) + 1
-                if ed_image < ed_video:
-                    t, h, w = (
-                        image_grid_thw[image_index][0],
-                        image_grid_thw[image_index][1],
-                        image_grid_thw[image_index][2],
-                    )
-                    second_per_grid_t = 0
-                    image_index += 1
-                    remain_images -= 1
-                    ed = ed_image
-
-                else:
-                    t, h, w = (
-                        video_grid_thw[video_index][0],
-                        video_grid_thw[video_index][1],
-                        video_grid_thw[video_index][2],
-                    )
-                    if second_per_grid_ts is not None:
-                        second_per_grid_t = second_per_grid_ts[video_index]
-                    else:
-                        second_per_grid_t = 1.0
-                    video_index += 1
-                    remain_videos -= 1
-                    ed = ed_video
-                llm_grid_t, llm_grid_h, llm_grid_w = (
-                    t.item(),
-                    h.item() // spatial_merge_size,
-                    w.item() // spatial_merge_size,
-                )
-                text_len = ed - st
-
-                st_idx = (
-                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                )
-                llm_pos_ids_list.append(
-                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
-                )
-
-                range_tensor = torch.arange(llm_grid_t).view(-1, 1)
-                expanded_range = range_tensor.expand(-1, llm_grid_h * llm_grid_w)
-
-                time_tensor = expanded_range * second_per_grid_t * 2
-
-                time_tensor_long = time_tensor.long()
-                t_index = time_tensor_long.flatten()
-
-                h_index = (
-                    torch.arange(llm_grid_h)
-                    .view(1, -1, 1)
-                    .expand(llm_grid_t, -1, llm_grid_w)
-                    .flatten()
-                )
-                w_index = (
-                    torch.arange(llm_grid_w)
-                    .view(1, 1, -1)
-                    .expand(llm_grid_t, llm_grid_h, -1)
-                    .flatten()
-                )
-                llm_pos_ids_list.append(
-                    torch.stack([t_index, h_index, w_index]) + text_len + st_idx
-                )
-                st = ed + llm_grid_t * llm_grid_h * llm_grid_w
-
-            if st < len(input_tokens):
-                st_idx = (
-                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                )
-                text_len = len(input_tokens) - st
-                llm_pos_ids_list.append(
-                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
-                )
-
-            llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
-            position_ids[..., i, attention_mask[i] == 1] = llm_positions.to(
-                position_ids.device
-            )
-            mrope_position_deltas.append(
-                llm_positions.max() + 1 - len(total_input_ids[i])
-            )
-        mrope_position_deltas = torch.tensor(
-            mrope_position_deltas, device=input_ids.device
-        ).unsqueeze(1)
-        return position_ids, mrope_position_deltas
-    else:
-        if attention_mask is not None:
-            position_ids = attention_mask.long().cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask == 0, 1)
-            position_ids = (
-                position_ids.unsqueeze(0).expand(3, -1, -1).to(attention_mask.device)
-            )
-            max_position_ids = position_ids.max(0, keepdim=False)[0].max(
-                -1, keepdim=True
-            )[0]
-            mrope_position_deltas = max_position_ids + 1 - attention_mask.shape[-1]
-        else:
-            position_ids = (
-                torch.arange(input_ids.shape[1], device=input_ids.device)
-                .view(1, 1, -1)
-                .expand(3, input_ids.shape[0], -1)
-            )
-            mrope_position_deltas = torch.zeros(
-                [input_ids.shape[0], 1],
-                device=input_ids.device,
-                dtype=input_ids.dtype,
-            )
-
-        return position_ids, mrope_position_deltas
+    return _get_rope_index(
+        spatial_merge_size,
+        input_ids,
+        image_grid_thw,
+        video_grid_thw,
+        second_per_grid_ts,
+        attention_mask,
+        cu_seqlens,
+        scale_time=True,
+    )
 
 
 def get_rope_index_2(
@@ -238,6 +333,7 @@ def get_rope_index_2(
     video_grid_thw: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
     attention_mask: Optional[torch.Tensor] = None,
+    cu_seqlens: Optional[torch.Tensor] = None,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Calculate the 3D rope index based on image and video's temporal, height and width in LLM.
@@ -278,147 +374,21 @@ def get_rope_index_2(
 
             - 1 for tokens that are **not masked**,
             - 0 for tokens that are **masked**.
+        cu_seqlens (`torch.Tensor` of shape `(num_sequences + 1)`, *optional*):
+            Cumulative sequence lengths of a packed `input_ids` of shape `(1, total_length)`. Positions restart at
+            0 for every sequence and `attention_mask` is ignored.
 
     Returns:
         position_ids (`torch.LongTensor` of shape `(3, batch_size, sequence_length)`)
-        mrope_position_deltas (`torch.Tensor` of shape `(batch_size)`)
+        mrope_position_deltas (`torch.Tensor` of shape `(batch_size)`, or `(num_sequences)` for packed inputs)
     """
-    image_token_id = 151655
-    video_token_id = 151656
-    vision_start_token_id = 151652
-    mrope_position_deltas = []
-    if input_ids is not None and (
-        image_grid_thw is not None or video_grid_thw is not None
-    ):
-        total_input_ids = input_ids
-        if attention_mask is None:
-            attention_mask = torch.ones_like(total_input_ids)
-        position_ids = torch.ones(
-            3,
-            input_ids.shape[0],
-            input_ids.shape[1],
-            dtype=input_ids.dtype,
-            device=input_ids.device,
-        )
-        image_index, video_index = 0, 0
-        for i, input_ids in enumerate(total_input_ids):
-            input_ids = input_ids[attention_mask[i] == 1]
-            image_nums, video_nums = 0, 0
-            vision_start_indices = torch.argwhere(
-                input_ids == vision_start_token_id
-            ).squeeze(1)
-            vision_tokens = input_ids[vision_start_indices + 1]
-            image_nums = (vision_tokens == image_token_id).sum()
-            video_nums = (vision_tokens == video_token_id).sum()
-            input_tokens = input_ids.tolist()
-            llm_pos_ids_list: list = []
-            st = 0
-            remain_images, remain_videos = image_nums, video_nums
-            for _ in range(image_nums + video_nums):
-                if image_token_id in input_tokens and remain_images > 0:
-                    ed_image = input_tokens.index(image_token_id, st)
-                else:
-                    ed_image = len(input_tokens) + 1
-                if video_token_id in input_tokens and remain_videos > 0:
-                    ed_video = input_tokens.index(video_token_id, st)
-                else:
-                    ed_video = len(input_tokens) + 1
-                if ed_image < ed_video:
-                    t, h, w = (
-                        image_grid_thw[image_index][0],
-                        image_grid_thw[image_index][1],
-                        image_grid_thw[image_index][2],
-                    )
-                    image_index += 1
-                    remain_images -= 1
-                    ed = ed_image
-                else:
-                    t, h, w = (
-                        video_grid_thw[video_index][0],
-                        video_grid_thw[video_index][1],
-                        video_grid_thw[video_index][2],
-                    )
-                    video_index += 1
-                    remain_videos -= 1
-                    ed = ed_video
-                llm_grid_t, llm_grid_h, llm_grid_w = (
-                    t.item(),
-                    h.item() // spatial_merge_size,
-                    w.item() // spatial_merge_size,
-                )
-                text_len = ed - st
-
-                st_idx = (
-                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                )
-                llm_pos_ids_list.append(
-                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
-                )
-
-                t_index = (
-                    torch.arange(llm_grid_t)
-                    .view(-1, 1)
-                    .expand(-1, llm_grid_h * llm_grid_w)
-                    .flatten()
-                )
-                h_index = (
-                    torch.arange(llm_grid_h)
-                    .view(1, -1, 1)
-                    .expand(llm_grid_t, -1, llm_grid_w)
-                    .flatten()
-                )
-                w_index = (
-                    torch.arange(llm_grid_w)
-                    .view(1, 1, -1)
-                    .expand(llm_grid_t, llm_grid_h, -1)
-                    .flatten()
-                )
-                llm_pos_ids_list.append(
-                    torch.stack([t_index, h_index, w_index]) + text_len + st_idx
-                )
-                st = ed + llm_grid_t * llm_grid_h * llm_grid_w
-
-            if st < len(input_tokens):
-                st_idx = (
-                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
-                )
-                text_len = len(input_tokens) - st
-                llm_pos_ids_list.append(
-                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
-                )
-
-            llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
-            position_ids[..., i, attention_mask[i] == 1] = llm_positions.to(
-                position_ids.device
-            )
-            mrope_position_deltas.append(
-                llm_positions.max() + 1 - len(total_input_ids[i])
-            )
-        mrope_position_deltas = torch.tensor(
-            mrope_position_deltas, device=input_ids.device
-        ).unsqueeze(1)
-        return position_ids, mrope_position_deltas
-    else:
-        if attention_mask is not None:
-            position_ids = attention_mask.long().cumsum(-1) - 1
-            position_ids.masked_fill_(attention_mask == 0, 1)
-            position_ids = (
-                position_ids.unsqueeze(0).expand(3, -1, -1).to(attention_mask.device)
-            )
-            max_position_ids = position_ids.max(0, keepdim=False)[0].max(
-                -1, keepdim=True
-            )[0]
-            mrope_position_deltas = max_position_ids + 1 - attention_mask.shape[-1]
-        else:
-            position_ids = (
-                torch.arange(input_ids.shape[1], device=input_ids.device)
-                .view(1, 1, -1)
-                .expand(3, input_ids.shape[0], -1)
-            )
-            mrope_position_deltas = torch.zeros(
-                [input_ids.shape[0], 1],
-                device=input_ids.device,
-                dtype=input_ids.dtype,
-            )
-
-        return position_ids, mrope_position_deltas
+    return _get_rope_index(
+        spatial_merge_size,
+        input_ids,
+        image_grid_thw,
+        video_grid_thw,
+        second_per_grid_ts,
+        attention_mask,
+        cu_seqlens,
+        scale_time=False,
+    )
@@ -0,0 +1,201 @@
+import math
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def pack_by_token_budget(
+    lengths: np.ndarray,
+    order: Sequence[int],
+    max_tokens: int,
+    padded: bool = False,
+    max_batch_size: Optional[int] = None,
+) -> List[np.ndarray]:
+    """Greedily cut `order` into batches whose cost stays within `max_tokens`.
+
+    The cost of a batch is its total length for packed (flattened) batches, or
+    `len(batch) * longest` for padded ones. A sample longer than the budget
+    gets a batch of its own.
+    """
+    batches, batch = [], []
+    total, longest = 0, 0
+    for index in order:
+        length = int(lengths[index])
+        new_total, new_longest = total + length, max(longest, length)
+        cost = new_longest * (len(batch) + 1) if padded else new_total
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (cost > max_tokens or full):
+            batches.append(np.array(batch, dtype=np.int64))
+            batch, new_total, new_longest = [], length, length
+        batch.append(index)
+        total, longest = new_total, new_longest
+    if batch:
+        batches.append(np.array(batch, dtype=np.int64))
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Yield batches of sample indices that hold up to `max_tokens` tokens.
+
+    Samples are sorted by length (ties broken by a seeded permutation) and
+    packed once, so every batch groups samples of similar length and the
+    number of batches is fixed. Each epoch the batch order is shuffled with
+    `seed + epoch` and rank `rank` takes every `num_replicas`-th batch; the
+    order is padded by wrapping around so all ranks run the same number of
+    steps.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        shuffle: bool = True,
+        padded: bool = False,
+        max_batch_size: Optional[int] = None,
+    ):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank {rank} is not in [0, {num_replicas})")
+        lengths = np.asarray(lengths, dtype=np.int64)
+        tie_breaker = np.random.default_rng(seed).permutation(len(lengths))
+        order = np.lexsort((tie_breaker, lengths))
+        self.batches = pack_by_token_budget(
+            lengths, order, max_tokens, padded=padded, max_batch_size=max_batch_size
+        )
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.batches) / self.num_replicas)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            order = rng.permutation(len(self.batches))
+        else:
+            order = np.arange(len(self.batches))
+        total_size = len(self) * self.num_replicas
+        if total_size > len(order):
+            order = np.resize(order, total_size)
+        for batch_index in order[self.rank : total_size : self.num_replicas]:
+            yield self.batches[batch_index].tolist()
+
+
+class MixtureSampler(Sampler):
+    """Yield this rank's indices of a weighted mixture of sources, in a resumable order.
+
+    `source_indices[s]` holds the dataset indices of source `s` in a fixed
+    order; rank `rank` owns every `num_replicas`-th of them (wrapping around
+    so all shards have the same size). Each epoch, source `s` contributes
+    `ceil(round(weights[s] * len(source_indices[s])) / num_replicas)` samples
+    per rank, drawn from back-to-back permutations of the shard seeded by
+    `(seed, epoch, rank, s, cycle)`: a weight of 2.5 walks the shard two and a
+    half times, and a weight below 1 takes a different subset every epoch.
+    Sources are interleaved by a permutation of the per-sample source labels
+    seeded by `(seed, epoch, rank)`.
+
+    Every position of an epoch is determined by those seeds alone, so
+    `load_state_dict` resumes in the middle of an epoch without replaying the
+    samples before it.
+    """
+
+    def __init__(
+        self,
+        source_indices: Sequence[Sequence[int]],
+        weights: Sequence[float],
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ):
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank {rank} is not in [0, {num_replicas})")
+        if len(source_indices) != len(weights):
+            raise ValueError(
+                f"got {len(weights)} weights for {len(source_indices)} sources"
+            )
+        if any(weight < 0 for weight in weights):
+            raise ValueError(f"weights must not be negative, got {list(weights)}")
+        self.shards, quotas = [], []
+        for indices, weight in zip(source_indices, weights):
+            indices = np.asarray(indices, dtype=np.int64)
+            shard_size = math.ceil(len(indices) / num_replicas)
+            self.shards.append(np.resize(indices, shard_size * num_replicas)[rank::num_replicas])
+            quotas.append(math.ceil(round(weight * len(indices)) / num_replicas))
+        self.quotas = np.array(quotas, dtype=np.int64)
+        self.weights = [float(weight) for weight in weights]
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self._resume = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return int(self.quotas.sum())
+
+    def source_labels(self, epoch: int) -> np.ndarray:
+        """Source of every position of `epoch` on this rank."""
+        labels = np.repeat(np.arange(len(self.quotas), dtype=np.int32), self.quotas)
+        return np.random.default_rng([self.seed, epoch, self.rank]).permutation(labels)
+
+    def _stream(self, source: int, epoch: int, start: int) -> Iterator[int]:
+        shard = self.shards[source]
+        cycle, offset = divmod(start, len(shard))
+        while True:
+            rng = np.random.default_rng([self.seed, epoch, self.rank, source, cycle])
+            for i in rng.permutation(len(shard))[offset:]:
+                yield int(shard[i])
+            cycle, offset = cycle + 1, 0
+
+    def start_position(self) -> int:
+        """Where the next iteration of the current epoch starts."""
+        if self._resume is not None and self._resume[0] == self.epoch:
+            return self._resume[1]
+        return 0
+
+    def __iter__(self) -> Iterator[int]:
+        epoch, start = self.epoch, self.start_position()
+        self._resume = None
+        labels = self.source_labels(epoch)
+        drawn = np.bincount(labels[:start], minlength=len(self.quotas))
+        streams = [
+            self._stream(source, epoch, int(drawn[source])) if quota else None
+            for source, quota in enumerate(self.quotas)
+        ]
+        for label in labels[start:]:
+            yield next(streams[label])
+
+    def state_dict(self, position: int) -> Dict:
+        """State after `position` samples of the current epoch were consumed."""
+        return {
+            "epoch": self.epoch,
+            "position": position,
+            "num_samples": len(self),
+            "weights": self.weights,
+            "num_replicas": self.num_replicas,
+            "seed": self.seed,
+        }
+
+    def load_state_dict(self, state: Dict):
+        current = self.state_dict(0)
+        for key in ("num_samples", "weights", "num_replicas", "seed"):
+            if key in state and state[key] != current[key]:
+                raise ValueError(
+                    f"cannot resume the mixture sampler: saved {key} {state[key]} "
+                    f"does not match {current[key]} of the current run"
+                )
+        self.epoch = state["epoch"]
+        self._resume = (state["epoch"], state["position"])
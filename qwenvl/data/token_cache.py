@@ -0,0 +1,309 @@
+import os
+import copy
+import json
+import shutil
+import hashlib
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import transformers
+from PIL import Image
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+CACHE_VERSION = 1
+IMAGE_TOKEN_INDEX = 151655
+VIDEO_TOKEN_INDEX = 151656
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer: transformers.PreTrainedTokenizer) -> str:
+    """Hash the vocabulary and added tokens, i.e. everything that changes token ids."""
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode())
+    digest.update(
+        json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode()
+    )
+    digest.update(
+        json.dumps(
+            sorted((str(k), v) for k, v in tokenizer.get_added_vocab().items()),
+            ensure_ascii=False,
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def token_cache_key(
+    annotation_path: str,
+    tokenizer: transformers.PreTrainedTokenizer,
+    chat_template: str,
+    min_pixels: int,
+    max_pixels: int,
+    patch_size: int,
+    merge_size: int,
+    extra: Optional[Dict] = None,
+) -> str:
+    """Content address of a cache: annotation bytes, tokenizer, template and vision settings."""
+    key = {
+        "version": CACHE_VERSION,
+        "annotation": file_sha256(annotation_path),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "chat_template": chat_template,
+        "min_pixels": min_pixels,
+        "max_pixels": max_pixels,
+        "patch_size": patch_size,
+        "merge_size": merge_size,
+    }
+    if extra:
+        key.update(extra)
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def image_grid_thw(
+    image_file: str, patch_size: int, merge_size: int, min_pixels: int, max_pixels: int
+) -> List[int]:
+    """Grid of an image as produced by Qwen2VLImageProcessor, from the header only."""
+    with Image.open(image_file) as image:
+        width, height = image.size
+    resized_height, resized_width = smart_resize(
+        height,
+        width,
+        factor=patch_size * merge_size,
+        min_pixels=min_pixels,
+        max_pixels=max_pixels,
+    )
+    return [1, resized_height // patch_size, resized_width // patch_size]
+
+
+def media_spans(input_ids: np.ndarray) -> np.ndarray:
+    """Return `[start, end)` offsets of every run of image/video pad tokens."""
+    is_media = np.isin(input_ids, (IMAGE_TOKEN_INDEX, VIDEO_TOKEN_INDEX))
+    padded = np.concatenate(([False], is_media, [False])).astype(np.int8)
+    change = np.flatnonzero(np.diff(padded))
+    return change.reshape(-1, 2)
+
+
+class TokenCache(object):
+    """Memory-mapped `input_ids`/`labels` of one annotation file, in file order.
+
+    Rows that could not be pre-tokenized (videos, unreadable images) are marked
+    invalid and the dataset falls back to tokenizing them on the fly.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.input_ids = np.load(os.path.join(path, "input_ids.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.valid = np.load(os.path.join(path, "valid.npy"))
+        self.media_spans = np.load(os.path.join(path, "media_spans.npy"), mmap_mode="r")
+        self.grid_thw = np.load(os.path.join(path, "grid_thw.npy"), mmap_mode="r")
+        self.media_offsets = np.load(os.path.join(path, "media_offsets.npy"))
+
+    def __len__(self):
+        return len(self.valid)
+
+    def get(self, row: int) -> Optional[Dict]:
+        if not self.valid[row]:
+            return None
+        start, end = self.offsets[row], self.offsets[row + 1]
+        media_start, media_end = self.media_offsets[row], self.media_offsets[row + 1]
+        return dict(
+            input_ids=torch.from_numpy(
+                self.input_ids[start:end].astype(np.int64)
+            ).unsqueeze(0),
+            labels=torch.from_numpy(self.labels[start:end].astype(np.int64)).unsqueeze(
+                0
+            ),
+            media_spans=np.asarray(self.media_spans[media_start:media_end]),
+            grid_thw=np.asarray(self.grid_thw[media_start:media_end]),
+        )
+
+
+def build_token_cache(
+    annotations: List[Dict],
+    data_path: str,
+    tokenizer: transformers.PreTrainedTokenizer,
+    output_path: str,
+    min_pixels: int,
+    max_pixels: int,
+    patch_size: int,
+    merge_size: int,
+    meta: Optional[Dict] = None,
+) -> str:
+    """Tokenize every annotation once and write the cache to `output_path`.
+
+    The cache is written to a temporary directory and renamed into place, so
+    concurrent builders never expose a partial cache.
+    """
+    from .data_qwen import preprocess_qwen_2_visual
+
+    input_ids, labels, offsets, valid = [], [], [0], []
+    spans, grids, media_offsets = [], [], [0]
+    for ann in annotations:
+        try:
+            if "video" in ann:
+                raise NotImplementedError("video samples are tokenized on the fly")
+            grid_thw = []
+            if "image" in ann:
+                image_files = ann["image"]
+                if not isinstance(image_files, list):
+                    image_files = [image_files]
+                grid_thw = [
+                    image_grid_thw(
+                        os.path.join(data_path, file),
+                        patch_size,
+                        merge_size,
+                        min_pixels,
+                        max_pixels,
+                    )
+                    for file in image_files
+                ]
+            data_dict = preprocess_qwen_2_visual(
+                copy.deepcopy([ann["conversations"]]),
+                tokenizer,
+                grid_thw=[int(np.prod(thw)) // merge_size**2 for thw in grid_thw],
+                visual_type="image",
+            )
+            ids = data_dict["input_ids"][0].numpy().astype(np.int32)
+            sample_spans = media_spans(ids)
+            if len(sample_spans) != len(grid_thw):
+                raise ValueError(
+                    f"found {len(sample_spans)} media spans for {len(grid_thw)} images"
+                )
+        except Exception:
+            valid.append(False)
+            offsets.append(offsets[-1])
+            media_offsets.append(media_offsets[-1])
+            continue
+        input_ids.append(ids)
+        labels.append(data_dict["labels"][0].numpy().astype(np.int32))
+        spans.append(sample_spans)
+        grids.extend(grid_thw)
+        valid.append(True)
+        offsets.append(offsets[-1] + len(ids))
+        media_offsets.append(media_offsets[-1] + len(sample_spans))
+
+    parent = os.path.dirname(os.path.abspath(output_path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-token-cache-")
+    try:
+        np.save(
+            os.path.join(tmp_path, "input_ids.npy"),
+            np.concatenate(input_ids) if input_ids else np.zeros(0, dtype=np.int32),
+        )
+        np.save(
+            os.path.join(tmp_path, "labels.npy"),
+            np.concatenate(labels) if labels else np.zeros(0, dtype=np.int32),
+        )
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, np.int64))
+        np.save(os.path.join(tmp_path, "valid.npy"), np.array(valid, dtype=bool))
+        np.save(
+            os.path.join(tmp_path, "media_spans.npy"),
+            np.concatenate(spans).astype(np.int64)
+            if spans
+            else np.zeros((0, 2), dtype=np.int64),
+        )
+        np.save(
+            os.path.join(tmp_path, "grid_thw.npy"),
+            np.array(grids, dtype=np.int64).reshape(-1, 3),
+        )
+        np.save(
+            os.path.join(tmp_path, "media_offsets.npy"),
+            np.array(media_offsets, np.int64),
+        )
+        meta = dict(meta or {})
+        meta.update(num_samples=len(valid), num_cached=int(sum(valid)))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, output_path)
+    except OSError:
+        # another process already published the same cache
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(output_path):
+            raise
+    return output_path
+
+
+def load_token_cache(
+    annotation_path: str,
+    annotations: List[Dict],
+    data_path: str,
+    tokenizer: transformers.PreTrainedTokenizer,
+    data_args,
+) -> TokenCache:
+    """Open the cache for `annotation_path`, building it first if it is missing."""
+    from .data_qwen import CHAT_TEMPLATE, rank0_print
+
+    image_processor = data_args.image_processor
+    settings = dict(
+        min_pixels=data_args.min_pixels,
+        max_pixels=data_args.max_pixels,
+        patch_size=image_processor.patch_size,
+        merge_size=image_processor.merge_size,
+    )
+    key = token_cache_key(annotation_path, tokenizer, CHAT_TEMPLATE, **settings)
+    path = os.path.join(data_args.token_cache_dir, key)
+
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if not os.path.isdir(path):
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            rank0_print(f"Building token cache for {annotation_path} at {path}")
+            build_token_cache(
+                annotations,
+                data_path,
+                tokenizer,
+                path,
+                meta=dict(annotation_path=os.path.abspath(annotation_path), **settings),
+                **settings,
+            )
+        if distributed:
+            torch.distributed.barrier()
+    cache = TokenCache(path)
+    if len(cache) != len(annotations):
+        raise ValueError(
+            f"token cache {path} has {len(cache)} rows but {annotation_path} has {len(annotations)}"
+        )
+    rank0_print(
+        f"Loaded token cache {path} ({cache.meta['num_cached']}/{len(cache)} samples cached)"
+    )
+    return cache
+
+
+if __name__ == "__main__":
+    from transformers import AutoProcessor, HfArgumentParser
+
+    from qwenvl.data import data_list
+    from qwenvl.data.annotations import load_annotations
+    from qwenvl.train.argument import ModelArguments, DataArguments
+
+    parser = HfArgumentParser((ModelArguments, DataArguments))
+    model_args, data_args = parser.parse_args_into_dataclasses()
+    if data_args.token_cache_dir is None:
+        raise ValueError("--token_cache_dir is required to pre-tokenize")
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_args.model_name_or_path, use_fast=False
+    )
+    data_args.image_processor = AutoProcessor.from_pretrained(
+        model_args.model_name_or_path
+    ).image_processor
+    for data in data_list(data_args.dataset_use.split(",")):
+        annotations = load_annotations(
+            data["annotation_path"], data["data_path"], data_args.annotation_cache_dir
+        )
+        cache = load_token_cache(
+            data["annotation_path"], annotations, data["data_path"], tokenizer, data_args
+        )
+        print(
+            f"{data['annotation_path']}: {cache.meta['num_cached']}/{len(cache)} samples cached at {cache.path}"
+        )
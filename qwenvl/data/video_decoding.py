@@ -0,0 +1,101 @@
+import os
+from collections import OrderedDict
+from typing import Tuple
+
+import torch
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def decoder_threads() -> int:
+    """Decoder threads per reader, so the readers of all dataloader workers of all local ranks fit the cores."""
+    worker_info = torch.utils.data.get_worker_info()
+    num_workers = worker_info.num_workers if worker_info is not None else 1
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    return max(1, available_cores() // (num_workers * local_world_size))
+
+
+class VideoReaderCache(object):
+    """Per-process LRU of open decord readers.
+
+    Samples that share a video (several questions about one clip) reuse its
+    reader and decoder instead of reopening the file. Each reader runs
+    `decoder_threads()` threads rather than a fixed four, since the
+    dataloader workers already decode in parallel.
+
+    With `reduced=True` a reader decodes straight to the `smart_resize` size
+    of the video, so frames come out of the decoder at the size the image
+    processor would resize them to and its resize is a no-op. The scaling is
+    done by the decoder instead of PIL, so pixels differ slightly from full
+    decoding (see tools/bench_video_decoding.py). The frame size is read once
+    per video from its first frame.
+    """
+
+    def __init__(
+        self,
+        min_pixels: int,
+        max_pixels: int,
+        factor: int = 28,
+        max_readers: int = 4,
+        reduced: bool = False,
+    ):
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.factor = factor
+        self.max_readers = max_readers
+        self.reduced = reduced
+        self._readers = OrderedDict()
+        self._sizes = OrderedDict()
+        self._pid = os.getpid()
+
+    def decode_size(self, video_file: str) -> Tuple[int, int]:
+        """`(height, width)` the reader of `video_file` decodes to."""
+        from decord import VideoReader
+
+        size = self._sizes.get(video_file)
+        if size is None:
+            height, width = VideoReader(video_file, num_threads=1)[0].shape[:2]
+            size = smart_resize(
+                height,
+                width,
+                factor=self.factor,
+                min_pixels=self.min_pixels,
+                max_pixels=self.max_pixels,
+            )
+            self._sizes[video_file] = size
+            if len(self._sizes) > 64 * self.max_readers:
+                self._sizes.popitem(last=False)
+        return size
+
+    def get(self, video_file: str):
+        from decord import VideoReader
+
+        if self._pid != os.getpid():
+            # decoder threads do not survive a fork into a dataloader worker
+            self._readers, self._pid = OrderedDict(), os.getpid()
+        reader = self._readers.get(video_file)
+        if reader is not None:
+            self._readers.move_to_end(video_file)
+            return reader
+        if self.reduced:
+            height, width = self.decode_size(video_file)
+            reader = VideoReader(
+                video_file, width=width, height=height, num_threads=decoder_threads()
+            )
+        else:
+            reader = VideoReader(video_file, num_threads=decoder_threads())
+        self._readers[video_file] = reader
+        if len(self._readers) > self.max_readers:
+            self._readers.popitem(last=False)
+        return reader
+
+    def __getstate__(self):
+        # readers hold native decoder state; each worker opens its own
+        state = self.__dict__.copy()
+        state["_readers"] = OrderedDict()
+        return state
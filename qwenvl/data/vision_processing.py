@@ -0,0 +1,123 @@
+import copy
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+
+def configure_processor(image_processor, min_pixels: int, max_pixels: int):
+    """Copy of `image_processor` resizing into `[min_pixels, max_pixels]`, made once per dataset."""
+    processor = copy.deepcopy(image_processor)
+    processor.max_pixels = max_pixels
+    processor.min_pixels = min_pixels
+    processor.size["longest_edge"] = max_pixels
+    processor.size["shortest_edge"] = min_pixels
+    return processor
+
+
+def patchify(
+    frames: torch.Tensor, patch_size: int, temporal_patch_size: int, merge_size: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Flatten `(T, C, H, W)` frames into the Qwen2-VL patch layout.
+
+    Mirrors `Qwen2VLImageProcessor._preprocess`: the last frame is repeated up
+    to a multiple of `temporal_patch_size` and patches are ordered so that each
+    `merge_size x merge_size` block is contiguous.
+    """
+    if frames.shape[0] % temporal_patch_size != 0:
+        repeats = frames[-1:].expand(
+            temporal_patch_size - frames.shape[0] % temporal_patch_size, -1, -1, -1
+        )
+        frames = torch.cat([frames, repeats], dim=0)
+    num_frames, channel, height, width = frames.shape
+    grid_t = num_frames // temporal_patch_size
+    grid_h, grid_w = height // patch_size, width // patch_size
+    patches = frames.reshape(
+        grid_t,
+        temporal_patch_size,
+        channel,
+        grid_h // merge_size,
+        merge_size,
+        patch_size,
+        grid_w // merge_size,
+        merge_size,
+        patch_size,
+    )
+    patches = patches.permute(0, 3, 6, 4, 7, 2, 1, 5, 8)
+    flatten_patches = patches.reshape(
+        grid_t * grid_h * grid_w,
+        channel * temporal_patch_size * patch_size * patch_size,
+    )
+    return flatten_patches, torch.tensor([grid_t, grid_h, grid_w])
+
+
+class VisionProcessor(object):
+    """Turns an image or a video into `(pixel_values, grid_thw)` with fixed settings.
+
+    By default this calls the HF `Qwen2VLImageProcessor`. With `fast=True` the
+    frames are resized with PIL exactly as HF does, rescaled and normalized
+    through a per-channel lookup table of the 256 uint8 values, and patchified
+    in torch, skipping the generic per-image numpy pipeline. The output is
+    checked against HF in tools/bench_vision_processor.py.
+    """
+
+    def __init__(self, image_processor, min_pixels: int, max_pixels: int, fast=False):
+        self.processor = configure_processor(image_processor, min_pixels, max_pixels)
+        self.fast = fast
+        # same float64 rescale and float32 normalize as the HF processor
+        values = np.arange(256, dtype=np.float64)
+        if self.processor.do_rescale:
+            values = values * self.processor.rescale_factor
+        lut = np.broadcast_to(values.astype(np.float32), (3, 256))
+        if self.processor.do_normalize:
+            mean = np.array(self.processor.image_mean, dtype=np.float32)
+            std = np.array(self.processor.image_std, dtype=np.float32)
+            lut = (lut - mean[:, None]) / std[:, None]
+        self.lut = np.ascontiguousarray(lut)
+
+    def __call__(
+        self, visual: Union[Image.Image, np.ndarray], video=False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """`visual` is a PIL image, or a `(T, H, W, C)` uint8 array when `video=True`."""
+        if self.fast:
+            return self._fast_preprocess(visual)
+        if video:
+            processed = self.processor.preprocess(
+                images=None, videos=visual, return_tensors="pt"
+            )
+            return processed["pixel_values_videos"], processed["video_grid_thw"][0]
+        processed = self.processor.preprocess(visual, return_tensors="pt")
+        return processed["pixel_values"], processed["image_grid_thw"][0]
+
+    def _fast_preprocess(self, visual) -> Tuple[torch.Tensor, torch.Tensor]:
+        processor = self.processor
+        if isinstance(visual, Image.Image):
+            frames = [visual.convert("RGB")]
+        else:
+            frames = [Image.fromarray(frame) for frame in visual]
+        width, height = frames[0].size
+        if processor.do_resize:
+            height, width = smart_resize(
+                height,
+                width,
+                factor=processor.patch_size * processor.merge_size,
+                min_pixels=processor.size["shortest_edge"],
+                max_pixels=processor.size["longest_edge"],
+            )
+            frames = [
+                frame.resize((width, height), resample=processor.resample)
+                for frame in frames
+            ]
+        pixels = np.empty((len(frames), 3, height, width), dtype=np.float32)
+        for t, frame in enumerate(frames):
+            frame = np.asarray(frame)
+            for c in range(3):
+                pixels[t, c] = self.lut[c][frame[..., c]]
+        return patchify(
+            torch.from_numpy(pixels),
+            processor.patch_size,
+            processor.temporal_patch_size,
+            processor.merge_size,
+        )
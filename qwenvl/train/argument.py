@@ -21,6 +21,61 @@ class DataArguments:
     min_pixels: int = field(default=28 * 28 * 16)
     video_max_frame_pixels: int = field(default=32 * 28 * 28)
     video_min_frame_pixels: int = field(default=4 * 28 * 28)
+    video_reduced_decode: bool = field(
+        default=False,
+        metadata={
+            "help": "Decode video frames directly at their resized resolution, see qwenvl/data/video_decoding.py."
+        },
+    )
+    video_frame_store_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory of video frames extracted offline, read instead of decoding, see qwenvl/data/frame_store.py."
+        },
+    )
+    annotation_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory for the JSONL conversions, indexes and length indexes derived from annotation files. Defaults to each annotation file's directory, or a tmp directory if that is read-only, see qwenvl/data/annotations.py."
+        },
+    )
+    token_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory of pre-tokenized annotation caches, see qwenvl/data/token_cache.py."
+        },
+    )
+    fast_vision_processor: bool = field(
+        default=False,
+        metadata={
+            "help": "Normalize and patchify images/videos without the generic HF image processor, see qwenvl/data/vision_processing.py."
+        },
+    )
+    pixel_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory caching preprocessed image pixel_values across epochs, see qwenvl/data/pixel_cache.py."
+        },
+    )
+    pixel_cache_max_gb: float = field(default=64.0)
+    sample_failure_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Directory of the registry of samples that failed to load, shared by all ranks and later runs, see qwenvl/data/failure_registry.py. Without it the registry is per rank and per run."
+        },
+    )
+    build_length_index: bool = field(
+        default=False,
+        metadata={
+            "help": "Build missing length indexes when the dataset is created instead of estimating sample lengths, see qwenvl/data/length_index.py. Ranks wait for the build at a barrier, so prefer building them offline."
+        },
+    )
+    length_index_num_workers: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Processes used to build missing length indexes, see qwenvl/data/length_index.py. Defaults to all CPUs."
+        },
+    )
 
 
 @dataclass
@@ -33,5 +88,11 @@ class TrainingArguments(transformers.TrainingArguments):
             "help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Build each device batch up to this many tokens (text plus vision) instead of a fixed number of samples."
+        },
+    )
     mm_projector_lr: Optional[float] = None
     vision_tower_lr: Optional[float] = None
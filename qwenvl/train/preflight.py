@@ -0,0 +1,307 @@
+import os
+import sys
+import copy
+import json
+import math
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import transformers
+
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+
+import qwenvl.data.data_qwen as data_qwen
+from qwenvl.data.data_qwen import LazySupervisedDataset, preprocess_qwen_2_visual
+from qwenvl.data.length_index import sample_grid_thw
+from qwenvl.data.sampler import (
+    MixtureSampler,
+    TokenBudgetBatchSampler,
+    pack_by_token_budget,
+)
+from qwenvl.data.token_cache import media_spans
+from qwenvl.train.argument import ModelArguments, DataArguments, TrainingArguments
+
+
+@dataclass
+class PreflightArguments:
+    preflight_output: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "JSON summary path. Defaults to <output_dir>/preflight.json."
+        },
+    )
+
+
+def distribution(values: np.ndarray) -> Dict:
+    if len(values) == 0:
+        return dict(count=0)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return dict(
+        count=int(len(values)),
+        mean=float(values.mean()),
+        min=int(values.min()),
+        p50=float(p50),
+        p90=float(p90),
+        p99=float(p99),
+        max=int(values.max()),
+    )
+
+
+def epoch_indices(dataset, seed: int) -> np.ndarray:
+    """Dataset indices of one epoch on a single rank, with mixture weights applied."""
+    if all(weight == 1.0 for weight in dataset.source_weights):
+        return np.arange(len(dataset))
+    sampler = MixtureSampler(
+        dataset.source_indices(), dataset.source_weights, seed=seed
+    )
+    return np.fromiter(sampler, dtype=np.int64, count=len(sampler))
+
+
+def truncation_report(dataset, indices: np.ndarray, model_max_length: int) -> Dict:
+    """Tokens cut by `model_max_length`, re-tokenizing the samples that exceed it.
+
+    A cut inside a run of vision pad tokens leaves the sequence out of sync
+    with `pixel_values`.
+    """
+    num_tokens = dataset.num_tokens
+    too_long = np.unique(indices[num_tokens[indices] > model_max_length])
+    merge_size = dataset.data_args.image_processor.merge_size
+    vision_cut, vision_split, examples = 0, 0, []
+    for i in too_long.tolist():
+        sample = dataset.list_data_dict[i]
+        visual_type = "video" if "video" in sample else "image"
+        try:
+            grid_thw = sample_grid_thw(sample, dataset.data_args)
+        except Exception:
+            grid_thw = []
+        input_ids = preprocess_qwen_2_visual(
+            copy.deepcopy([sample["conversations"]]),
+            dataset.tokenizer,
+            grid_thw=[int(np.prod(thw)) // merge_size**2 for thw in grid_thw],
+            visual_type=visual_type,
+        )["input_ids"][0].numpy()
+        spans = media_spans(input_ids)
+        cut = spans[:, 1] > model_max_length
+        split = (spans[:, 0] < model_max_length) & cut
+        vision_cut += bool(cut.any())
+        vision_split += bool(split.any())
+        if len(examples) < 20:
+            examples.append(
+                dict(
+                    annotation_path=dataset.annotation_paths[dataset.sample_source[i]],
+                    row=int(dataset.sample_row[i]),
+                    num_tokens=int(num_tokens[i]),
+                    vision_tokens_cut=int(
+                        np.clip(
+                            spans[:, 1] - np.maximum(spans[:, 0], model_max_length),
+                            0,
+                            None,
+                        ).sum()
+                    ),
+                )
+            )
+    over = num_tokens[indices] > model_max_length
+    return dict(
+        model_max_length=model_max_length,
+        truncated_samples=int(len(too_long)),
+        truncated_per_epoch=int(over.sum()),
+        tokens_cut_per_epoch=int((num_tokens[indices][over] - model_max_length).sum()),
+        samples_losing_vision_tokens=vision_cut,
+        samples_split_inside_vision_span=vision_split,
+        examples=examples,
+    )
+
+
+def padding_report(batches, lengths: np.ndarray) -> Dict:
+    """Share of padded batch slots that hold padding.
+
+    Batches are padded to their longest sample.
+    """
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    slots = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    return dict(
+        num_batches=len(batches),
+        real_tokens=real,
+        padded_tokens=slots - real,
+        padding_waste=(slots - real) / slots if slots else 0.0,
+    )
+
+
+def packing_report(lengths: np.ndarray, capacity: int) -> Dict:
+    """Fill of packed sequences of `capacity` tokens.
+
+    Sequences are packed like the length-sorted packer of
+    TokenBudgetBatchSampler. Samples longer than `capacity` are counted
+    apart; each would be a batch of its own.
+    """
+    samples_over_capacity = int((lengths > capacity).sum())
+    lengths = lengths[lengths <= capacity]
+    batches = pack_by_token_budget(
+        lengths, np.argsort(lengths, kind="stable"), capacity
+    )
+    total = int(lengths.sum())
+    return dict(
+        capacity=capacity,
+        num_batches=len(batches),
+        min_num_batches=math.ceil(total / capacity),
+        packing_efficiency=total / (len(batches) * capacity) if batches else 0.0,
+        samples_over_capacity=samples_over_capacity,
+    )
+
+
+def preflight(data_args, training_args, tokenizer) -> Dict:
+    dataset = LazySupervisedDataset(tokenizer=tokenizer, data_args=data_args)
+    model_max_length = training_args.model_max_length
+    indices = epoch_indices(dataset, training_args.seed)
+    num_tokens = dataset.num_tokens
+    lengths = num_tokens[indices]
+
+    sources = []
+    for source_id, (path, weight) in enumerate(
+        zip(dataset.annotation_paths, dataset.source_weights)
+    ):
+        source_lengths = num_tokens[dataset.sample_source == source_id]
+        sources.append(
+            dict(
+                annotation_path=path,
+                weight=weight,
+                num_samples=int(len(source_lengths)),
+                num_tokens=distribution(source_lengths),
+                over_model_max_length=int((source_lengths > model_max_length).sum()),
+            )
+        )
+
+    summary = dict(
+        dataset_use=data_args.dataset_use,
+        num_samples=len(dataset),
+        samples_per_epoch=int(len(indices)),
+        tokens_per_epoch=int(lengths.sum()),
+        num_tokens=distribution(lengths),
+        sources=sources,
+        truncation=truncation_report(dataset, indices, model_max_length),
+    )
+    # the padded collator cuts sequences to model_max_length;
+    # the flattened one packs them whole
+    summary["truncation"]["applies"] = not data_args.data_flatten
+
+    rng = np.random.default_rng(training_args.seed)
+    if training_args.max_tokens_per_batch is not None:
+        sampler = TokenBudgetBatchSampler(
+            lengths,
+            training_args.max_tokens_per_batch,
+            seed=training_args.seed,
+            padded=not data_args.data_flatten,
+        )
+        batches = sampler.batches
+        summary["batching"] = dict(
+            mode="token_budget", max_tokens_per_batch=training_args.max_tokens_per_batch
+        )
+    else:
+        order = rng.permutation(len(lengths))
+        batch_size = training_args.per_device_train_batch_size
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        summary["batching"] = dict(
+            mode="random", per_device_train_batch_size=batch_size
+        )
+    if data_args.data_flatten:
+        summary["batching"]["packed"] = True
+        summary["batching"]["num_batches"] = len(batches)
+        summary["batching"]["tokens_per_batch"] = distribution(
+            np.array([int(lengths[batch].sum()) for batch in batches])
+        )
+    else:
+        clipped = np.minimum(lengths, model_max_length)
+        summary["batching"].update(padding_report(batches, clipped))
+    summary["packing"] = packing_report(
+        lengths, training_args.max_tokens_per_batch or model_max_length
+    )
+    return summary
+
+
+def print_summary(summary: Dict):
+    tokens = summary["num_tokens"]
+    print(f"\n==== Preflight: {summary['dataset_use']} ====")
+    print(
+        f"{summary['samples_per_epoch']} samples per epoch "
+        f"({summary['num_samples']} unique), {summary['tokens_per_epoch']} tokens"
+    )
+    print(
+        f"tokens per sample: mean {tokens['mean']:.0f}, p50 {tokens['p50']:.0f}, "
+        f"p90 {tokens['p90']:.0f}, p99 {tokens['p99']:.0f}, max {tokens['max']}"
+    )
+    truncation = summary["truncation"]
+    print(
+        f"over model_max_length {truncation['model_max_length']}: "
+        f"{truncation['truncated_samples']} samples "
+        f"({truncation['truncated_per_epoch']} per epoch, "
+        f"{truncation['tokens_cut_per_epoch']} tokens), "
+        f"{truncation['samples_losing_vision_tokens']} losing vision tokens, "
+        f"{truncation['samples_split_inside_vision_span']} split inside a vision span"
+        + ("" if truncation["applies"] else " (not truncated with --data_flatten)")
+    )
+    batching = summary["batching"]
+    if "padding_waste" in batching:
+        print(
+            f"{batching['mode']} batches: {batching['num_batches']}, "
+            f"padding waste {batching['padding_waste']:.1%}"
+        )
+    else:
+        print(
+            f"{batching['mode']} packed batches: {batching['num_batches']}, "
+            f"tokens per batch p50 {batching['tokens_per_batch']['p50']:.0f}, "
+            f"max {batching['tokens_per_batch']['max']}"
+        )
+    packing = summary["packing"]
+    print(
+        f"packing into {packing['capacity']} tokens: {packing['num_batches']} batches "
+        f"(at least {packing['min_num_batches']}), "
+        f"efficiency {packing['packing_efficiency']:.1%}, "
+        f"{packing['samples_over_capacity']} samples longer than that"
+    )
+
+
+def main():
+    parser = transformers.HfArgumentParser(
+        (ModelArguments, DataArguments, TrainingArguments, PreflightArguments)
+    )
+    model_args, data_args, training_args, preflight_args = (
+        parser.parse_args_into_dataclasses()
+    )
+    data_qwen.local_rank = 0
+    # the analysis needs exact token counts; as a single process it has no barrier to outlast
+    data_args.build_length_index = True
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_args.model_name_or_path,
+        cache_dir=training_args.cache_dir,
+        model_max_length=training_args.model_max_length,
+        padding_side="right",
+        use_fast=False,
+    )
+    if "qwen2.5" in model_args.model_name_or_path.lower():
+        data_args.image_processor = transformers.AutoProcessor.from_pretrained(
+            model_args.model_name_or_path,
+        ).image_processor
+        data_args.model_type = "qwen2.5vl"
+    else:
+        data_args.image_processor = transformers.Qwen2VLImageProcessor.from_pretrained(
+            model_args.model_name_or_path,
+        )
+        data_args.model_type = "qwen2vl"
+
+    summary = preflight(data_args, training_args, tokenizer)
+    print_summary(summary)
+    output = preflight_args.preflight_output or os.path.join(
+        training_args.output_dir, "preflight.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"Saved preflight summary to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -153,6 +153,8 @@ def train(attn_implementation="flash_attention_2"):
         model.visual.print_trainable_parameters()
         model.model.print_trainable_parameters()
 
+    # without --sample_failure_dir, skipped samples are logged per rank next to the checkpoints
+    data_args.sample_failure_log_dir = training_args.output_dir
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
     trainer = Trainer(
         model=model, processing_class=tokenizer, args=training_args, **data_module
@@ -164,6 +166,23 @@ def train(attn_implementation="flash_attention_2"):
     else:
         trainer.train()
     trainer.save_state()
+    if training_args.dataloader_num_workers == 0:
+        # with workers, each one prints its own stats when it exits
+        rank0_print(f"Cache stats: {data_module['train_dataset'].cache_stats()}")
+    # each rank skips the samples it failed to load, so the report needs all of them
+    failure_registry = data_module["train_dataset"].failure_registry
+    flagged = [None] * torch.distributed.get_world_size()
+    torch.distributed.all_gather_object(flagged, failure_registry.flagged())
+    if training_args.should_save:
+        report = failure_registry.write_report(
+            os.path.join(training_args.output_dir, "skipped_samples.json"),
+            [sample for rank_flagged in flagged for sample in rank_flagged],
+        )
+        if report["num_skipped"]:
+            rank0_print(
+                f"Skipped {report['num_skipped']} samples that failed to load "
+                f"({report['num_new']} new in this run), see skipped_samples.json"
+            )
     data_args.image_processor.save_pretrained(training_args.output_dir)
 
     source_path = os.path.join(model_args.model_name_or_path, "chat_template.json")
@@ -1,4 +1,6 @@
 import os
+import copy
+import json
 from typing import Dict, List, Optional, Sequence
 
 import datasets
@@ -18,11 +20,17 @@ from transformers.models.qwen2_vl.modeling_qwen2_vl import (
 )
 from transformers.trainer import (
     ALL_LAYERNORM_LAYERS,
+    TRAINER_STATE_NAME,
     get_parameter_names,
     has_length,
     is_sagemaker_mp_enabled,
 )
-from transformers.trainer_utils import seed_worker
+from transformers.trainer_utils import get_last_checkpoint, seed_worker
+
+from qwenvl.data.data_qwen import FlattenedDataCollatorForSupervisedDataset
+from qwenvl.data.sampler import MixtureSampler, TokenBudgetBatchSampler
+
+MIXTURE_STATE_NAME = "mixture_sampler_{}.json"
 
 
 def _flash_attention_forward(
@@ -387,8 +395,173 @@ def create_optimizer(self):
     return self.optimizer
 
 
+class TokenBudgetDataLoader(DataLoader):
+    """DataLoader over a `TokenBudgetBatchSampler` that already shards batches per rank."""
+
+    def set_epoch(self, epoch: int):
+        self.batch_sampler.set_epoch(epoch)
+
+
+class MixtureDataLoader(DataLoader):
+    """DataLoader over a per-rank `MixtureSampler` that counts the samples handed to the training loop.
+
+    Counting happens here rather than in the sampler, which runs ahead of
+    training by the workers' prefetch.
+    """
+
+    def set_epoch(self, epoch: int):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        self.position = self.sampler.start_position()
+        for batch in super().__iter__():
+            self.position = min(self.position + self.batch_size, len(self.sampler))
+            yield batch
+
+    def state_dict(self) -> Dict:
+        return self.sampler.state_dict(getattr(self, "position", 0))
+
+
+def mixture_resume_state(self, dataloader: MixtureDataLoader, checkpoint: str) -> Dict:
+    """Sampler state saved in `checkpoint`, or derived from its global step if there is none."""
+    state_path = os.path.join(checkpoint, MIXTURE_STATE_NAME.format(self.args.process_index))
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            return json.load(f)
+    with open(os.path.join(checkpoint, TRAINER_STATE_NAME), "r") as f:
+        global_step = json.load(f)["global_step"]
+    accumulation_steps = self.args.gradient_accumulation_steps
+    epoch, step = divmod(global_step, max(len(dataloader) // accumulation_steps, 1))
+    position = step * accumulation_steps * dataloader.batch_size
+    return {"epoch": epoch, "position": min(position, len(dataloader.sampler))}
+
+
+def _original(name: str):
+    """`Trainer.<name>` as it was before any patching.
+
+    train_qwen.py imports this module under two names; keeping the originals
+    on `Trainer` from the first import stops the second from wrapping the
+    first one's wrappers.
+    """
+    originals = Trainer.__dict__.get("_qwenvl_originals")
+    if originals is None:
+        originals = Trainer._qwenvl_originals = {}
+    return originals.setdefault(name, getattr(Trainer, name))
+
+
+def get_mixture_dataloader(self) -> MixtureDataLoader:
+    dataset = self.train_dataset
+    sampler = MixtureSampler(
+        dataset.source_indices(),
+        dataset.source_weights,
+        num_replicas=self.args.world_size,
+        rank=self.args.process_index,
+        seed=self.args.seed,
+    )
+    # not passed through accelerator.prepare, which would shard the samples again
+    dataloader = MixtureDataLoader(
+        dataset,
+        batch_size=self._train_batch_size,
+        sampler=sampler,
+        collate_fn=self.data_collator,
+        drop_last=self.args.dataloader_drop_last,
+        num_workers=self.args.dataloader_num_workers,
+        pin_memory=self.args.dataloader_pin_memory,
+        persistent_workers=self.args.dataloader_persistent_workers,
+        worker_init_fn=seed_worker,
+        prefetch_factor=self.args.dataloader_prefetch_factor,
+    )
+    checkpoint = getattr(self, "_resume_checkpoint", None)
+    if checkpoint is not None and not self.args.ignore_data_skip:
+        sampler.load_state_dict(mixture_resume_state(self, dataloader, checkpoint))
+        # the sampler starts at the saved position; skipping batches again would lose them
+        loop_args = getattr(self, "_loop_args", None)
+        if loop_args is not None:
+            loop_args.ignore_data_skip = True
+    self._mixture_dataloader = dataloader
+    return dataloader
+
+
+_get_train_dataloader = _original("get_train_dataloader")
+
+
+def get_train_dataloader(self) -> DataLoader:
+    weights = getattr(self.train_dataset, "source_weights", [])
+    if any(weight != 1.0 for weight in weights):
+        if self.args.max_tokens_per_batch is not None:
+            raise ValueError(
+                "dataset weights (`name%NN`) cannot be combined with --max_tokens_per_batch"
+            )
+        return get_mixture_dataloader(self)
+
+    if self.args.max_tokens_per_batch is None:
+        return _get_train_dataloader(self)
+
+    batch_sampler = TokenBudgetBatchSampler(
+        self.train_dataset.num_tokens,
+        max_tokens=self.args.max_tokens_per_batch,
+        num_replicas=self.args.world_size,
+        rank=self.args.process_index,
+        seed=self.args.seed,
+        padded=not isinstance(
+            self.data_collator, FlattenedDataCollatorForSupervisedDataset
+        ),
+    )
+    # not passed through accelerator.prepare, which would shard the batches again
+    return TokenBudgetDataLoader(
+        self.train_dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=self.data_collator,
+        num_workers=self.args.dataloader_num_workers,
+        pin_memory=self.args.dataloader_pin_memory,
+        persistent_workers=self.args.dataloader_persistent_workers,
+        worker_init_fn=seed_worker,
+        prefetch_factor=self.args.dataloader_prefetch_factor,
+    )
+
+
+_save_rng_state = _original("_save_rng_state")
+
+
+def save_rng_state(self, output_dir):
+    _save_rng_state(self, output_dir)
+    dataloader = getattr(self, "_mixture_dataloader", None)
+    if dataloader is not None:
+        state_path = os.path.join(output_dir, MIXTURE_STATE_NAME.format(self.args.process_index))
+        with open(state_path, "w") as f:
+            json.dump(dataloader.state_dict(), f)
+
+
+_train = _original("train")
+
+
+def train(self, resume_from_checkpoint=None, *args, **kwargs):
+    # resolved here because the dataloader is built before Trainer loads the checkpoint
+    if resume_from_checkpoint is True:
+        resume_from_checkpoint = get_last_checkpoint(self.args.output_dir) or True
+    self._resume_checkpoint = (
+        resume_from_checkpoint if isinstance(resume_from_checkpoint, str) else None
+    )
+    return _train(self, resume_from_checkpoint, *args, **kwargs)
+
+
+_inner_training_loop = _original("_inner_training_loop")
+
+
+def inner_training_loop(self, batch_size=None, args=None, *rest, **kwargs):
+    # The loop reads `args.ignore_data_skip` after building the dataloader. It
+    # gets a copy, so `get_mixture_dataloader` can turn the skip off for a
+    # resumed run without changing `self.args`, which every checkpoint saves.
+    self._loop_args = copy.copy(args)
+    return _inner_training_loop(self, batch_size, self._loop_args, *rest, **kwargs)
+
+
 # Apply monkey patches
 Trainer.create_optimizer = create_optimizer
+Trainer.get_train_dataloader = get_train_dataloader
+Trainer._save_rng_state = save_rng_state
+Trainer.train = train
+Trainer._inner_training_loop = inner_training_loop
 
 Qwen2VisionTransformerPretrainedModel.print_trainable_parameters = (
     print_trainable_parameters_visual
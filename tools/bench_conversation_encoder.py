@@ -0,0 +1,128 @@
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+
+import torch
+import transformers
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from qwenvl.data.annotations import load_annotations
+from qwenvl.data.data_qwen import (
+    CHAT_TEMPLATE,
+    IGNORE_INDEX,
+    ConversationEncoder,
+)
+
+
+def legacy_preprocess_qwen_2_visual(sources, tokenizer, grid_thw=[], visual_type="image"):
+    """The per-sample deepcopy + apply_chat_template implementation, kept as reference."""
+    roles = {"human": "user", "gpt": "assistant"}
+    system_message = "You are a helpful assistant."
+
+    tokenizer = copy.deepcopy(tokenizer)
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    visual_replicate_index = 0
+    input_ids, targets = [], []
+
+    for source in sources:
+        if roles[source[0]["from"]] != roles["human"]:
+            source = source[1:]
+
+        input_id = tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_message}]
+        )
+        target = [IGNORE_INDEX] * len(input_id)
+
+        for conv in source:
+            role = roles.get(conv["from"], conv["from"])
+            content = conv["value"]
+            if role == "user":
+                visual_tag = f"<{visual_type}>"
+                if visual_tag in content:
+                    parts = content.split(visual_tag)
+                    new_parts = []
+                    for i in range(len(parts) - 1):
+                        new_parts.append(parts[i])
+                        new_parts.append(
+                            "<|vision_start|>"
+                            + f"<|{visual_type}_pad|>" * grid_thw[visual_replicate_index]
+                            + "<|vision_end|>"
+                        )
+                        visual_replicate_index += 1
+                    new_parts.append(parts[-1])
+                    content = "".join(new_parts)
+
+            encode_id = tokenizer.apply_chat_template([{"role": role, "content": content}])
+            input_id += encode_id
+            if role in ["user", "system"]:
+                target += [IGNORE_INDEX] * len(encode_id)
+            else:
+                target += [IGNORE_INDEX] * 3 + encode_id[3:]
+
+        input_ids.append(input_id)
+        targets.append(target)
+
+    return dict(
+        input_ids=torch.tensor(input_ids, dtype=torch.long),
+        labels=torch.tensor(targets, dtype=torch.long),
+    )
+
+
+def run(fn, samples, grid_tokens):
+    outputs = []
+    start = time.perf_counter()
+    for sample in samples:
+        num_images = sum(
+            conv["value"].count("<image>") for conv in sample["conversations"]
+        )
+        outputs.append(
+            fn(
+                [copy.deepcopy(sample["conversations"])],
+                grid_thw=[grid_tokens] * num_images,
+            )
+        )
+    return outputs, len(samples) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare samples/sec of the legacy and cached conversation encoders."
+    )
+    parser.add_argument("--model_name_or_path", default="Qwen/Qwen2.5-VL-3B-Instruct")
+    parser.add_argument("--annotation_path", default="frozenlake/train.json")
+    parser.add_argument("--num_samples", type=int, default=500)
+    parser.add_argument("--grid_tokens", type=int, default=64)
+    parser.add_argument("--use_fast", action="store_true")
+    args = parser.parse_args()
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.model_name_or_path, use_fast=args.use_fast
+    )
+    annotations = load_annotations(args.annotation_path)
+    samples = [annotations[i] for i in range(min(args.num_samples, len(annotations)))]
+
+    legacy_outputs, legacy_rate = run(
+        lambda sources, grid_thw: legacy_preprocess_qwen_2_visual(
+            sources, tokenizer, grid_thw=grid_thw
+        ),
+        samples,
+        args.grid_tokens,
+    )
+    encoder = ConversationEncoder(tokenizer)
+    outputs, rate = run(encoder, samples, args.grid_tokens)
+
+    for legacy, output in zip(legacy_outputs, outputs):
+        assert torch.equal(legacy["input_ids"], output["input_ids"])
+        assert torch.equal(legacy["labels"], output["labels"])
+
+    print(f"samples: {len(samples)} (outputs identical)")
+    print(f"legacy  : {legacy_rate:10.1f} samples/sec")
+    print(f"encoder : {rate:10.1f} samples/sec ({rate / legacy_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
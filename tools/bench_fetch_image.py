@@ -0,0 +1,70 @@
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+# time decoding, not the media cache
+os.environ["QWENVL_MEDIA_CACHE_MB"] = "0"
+os.environ.pop("QWENVL_MEDIA_CACHE_DIR", None)
+sys.path.append(str(Path(__file__).parent.parent / "qwen-vl-utils" / "src"))
+
+from qwen_vl_utils import vision_process
+
+
+def make_photos(directory, size, quality):
+    """Large JPEGs: a demo photo upscaled, and the same photo mixed with fine texture."""
+    photo = Image.open(Path(__file__).parent.parent / "demo/images/COCO_train2014_000000580957.jpg").convert("RGB")
+    photo = photo.resize(size, Image.LANCZOS)
+    noise = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    textured = Image.blend(Image.fromarray(noise).filter(ImageFilter.GaussianBlur(1.5)), photo, 0.5)
+    paths = []
+    for name, image in (("photo", photo), ("textured", textured)):
+        path = os.path.join(directory, f"{name}_{size[0]}x{size[1]}.jpg")
+        image.save(path, quality=quality)
+        paths.append(path)
+    return paths
+
+
+def run(paths, max_pixels, draft, repeats):
+    vision_process.IMAGE_DRAFT_DECODE = draft
+    images = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        images = [vision_process.fetch_image({"image": path, "max_pixels": max_pixels}) for path in paths]
+    return images, (time.perf_counter() - start) / (repeats * len(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fetch_image with and without JPEG draft decoding.")
+    parser.add_argument("--image_glob", default="demo/images/*", help="Extra images to include")
+    parser.add_argument("--width", type=int, default=4032)
+    parser.add_argument("--height", type=int, default=3024)
+    parser.add_argument("--quality", type=int, default=92)
+    parser.add_argument("--max_pixels", type=int, nargs="+", default=[50176, 200704, 1003520])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"decode backend: {vision_process.get_image_decode_backend()}")
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_photos(directory, (args.width, args.height), args.quality) + sorted(glob.glob(args.image_glob))
+        for max_pixels in args.max_pixels:
+            for path in paths:
+                (full,), full_time = run([path], max_pixels, False, args.repeats)
+                (fast,), fast_time = run([path], max_pixels, True, args.repeats)
+                assert full.size == fast.size
+                diff = np.abs(np.asarray(full, dtype=np.int16) - np.asarray(fast, dtype=np.int16))
+                print(
+                    f"max_pixels {max_pixels:>8} {os.path.basename(path):<36} -> {fast.size[0]}x{fast.size[1]}: "
+                    f"{full_time * 1000:7.1f} ms -> {fast_time * 1000:6.1f} ms ({full_time / fast_time:4.1f}x), "
+                    f"mean abs diff {diff.mean():.2f}, p99 {np.percentile(diff, 99):.0f}, max {diff.max()}"
+                )
+
+
+if __name__ == "__main__":
+    main()
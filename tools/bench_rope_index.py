@@ -0,0 +1,470 @@
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+import torch
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from qwenvl.data.rope2d import (
+    get_rope_index_2,
+    get_rope_index_25,
+    rope_template_cache,
+)
+
+IMAGE_TOKEN_ID = 151655
+VIDEO_TOKEN_ID = 151656
+VISION_START_TOKEN_ID = 151652
+VISION_END_TOKEN_ID = 151653
+TEXT_TOKEN_ID = 100
+
+
+def legacy_get_rope_index_25(
+    spatial_merge_size: Optional[int] = 2,
+    input_ids: Optional[torch.LongTensor] = None,
+    image_grid_thw: Optional[torch.LongTensor] = None,
+    video_grid_thw: Optional[torch.LongTensor] = None,
+    second_per_grid_ts: Optional[torch.Tensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The per-sequence loop implementation, kept as reference."""
+    image_token_id = 151655
+    video_token_id = 151656
+    vision_start_token_id = 151652
+    mrope_position_deltas = []
+    if input_ids is not None and (
+        image_grid_thw is not None or video_grid_thw is not None
+    ):
+        total_input_ids = input_ids
+        if attention_mask is None:
+            attention_mask = torch.ones_like(total_input_ids)
+        position_ids = torch.ones(
+            3,
+            input_ids.shape[0],
+            input_ids.shape[1],
+            dtype=input_ids.dtype,
+            device=input_ids.device,
+        )
+        image_index, video_index = 0, 0
+        attention_mask = attention_mask.to(total_input_ids.device)
+        for i, input_ids in enumerate(total_input_ids):
+            input_ids = input_ids[attention_mask[i] == 1]
+            image_nums, video_nums = 0, 0
+            vision_start_indices = torch.argwhere(
+                input_ids == vision_start_token_id
+            ).squeeze(1)
+            vision_tokens = input_ids[vision_start_indices + 1]
+            image_nums = (vision_tokens == image_token_id).sum()
+            video_nums = (vision_tokens == video_token_id).sum()
+            input_tokens = input_ids.tolist()
+            llm_pos_ids_list: list = []
+            st = 0
+            remain_images, remain_videos = image_nums, video_nums
+            for _ in range(image_nums + video_nums):
+                if image_token_id in input_tokens and remain_images > 0:
+                    ed_image = input_tokens.index(image_token_id, st)
+                else:
+                    ed_image = len(input_tokens) + 1
+                if video_token_id in input_tokens and remain_videos > 0:
+                    ed_video = input_tokens.index(video_token_id, st)
+                else:
+                    ed_video = len(input_tokens) + 1
+                if ed_image < ed_video:
+                    t, h, w = (
+                        image_grid_thw[image_index][0],
+                        image_grid_thw[image_index][1],
+                        image_grid_thw[image_index][2],
+                    )
+                    second_per_grid_t = 0
+                    image_index += 1
+                    remain_images -= 1
+                    ed = ed_image
+
+                else:
+                    t, h, w = (
+                        video_grid_thw[video_index][0],
+                        video_grid_thw[video_index][1],
+                        video_grid_thw[video_index][2],
+                    )
+                    if second_per_grid_ts is not None:
+                        second_per_grid_t = second_per_grid_ts[video_index]
+                    else:
+                        second_per_grid_t = 1.0
+                    video_index += 1
+                    remain_videos -= 1
+                    ed = ed_video
+                llm_grid_t, llm_grid_h, llm_grid_w = (
+                    t.item(),
+                    h.item() // spatial_merge_size,
+                    w.item() // spatial_merge_size,
+                )
+                text_len = ed - st
+
+                st_idx = (
+                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+                )
+                llm_pos_ids_list.append(
+                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
+                )
+
+                range_tensor = torch.arange(llm_grid_t).view(-1, 1)
+                expanded_range = range_tensor.expand(-1, llm_grid_h * llm_grid_w)
+
+                time_tensor = expanded_range * second_per_grid_t * 2
+
+                time_tensor_long = time_tensor.long()
+                t_index = time_tensor_long.flatten()
+
+                h_index = (
+                    torch.arange(llm_grid_h)
+                    .view(1, -1, 1)
+                    .expand(llm_grid_t, -1, llm_grid_w)
+                    .flatten()
+                )
+                w_index = (
+                    torch.arange(llm_grid_w)
+                    .view(1, 1, -1)
+                    .expand(llm_grid_t, llm_grid_h, -1)
+                    .flatten()
+                )
+                llm_pos_ids_list.append(
+                    torch.stack([t_index, h_index, w_index]) + text_len + st_idx
+                )
+                st = ed + llm_grid_t * llm_grid_h * llm_grid_w
+
+            if st < len(input_tokens):
+                st_idx = (
+                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+                )
+                text_len = len(input_tokens) - st
+                llm_pos_ids_list.append(
+                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
+                )
+
+            llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
+            position_ids[..., i, attention_mask[i] == 1] = llm_positions.to(
+                position_ids.device
+            )
+            mrope_position_deltas.append(
+                llm_positions.max() + 1 - len(total_input_ids[i])
+            )
+        mrope_position_deltas = torch.tensor(
+            mrope_position_deltas, device=input_ids.device
+        ).unsqueeze(1)
+        return position_ids, mrope_position_deltas
+    else:
+        if attention_mask is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = (
+                position_ids.unsqueeze(0).expand(3, -1, -1).to(attention_mask.device)
+            )
+            max_position_ids = position_ids.max(0, keepdim=False)[0].max(
+                -1, keepdim=True
+            )[0]
+            mrope_position_deltas = max_position_ids + 1 - attention_mask.shape[-1]
+        else:
+            position_ids = (
+                torch.arange(input_ids.shape[1], device=input_ids.device)
+                .view(1, 1, -1)
+                .expand(3, input_ids.shape[0], -1)
+            )
+            mrope_position_deltas = torch.zeros(
+                [input_ids.shape[0], 1],
+                device=input_ids.device,
+                dtype=input_ids.dtype,
+            )
+
+        return position_ids, mrope_position_deltas
+
+
+def legacy_get_rope_index_2(
+    spatial_merge_size: Optional[int] = 2,
+    input_ids: Optional[torch.LongTensor] = None,
+    image_grid_thw: Optional[torch.LongTensor] = None,
+    video_grid_thw: Optional[torch.LongTensor] = None,
+    second_per_grid_ts: Optional[torch.Tensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The per-sequence loop implementation, kept as reference."""
+    image_token_id = 151655
+    video_token_id = 151656
+    vision_start_token_id = 151652
+    mrope_position_deltas = []
+    if input_ids is not None and (
+        image_grid_thw is not None or video_grid_thw is not None
+    ):
+        total_input_ids = input_ids
+        if attention_mask is None:
+            attention_mask = torch.ones_like(total_input_ids)
+        position_ids = torch.ones(
+            3,
+            input_ids.shape[0],
+            input_ids.shape[1],
+            dtype=input_ids.dtype,
+            device=input_ids.device,
+        )
+        image_index, video_index = 0, 0
+        for i, input_ids in enumerate(total_input_ids):
+            input_ids = input_ids[attention_mask[i] == 1]
+            image_nums, video_nums = 0, 0
+            vision_start_indices = torch.argwhere(
+                input_ids == vision_start_token_id
+            ).squeeze(1)
+            vision_tokens = input_ids[vision_start_indices + 1]
+            image_nums = (vision_tokens == image_token_id).sum()
+            video_nums = (vision_tokens == video_token_id).sum()
+            input_tokens = input_ids.tolist()
+            llm_pos_ids_list: list = []
+            st = 0
+            remain_images, remain_videos = image_nums, video_nums
+            for _ in range(image_nums + video_nums):
+                if image_token_id in input_tokens and remain_images > 0:
+                    ed_image = input_tokens.index(image_token_id, st)
+                else:
+                    ed_image = len(input_tokens) + 1
+                if video_token_id in input_tokens and remain_videos > 0:
+                    ed_video = input_tokens.index(video_token_id, st)
+                else:
+                    ed_video = len(input_tokens) + 1
+                if ed_image < ed_video:
+                    t, h, w = (
+                        image_grid_thw[image_index][0],
+                        image_grid_thw[image_index][1],
+                        image_grid_thw[image_index][2],
+                    )
+                    image_index += 1
+                    remain_images -= 1
+                    ed = ed_image
+                else:
+                    t, h, w = (
+                        video_grid_thw[video_index][0],
+                        video_grid_thw[video_index][1],
+                        video_grid_thw[video_index][2],
+                    )
+                    video_index += 1
+                    remain_videos -= 1
+                    ed = ed_video
+                llm_grid_t, llm_grid_h, llm_grid_w = (
+                    t.item(),
+                    h.item() // spatial_merge_size,
+                    w.item() // spatial_merge_size,
+                )
+                text_len = ed - st
+
+                st_idx = (
+                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+                )
+                llm_pos_ids_list.append(
+                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
+                )
+
+                t_index = (
+                    torch.arange(llm_grid_t)
+                    .view(-1, 1)
+                    .expand(-1, llm_grid_h * llm_grid_w)
+                    .flatten()
+                )
+                h_index = (
+                    torch.arange(llm_grid_h)
+                    .view(1, -1, 1)
+                    .expand(llm_grid_t, -1, llm_grid_w)
+                    .flatten()
+                )
+                w_index = (
+                    torch.arange(llm_grid_w)
+                    .view(1, 1, -1)
+                    .expand(llm_grid_t, llm_grid_h, -1)
+                    .flatten()
+                )
+                llm_pos_ids_list.append(
+                    torch.stack([t_index, h_index, w_index]) + text_len + st_idx
+                )
+                st = ed + llm_grid_t * llm_grid_h * llm_grid_w
+
+            if st < len(input_tokens):
+                st_idx = (
+                    llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+                )
+                text_len = len(input_tokens) - st
+                llm_pos_ids_list.append(
+                    torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx
+                )
+
+            llm_positions = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1)
+            position_ids[..., i, attention_mask[i] == 1] = llm_positions.to(
+                position_ids.device
+            )
+            mrope_position_deltas.append(
+                llm_positions.max() + 1 - len(total_input_ids[i])
+            )
+        mrope_position_deltas = torch.tensor(
+            mrope_position_deltas, device=input_ids.device
+        ).unsqueeze(1)
+        return position_ids, mrope_position_deltas
+    else:
+        if attention_mask is not None:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+            position_ids.masked_fill_(attention_mask == 0, 1)
+            position_ids = (
+                position_ids.unsqueeze(0).expand(3, -1, -1).to(attention_mask.device)
+            )
+            max_position_ids = position_ids.max(0, keepdim=False)[0].max(
+                -1, keepdim=True
+            )[0]
+            mrope_position_deltas = max_position_ids + 1 - attention_mask.shape[-1]
+        else:
+            position_ids = (
+                torch.arange(input_ids.shape[1], device=input_ids.device)
+                .view(1, 1, -1)
+                .expand(3, input_ids.shape[0], -1)
+            )
+            mrope_position_deltas = torch.zeros(
+                [input_ids.shape[0], 1],
+                device=input_ids.device,
+                dtype=input_ids.dtype,
+            )
+
+        return position_ids, mrope_position_deltas
+
+
+def random_sample(rng, num_media, max_grid, merge_size=2, max_text=32):
+    """Return token ids of a random interleaved sample and its image/video grids."""
+    ids, image_grids, video_grids, seconds = [], [], [], []
+    for _ in range(num_media):
+        ids += [TEXT_TOKEN_ID] * rng.randint(0, max_text)
+        is_video = rng.random() < 0.3
+        t = rng.randint(1, 4) if is_video else 1
+        h = rng.randint(1, max_grid) * merge_size
+        w = rng.randint(1, max_grid) * merge_size
+        pad_id = VIDEO_TOKEN_ID if is_video else IMAGE_TOKEN_ID
+        ids += [VISION_START_TOKEN_ID]
+        ids += [pad_id] * (t * h * w // merge_size**2)
+        ids += [VISION_END_TOKEN_ID]
+        if is_video:
+            video_grids.append([t, h, w])
+            seconds.append(rng.choice([0.5, 1.0, 2 / 3, 1.37]))
+        else:
+            image_grids.append([t, h, w])
+    ids += [TEXT_TOKEN_ID] * rng.randint(1, max_text)
+    return ids, image_grids, video_grids, seconds
+
+
+def as_grid(grids):
+    return torch.tensor(grids, dtype=torch.long).view(-1, 3) if grids else None
+
+
+def check_equivalence(rng, num_trials, legacy_fn, fn):
+    for _ in range(num_trials):
+        batch = [
+            random_sample(rng, rng.randint(0, 4), max_grid=6)
+            for _ in range(rng.randint(1, 4))
+        ]
+        image_grids = sum((sample[1] for sample in batch), [])
+        video_grids = sum((sample[2] for sample in batch), [])
+        seconds = sum((sample[3] for sample in batch), [])
+        if not image_grids and not video_grids:
+            continue
+
+        # batched, left or right padded
+        max_length = max(len(sample[0]) for sample in batch)
+        left = rng.random() < 0.5
+        input_ids = torch.zeros(len(batch), max_length, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, (ids, _, _, _) in enumerate(batch):
+            span = slice(max_length - len(ids), None) if left else slice(0, len(ids))
+            input_ids[i, span] = torch.tensor(ids)
+            attention_mask[i, span] = 1
+        kwargs = dict(
+            image_grid_thw=as_grid(image_grids),
+            video_grid_thw=as_grid(video_grids),
+            second_per_grid_ts=seconds if seconds else None,
+            attention_mask=attention_mask,
+        )
+        expected = legacy_fn(2, input_ids, **kwargs)
+        actual = fn(2, input_ids, **kwargs)
+        assert torch.equal(expected[0], actual[0]), "position_ids differ"
+        assert torch.equal(expected[1], actual[1]), "mrope_position_deltas differ"
+
+        # packed: compare each sequence against its own reference call
+        packed = torch.tensor([sum((sample[0] for sample in batch), [])])
+        cu_seqlens = torch.tensor(
+            [0] + [len(sample[0]) for sample in batch]
+        ).cumsum(0)
+        position_ids, deltas = fn(
+            2, packed, cu_seqlens=cu_seqlens, **{**kwargs, "attention_mask": None}
+        )
+        for i, (ids, sample_images, sample_videos, sample_seconds) in enumerate(batch):
+            expected = legacy_fn(
+                2,
+                torch.tensor([ids]),
+                image_grid_thw=as_grid(sample_images),
+                video_grid_thw=as_grid(sample_videos),
+                second_per_grid_ts=sample_seconds if sample_seconds else None,
+            )
+            segment = slice(int(cu_seqlens[i]), int(cu_seqlens[i + 1]))
+            assert torch.equal(expected[0][:, 0], position_ids[:, 0, segment])
+            assert torch.equal(expected[1][0], deltas[i])
+
+
+def benchmark(fn, input_ids, kwargs, repeats):
+    fn(2, input_ids, **kwargs)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(2, input_ids, **kwargs)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the vectorized rope index functions against the loop implementations and time them."
+    )
+    parser.add_argument("--num_trials", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_images", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for legacy_fn, fn in [
+        (legacy_get_rope_index_25, get_rope_index_25),
+        (legacy_get_rope_index_2, get_rope_index_2),
+    ]:
+        check_equivalence(rng, args.num_trials, legacy_fn, fn)
+        print(
+            f"{fn.__name__}: {args.num_trials} randomized batched/packed trials, outputs identical"
+        )
+
+    batch = [
+        random_sample(rng, args.num_images, max_grid=16, max_text=64)
+        for _ in range(args.batch_size)
+    ]
+    max_length = max(len(sample[0]) for sample in batch)
+    input_ids = torch.zeros(len(batch), max_length, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, (ids, _, _, _) in enumerate(batch):
+        input_ids[i, : len(ids)] = torch.tensor(ids)
+        attention_mask[i, : len(ids)] = 1
+    kwargs = dict(
+        image_grid_thw=as_grid(sum((sample[1] for sample in batch), [])),
+        video_grid_thw=as_grid(sum((sample[2] for sample in batch), [])),
+        second_per_grid_ts=sum((sample[3] for sample in batch), []) or None,
+        attention_mask=attention_mask,
+    )
+    legacy_ms = benchmark(legacy_get_rope_index_25, input_ids, kwargs, args.repeats)
+    rope_template_cache.clear()
+    vectorized_ms = benchmark(get_rope_index_25, input_ids, kwargs, args.repeats)
+    print(
+        f"batch {args.batch_size} x {max_length} tokens, {args.num_images} media per sequence"
+    )
+    print(f"legacy    : {legacy_ms:8.2f} ms")
+    print(f"vectorized: {vectorized_ms:8.2f} ms ({legacy_ms / vectorized_ms:.1f}x)")
+    print(f"rope template cache: {rope_template_cache.info()}")
+
+
+if __name__ == "__main__":
+    main()
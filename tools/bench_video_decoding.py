@@ -0,0 +1,87 @@
+import argparse
+import glob
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+from decord import VideoReader
+from transformers import Qwen2VLImageProcessor
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from qwenvl.data.data_qwen import video_frame_indices
+from qwenvl.data.video_decoding import VideoReaderCache, decoder_threads
+from qwenvl.data.vision_processing import VisionProcessor
+
+
+def open_per_access(video_file):
+    # what process_video did before the reader cache
+    return VideoReader(video_file, num_threads=4)
+
+
+def run(open_reader, video_files, repeats, processor, data_args):
+    outputs, num_frames = [], 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for video_file in video_files:
+            vr = open_reader(video_file)
+            frame_idx = video_frame_indices(len(vr), vr.get_avg_fps(), data_args)
+            video = vr.get_batch(frame_idx).asnumpy()
+            outputs.append(processor(video, video=True))
+            num_frames += len(frame_idx)
+    return outputs, num_frames / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time LazySupervisedDataset.process_video decoding paths on sample clips."
+    )
+    parser.add_argument("--video_glob", default="demo/videos/*.mp4")
+    parser.add_argument("--repeats", type=int, default=5, help="Accesses per clip, as for several samples per video")
+    parser.add_argument("--video_min_frame_pixels", type=int, default=4 * 28 * 28)
+    parser.add_argument("--video_max_frame_pixels", type=int, default=32 * 28 * 28)
+    parser.add_argument("--video_max_frames", type=int, default=8)
+    parser.add_argument("--base_interval", type=int, default=2)
+    args = parser.parse_args()
+
+    video_files = sorted(glob.glob(args.video_glob))
+    image_processor = Qwen2VLImageProcessor()
+    data_args = SimpleNamespace(
+        base_interval=args.base_interval, video_min_frames=4, video_max_frames=args.video_max_frames
+    )
+    processor = VisionProcessor(
+        image_processor, args.video_min_frame_pixels, args.video_max_frame_pixels
+    )
+    factor = image_processor.patch_size * image_processor.merge_size
+    paths = {
+        "new reader per access": open_per_access,
+        "cached readers": VideoReaderCache(
+            args.video_min_frame_pixels, args.video_max_frame_pixels, factor
+        ).get,
+        "cached, reduced decode": VideoReaderCache(
+            args.video_min_frame_pixels, args.video_max_frame_pixels, factor, reduced=True
+        ).get,
+    }
+    print(f"{len(video_files)} clips x {args.repeats} accesses, {decoder_threads()} decoder threads per cached reader")
+    run(open_per_access, video_files, 1, processor, data_args)  # warm up the page cache
+    reference, reference_rate = None, None
+    for name, open_reader in paths.items():
+        outputs, rate = run(open_reader, video_files, args.repeats, processor, data_args)
+        line = f"{name:<24}: {rate:8.1f} frames/sec"
+        if reference is None:
+            reference, reference_rate = outputs, rate
+        else:
+            max_diff, mean_diff = 0.0, 0.0
+            for (ref_pixels, ref_grid), (pixels, grid) in zip(reference, outputs):
+                assert torch.equal(ref_grid, grid), (ref_grid, grid)
+                diff = (ref_pixels - pixels).abs()
+                max_diff = max(max_diff, diff.max().item())
+                mean_diff += diff.mean().item() / len(outputs)
+            line += f" ({rate / reference_rate:.2f}x), pixel_values max abs diff {max_diff:.4f}, mean {mean_diff:.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
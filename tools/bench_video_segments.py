@@ -0,0 +1,138 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import av
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent / "qwen-vl-utils" / "src"))
+
+from qwen_vl_utils import vision_process
+
+
+def make_video(path, seconds, fps, width, height, gop):
+    """Synthetic clip: a moving gradient with noise, so frames neither repeat nor compress to nothing."""
+    codec = "libx264" if "libx264" in av.codecs_available else "mpeg4"
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    with av.open(path, "w") as container:
+        stream = container.add_stream(codec, rate=fps)
+        stream.width, stream.height, stream.pix_fmt = width, height, "yuv420p"
+        stream.gop_size = gop
+        if codec == "libx264":
+            stream.options = {"preset": "ultrafast", "keyint": str(gop)}
+        noise = rng.integers(0, 32, (16, height, width, 3), dtype=np.uint8)
+        for i in range(int(seconds * fps)):
+            frame = np.empty((height, width, 3), dtype=np.uint8)
+            frame[..., 0] = (x + 4 * i) % 256
+            frame[..., 1] = (y + 2 * i) % 256
+            frame[..., 2] = (x + y + i) % 256
+            frame += noise[i % len(noise)]
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return codec
+
+
+def read_all(ele):
+    """What `_read_video_torchvision` did with `io.read_video`: decode every frame of the segment, then index."""
+    with av.open(ele["video"]) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        time_base, start = float(stream.time_base), ele.get("video_start", 0.0)
+        end = ele.get("video_end", float("inf"))
+        frames = [
+            frame.to_ndarray(format="rgb24")
+            for frame in container.decode(stream)
+            if start - 1e-6 <= frame.pts * time_base <= end + 1e-6
+        ]
+        video_fps = float(stream.average_rate)
+    video = np.stack(frames)
+    nframes = vision_process.smart_nframes(ele, total_frames=len(video), video_fps=video_fps)
+    idx = np.linspace(0, len(video) - 1, nframes).round().astype(int)
+    return video[idx]
+
+
+READERS = {
+    "decode all, then index": read_all,
+    "pyav, seek per keyframe": lambda ele: vision_process._read_video_torchvision(ele)[0],
+    "decord": lambda ele: vision_process._read_video_decord(ele)[0],
+}
+
+
+def measure(reader, ele, queue):
+    start = time.perf_counter()
+    video = READERS[reader](ele) if reader else None
+    queue.put(
+        dict(
+            seconds=time.perf_counter() - start,
+            peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            frames=0 if video is None else int(video.shape[0]),
+            checksum=0 if video is None else int(np.asarray(video, dtype=np.int64).sum()),
+        )
+    )
+
+
+def run(reader, ele):
+    """Run one read in a fresh forked process, so its peak RSS is its own."""
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(reader, ele, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and peak memory of the qwen-vl-utils video readers on long synthetic videos.")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[60, 240])
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--width", type=int, default=480)
+    parser.add_argument("--height", type=int, default=270)
+    parser.add_argument("--gop", type=int, default=50, help="Frames between keyframes")
+    parser.add_argument("--output", default=None, help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    readers = list(READERS) if vision_process.is_decord_available() else list(READERS)[:2]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for seconds in args.seconds:
+            path = os.path.join(directory, f"synthetic_{int(seconds)}s.mp4")
+            start = time.perf_counter()
+            codec = make_video(path, seconds, args.fps, args.width, args.height, args.gop)
+            print(
+                f"\n{seconds:.0f}s {args.width}x{args.height} @ {args.fps} fps, {codec}, keyframe every {args.gop} frames "
+                f"(encoded in {time.perf_counter() - start:.0f}s)"
+            )
+            baseline = run(None, {})["peak_rss_mb"]
+            requests = {
+                "whole video, 0.5 fps": dict(video=path, fps=0.5),
+                "whole video, 2 fps": dict(video=path, fps=2.0),
+                "30s segment in the middle, 2 fps": dict(video=path, video_start=seconds / 2, video_end=seconds / 2 + 30, fps=2.0),
+            }
+            for name, ele in requests.items():
+                checksums = set()
+                for reader in readers:
+                    result = run(reader, ele)
+                    checksums.add(result["checksum"])
+                    print(
+                        f"  {name:<34} {reader:<24}: {result['frames']:4d} frames in {result['seconds']:6.2f}s, "
+                        f"peak RSS +{result['peak_rss_mb'] - baseline:7.1f} MB"
+                    )
+                    results.append(dict(video_seconds=seconds, request=name, reader=reader, **result))
+                print(f"  {'':<34} identical frames: {len(checksums) == 1}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
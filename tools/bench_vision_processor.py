@@ -0,0 +1,75 @@
+import argparse
+import glob
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import Qwen2VLImageProcessor
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from qwenvl.data.vision_processing import VisionProcessor
+
+
+def run(processor, visuals, video):
+    outputs = []
+    start = time.perf_counter()
+    for visual in visuals:
+        outputs.append(processor(visual, video=video))
+    return outputs, len(visuals) / (time.perf_counter() - start)
+
+
+def compare(name, visuals, video, min_pixels, max_pixels, rescale_factor):
+    image_processor = Qwen2VLImageProcessor()
+    reference = VisionProcessor(image_processor, min_pixels, max_pixels)
+    fast = VisionProcessor(image_processor, min_pixels, max_pixels, fast=True)
+    ref_outputs, ref_rate = run(reference, visuals, video)
+    fast_outputs, fast_rate = run(fast, visuals, video)
+    max_diff, num_diff, num_values = 0.0, 0, 0
+    for (ref_pixels, ref_grid), (pixels, grid) in zip(ref_outputs, fast_outputs):
+        assert torch.equal(ref_grid, grid), (ref_grid, grid)
+        assert ref_pixels.shape == pixels.shape and ref_pixels.dtype == pixels.dtype
+        diff = (ref_pixels - pixels).abs()
+        max_diff = max(max_diff, diff.max().item())
+        num_diff += int((diff > 0).sum())
+        num_values += diff.numel()
+    # two uint8 levels after rescale and normalize by the smallest std
+    tolerance = 2 * rescale_factor / min(image_processor.image_std) * 1.001
+    assert max_diff <= tolerance, f"{name}: max abs diff {max_diff} > {tolerance}"
+    assert num_diff <= 1e-3 * num_values, f"{name}: {num_diff}/{num_values} values differ"
+    print(
+        f"{name}: {len(visuals)} inputs, max abs diff {max_diff:.4f} (tolerance {tolerance:.4f}), "
+        f"{num_diff}/{num_values} values differ"
+    )
+    print(f"  Qwen2VLImageProcessor: {ref_rate:8.1f} /sec")
+    print(f"  fast path            : {fast_rate:8.1f} /sec ({fast_rate / ref_rate:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the fast vision processor against Qwen2VLImageProcessor and time both."
+    )
+    parser.add_argument("--image_glob", default="demo/images/*")
+    parser.add_argument("--max_pixels", type=int, default=28 * 28 * 576)
+    parser.add_argument("--min_pixels", type=int, default=28 * 28 * 16)
+    parser.add_argument("--num_videos", type=int, default=8)
+    parser.add_argument("--num_frames", type=int, default=8)
+    args = parser.parse_args()
+    rescale_factor = Qwen2VLImageProcessor().rescale_factor
+
+    images = [Image.open(path).convert("RGB") for path in sorted(glob.glob(args.image_glob))]
+    compare("images", images, False, args.min_pixels, args.max_pixels, rescale_factor)
+
+    rng = np.random.default_rng(0)
+    videos = [
+        rng.integers(0, 256, size=(args.num_frames + i % 2, 360, 640, 3), dtype=np.uint8)
+        for i in range(args.num_videos)
+    ]
+    compare("videos", videos, True, 4 * 28 * 28, 32 * 28 * 28, rescale_factor)
+
+
+if __name__ == "__main__":
+    main()
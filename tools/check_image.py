@@ -1,40 +1,140 @@
-import json
 import os
+import sys
+import json
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
 from tqdm import tqdm
-from datasets import load_dataset
 
-def validate_data(json_file_path, media_folder_path):
+sys.path.append(str(Path(__file__).parent.parent))
+
+from qwenvl.data.annotations import annotation_jsonl
+from qwenvl.data.length_index import video_grid_thw
+from qwenvl.data.token_cache import image_grid_thw
+
+# at most this many records per worker are read ahead of the writer
+RECORDS_IN_FLIGHT_PER_WORKER = 64
+MAX_REPORTED_FILES = 5
+
+
+def read_records(jsonl_path):
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def media_files(item):
+    """Image and video paths of a record, supporting both singular and plural fields."""
+    media_info = {
+        'image': item.get("image", item.get("images", [])),
+        'video': item.get("video", item.get("videos", []))
+    }
+    for media_type in media_info:
+        if isinstance(media_info[media_type], str):
+            media_info[media_type] = [media_info[media_type]]
+        elif not isinstance(media_info[media_type], list):
+            media_info[media_type] = []
+    return media_info
+
+
+def probe_media(item, media_folder_path, data_args):
+    """Check that every media file of a record exists and parses, reading headers only.
+
+    Runs on the thread pool. Returns `(media_info, grid_thw, missing, unreadable)`.
     """
-    Main function to validate JSON data by checking:
-    1. Media file existence (supports both image and video fields)
+    image_processor = data_args.image_processor
+    media_info = media_files(item)
+    grid_thw, missing, unreadable = [], [], []
+    for media_type, files in media_info.items():
+        for media_file in files:
+            media_path = os.path.join(media_folder_path, media_file)
+            try:
+                if media_type == 'image':
+                    thw = image_grid_thw(
+                        media_path,
+                        image_processor.patch_size,
+                        image_processor.merge_size,
+                        data_args.min_pixels,
+                        data_args.max_pixels,
+                    )
+                else:
+                    thw = video_grid_thw(media_path, data_args)
+            except FileNotFoundError:
+                missing.append(media_path)
+                continue
+            except Exception as e:
+                if not os.path.exists(media_path):
+                    missing.append(media_path)
+                else:
+                    unreadable.append({'file': media_path, 'error': f"{type(e).__name__}: {e}"})
+                continue
+            grid_thw.append(thw)
+    return media_info, grid_thw, missing, unreadable
+
+
+def summarize(counts):
+    """Mean and percentiles of a `{value: count}` histogram."""
+    values = np.array(sorted(counts), dtype=np.int64)
+    cumulative = np.cumsum([counts[v] for v in values])
+    mean = float(np.dot(values, np.diff(cumulative, prepend=0))) / cumulative[-1]
+    p50, p90, p99 = (values[np.searchsorted(cumulative, q * cumulative[-1])] for q in (0.5, 0.9, 0.99))
+    return f"mean {mean:.0f}, p50 {p50}, p90 {p90}, p99 {p99}, max {values[-1]}"
+
+
+def count_tokens(item, grid_thw, visual_type, tokenizer, merge_size):
+    """Total tokens (text plus vision) the training dataset produces for a record."""
+    from qwenvl.data.data_qwen import preprocess_qwen_2_visual
+
+    grid_thw_merged = [int(np.prod(thw)) // merge_size**2 for thw in grid_thw]
+    data_dict = preprocess_qwen_2_visual(
+        [item["conversations"]], tokenizer, grid_thw=grid_thw_merged, visual_type=visual_type
+    )
+    return data_dict["input_ids"].shape[1]
+
+
+def validate_data(
+    json_file_path,
+    media_folder_path,
+    data_args,
+    tokenizer=None,
+    model_max_length=None,
+    num_workers=16,
+):
+    """
+    Validate JSON/JSONL data by checking:
+    1. Media file existence and readable headers (supports both image and video fields)
     2. Media token consistency in conversations
-    Saves valid and problematic data to separate files
+    3. Token count, as `smart_resize` grids of the media plus the text if a tokenizer is given,
+       against `model_max_length`
+    Records are streamed to `<name>_valid.jsonl` and `<name>_problems.jsonl` in input order;
+    media are probed on `num_workers` threads with a bounded read-ahead.
     """
     # Validate input file format
     if not json_file_path.endswith((".json", ".jsonl")):
         print("Invalid file format. Please provide a .json or .jsonl file.")
         return
-    
+
     # Prepare output file paths
     base_path = os.path.splitext(json_file_path)[0]
-    valid_file_path = f"{base_path}_valid.json"
-    problem_file_path = f"{base_path}_problems.json"
-    
-    # Load the dataset
-    try:
-        data = load_dataset("json", data_files=json_file_path)["train"]
-    except Exception as e:
-        print(f"Error loading dataset: {e}")
-        return
-    
-    valid_data = []
-    problem_data = []
+    valid_file_path = f"{base_path}_valid.jsonl"
+    problem_file_path = f"{base_path}_problems.jsonl"
+
+    # a .json array is converted once to the JSONL sidecar the training dataset reads
+    jsonl_path = annotation_jsonl(json_file_path, getattr(data_args, "annotation_cache_dir", None))
+
+    merge_size = data_args.image_processor.merge_size
     stats = {
         'total_entries': 0,
         'valid_entries': 0,
         'missing_media': 0,
+        'unreadable_media': 0,
         'token_mismatches': 0,
         'gpt_media_tokens': 0,
+        'too_long': 0,
         'missing_files': [],
         'media_types': {
             'image': 0,
@@ -42,128 +142,172 @@ def validate_data(json_file_path, media_folder_path):
             'mixed': 0
         }
     }
-    
-    print(f"Processing {len(data)} entries...")
-    
-    for item in tqdm(data):
+    # token counts as histograms, so memory does not grow with the number of entries
+    vision_tokens, total_tokens = Counter(), Counter()
+
+    def check(record, future, valid_file, problem_file):
+        media_info, grid_thw, missing_files, unreadable = future.result()
         stats['total_entries'] += 1
         problems = []
-        
-        # Check media file existence (handle both singular and plural fields)
-        media_info = {
-            'image': item.get("image", item.get("images", [])),
-            'video': item.get("video", item.get("videos", []))
-        }
-        
-        # Convert all media fields to lists
-        for media_type in media_info:
-            if isinstance(media_info[media_type], str):
-                media_info[media_type] = [media_info[media_type]]
-            elif not isinstance(media_info[media_type], list):
-                media_info[media_type] = []
-        
+
         # Count media types for stats
         media_counts = {k: len(v) for k, v in media_info.items()}
         active_media = [k for k, v in media_counts.items() if v > 0]
-        
         if len(active_media) > 1:
             stats['media_types']['mixed'] += 1
         elif len(active_media) == 1:
             stats['media_types'][active_media[0]] += 1
-        
-        # Check all media files exist
-        missing_files = []
-        for media_type, files in media_info.items():
-            for media_file in files:
-                media_path = os.path.join(media_folder_path, media_file)
-                if not os.path.exists(media_path):
-                    missing_files.append(media_path)
-        
+
         if missing_files:
             stats['missing_media'] += 1
-            stats['missing_files'].extend(missing_files)
+            free = MAX_REPORTED_FILES - len(stats['missing_files'])
+            stats['missing_files'].extend(missing_files[:max(free, 0)])
             problems.append({
                 'type': 'missing_files',
                 'files': missing_files,
                 'message': f"Missing media files: {missing_files}"
             })
-        
+        if unreadable:
+            stats['unreadable_media'] += 1
+            problems.append({
+                'type': 'unreadable_files',
+                'files': unreadable,
+                'message': f"Unreadable media files: {[u['file'] for u in unreadable]}"
+            })
+
         # Check media token consistency
-        conversations = item.get("conversations", [])
-        expected_counts = {
-            'image': media_counts['image'],
-            'video': media_counts['video']
-        }
-        
-        actual_counts = {
-            'image': 0,
-            'video': 0
-        }
+        actual_counts = {'image': 0, 'video': 0}
         gpt_has_media_token = False
-        
-        for conv in conversations:
+        for conv in record.get("conversations", []):
             if conv.get("from") == "human":
                 actual_counts['image'] += conv.get("value", "").count("<image>")
                 actual_counts['video'] += conv.get("value", "").count("<video>")
             elif conv.get("from") == "gpt":
                 if "<image>" in conv.get("value", "") or "<video>" in conv.get("value", ""):
                     gpt_has_media_token = True
-        
-        # Check token counts match media counts
+
         for media_type in ['image', 'video']:
-            if actual_counts[media_type] != expected_counts[media_type]:
+            if actual_counts[media_type] != media_counts[media_type]:
                 stats['token_mismatches'] += 1
                 problems.append({
                     'type': 'token_mismatch',
                     'media_type': media_type,
-                    'expected': expected_counts[media_type],
+                    'expected': media_counts[media_type],
                     'actual': actual_counts[media_type],
-                    'message': f"Expected {expected_counts[media_type]} <{media_type}> tokens, found {actual_counts[media_type]}"
+                    'message': f"Expected {media_counts[media_type]} <{media_type}> tokens, found {actual_counts[media_type]}"
                 })
                 break  # Count each entry only once for mismatches
-        
+
         if gpt_has_media_token:
             stats['gpt_media_tokens'] += 1
             problems.append({
                 'type': 'gpt_media_token',
                 'message': "GPT response contains media token (<image> or <video>)"
             })
-        
+
+        # Check the token budget, once every media file was probed
+        num_vision_tokens = sum(int(np.prod(thw)) // merge_size**2 for thw in grid_thw)
+        num_tokens = None
+        if not problems:
+            vision_tokens[num_vision_tokens] += 1
+            if tokenizer is not None:
+                visual_type = "video" if media_counts['video'] and not media_counts['image'] else "image"
+                num_tokens = count_tokens(record, grid_thw, visual_type, tokenizer, merge_size)
+                total_tokens[num_tokens] += 1
+            budget_tokens = num_tokens if num_tokens is not None else num_vision_tokens
+            if model_max_length is not None and budget_tokens > model_max_length:
+                stats['too_long'] += 1
+                problems.append({
+                    'type': 'too_long',
+                    'num_tokens': budget_tokens,
+                    'message': f"{budget_tokens} {'tokens' if num_tokens is not None else 'vision tokens'} exceed model_max_length {model_max_length}"
+                })
+
         # Categorize the item
         if not problems:
             stats['valid_entries'] += 1
-            valid_data.append(item)
+            valid_file.write(json.dumps(record, ensure_ascii=False) + "\n")
         else:
-            problem_item = item.copy()
+            problem_item = record.copy()
+            problem_item['grid_thw'] = grid_thw
+            problem_item['num_vision_tokens'] = num_vision_tokens
+            if num_tokens is not None:
+                problem_item['num_tokens'] = num_tokens
             problem_item['validation_problems'] = problems
-            problem_data.append(problem_item)
-    
-    # Save results
-    with open(valid_file_path, 'w') as f:
-        json.dump(valid_data, f, indent=2)
-    
-    with open(problem_file_path, 'w') as f:
-        json.dump(problem_data, f, indent=2)
-    
+            problem_file.write(json.dumps(problem_item, ensure_ascii=False) + "\n")
+
+    # media are probed ahead on the pool; records are checked and written in input order
+    window = num_workers * RECORDS_IN_FLIGHT_PER_WORKER
+    in_flight = deque()
+    with ThreadPoolExecutor(num_workers) as pool, \
+            open(valid_file_path, 'w', encoding='utf-8') as valid_file, \
+            open(problem_file_path, 'w', encoding='utf-8') as problem_file:
+        for item in tqdm(read_records(jsonl_path), desc="Validating", unit=" entries"):
+            in_flight.append((item, pool.submit(probe_media, item, media_folder_path, data_args)))
+            if len(in_flight) >= window:
+                check(*in_flight.popleft(), valid_file, problem_file)
+        while in_flight:
+            check(*in_flight.popleft(), valid_file, problem_file)
+
     # Print summary
     print("\nValidation Summary:")
     print(f"Total entries processed: {stats['total_entries']}")
-    print(f"Valid entries: {stats['valid_entries']} ({stats['valid_entries']/stats['total_entries']:.1%})")
+    print(f"Valid entries: {stats['valid_entries']} ({stats['valid_entries']/max(stats['total_entries'], 1):.1%})")
     print(f"Media type distribution:")
     print(f"  - Image only: {stats['media_types']['image']}")
     print(f"  - Video only: {stats['media_types']['video']}")
     print(f"  - Mixed media: {stats['media_types']['mixed']}")
     print(f"Entries with missing media: {stats['missing_media']}")
+    print(f"Entries with unreadable media: {stats['unreadable_media']}")
     print(f"Entries with token mismatches: {stats['token_mismatches']}")
     print(f"Entries with GPT media tokens: {stats['gpt_media_tokens']}")
-    
+    print(f"Entries over model_max_length: {stats['too_long']}")
+    for name, counts in (("Vision tokens", vision_tokens), ("Total tokens", total_tokens)):
+        if counts:
+            print(f"{name} per checked entry: {summarize(counts)}")
+    print(f"Valid entries written to {valid_file_path}, problems to {problem_file_path}")
+
     if stats['missing_files']:
-        print("\nSample missing files (max 5):")
-        for f in stats['missing_files'][:5]:
+        print(f"\nSample missing files (max {MAX_REPORTED_FILES}):")
+        for f in stats['missing_files']:
             print(f"  - {f}")
+    return stats
+
 
-# Example usage
 if __name__ == "__main__":
-    json_file_path = "example.json"  # Replace with your JSON file path
-    media_folder_path = "media"      # Replace with your media folder path
-    validate_data(json_file_path, media_folder_path)
\ No newline at end of file
+    from transformers import AutoProcessor, AutoTokenizer, Qwen2VLImageProcessor
+
+    from qwenvl.train.argument import DataArguments
+
+    parser = argparse.ArgumentParser(description="Validate the media and token budget of an annotation file.")
+    parser.add_argument("json_file_path", type=str, help=".json or .jsonl annotation file")
+    parser.add_argument("media_folder_path", type=str, help="Folder the media paths are relative to")
+    parser.add_argument("--model_name_or_path", type=str, default=None,
+                        help="Tokenizer and image processor to count tokens with; without it only vision tokens are counted")
+    parser.add_argument("--model_max_length", type=int, default=None)
+    parser.add_argument("--min_pixels", type=int, default=DataArguments.min_pixels)
+    parser.add_argument("--max_pixels", type=int, default=DataArguments.max_pixels)
+    parser.add_argument("--num_workers", type=int, default=16, help="Threads probing media files")
+    parser.add_argument("--annotation_cache_dir", type=str, default=None,
+                        help="Where a .json file's JSONL conversion is written, as in training")
+    args = parser.parse_args()
+
+    data_args = DataArguments(
+        min_pixels=args.min_pixels,
+        max_pixels=args.max_pixels,
+        annotation_cache_dir=args.annotation_cache_dir,
+    )
+    tokenizer = None
+    if args.model_name_or_path:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=False)
+        data_args.image_processor = AutoProcessor.from_pretrained(args.model_name_or_path).image_processor
+    else:
+        data_args.image_processor = Qwen2VLImageProcessor()
+    validate_data(
+        args.json_file_path,
+        args.media_folder_path,
+        data_args,
+        tokenizer=tokenizer,
+        model_max_length=args.model_max_length,
+        num_workers=args.num_workers,
+    )